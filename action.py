@@ -18,6 +18,7 @@ except ImportError as e:
 import six
 from six import text_type as unicode
 
+from collections import OrderedDict
 from functools import partial
 from zipfile import ZipFile
 from calibre.devices.usbms.driver import debug_print
@@ -49,7 +50,6 @@ from calibre.library import current_library_name
 from calibre.utils.config import config_dir
 
 from calibre_plugins.annotations.annotated_books import AnnotatedBooksDialog
-from calibre_plugins.annotations.annotations import merge_annotations, merge_annotations_with_comments
 from calibre_plugins.annotations.annotations_db import AnnotationsDB
 
 from calibre_plugins.annotations.common_utils import (CompileUI,
@@ -62,6 +62,7 @@ from calibre_plugins.annotations.common_utils import (CompileUI,
 from calibre_plugins.annotations.config import plugin_prefs
 from calibre_plugins.annotations.find_annotations import FindAnnotationsDialog
 from calibre_plugins.annotations.message_box_ui import COVER_ICON_SIZE
+from calibre_plugins.annotations.parallel_render import RenderPool, merge_task
 from calibre_plugins.annotations.reader_app_support import *
 from calibre.constants import numeric_version as calibre_version
 
@@ -131,55 +132,42 @@ class AnnotationsAction(InterfaceAction, Logger):
         else:
             return False
 
-    def add_annotations_to_calibre(self, book_mi, annotations_db, cid):
+    def annotations_merge_task(self, book_mi, annotations_db, cid):
         """
-        Add annotations from a single db to calibre
-        Update destination Comments or #<custom>
+        Gather the newly imported annotations and the current destination
+        Comments or #<custom> as a merge task, for run_tasks() or a RenderPool
+        Returns None, before rendering anything, if the destination already
+        holds every imported annotation
         """
         update_field = get_cc_mapping('annotations', 'field', 'Comments')
         self._log_location(update_field)
         library_db = self.opts.gui.current_db
-        mi = library_db.get_metadata(cid, index_is_id=True)
-
-        # Get the newly imported annotations
-        self._log_location("Getting new annotations as soup...")
-        raw_annotations = self.opts.db.annotations_to_html(annotations_db, book_mi)
-        self._log_location("New raw_annotations=%s" % raw_annotations)
-        new_soup = BeautifulSoup(self.opts.db.annotations_to_html(annotations_db, book_mi))
-        self._log_location("new_soup=%s" % new_soup)
-        new_annotation_string = None
+        merge_index = getattr(self.reader_app_class, 'MERGE_INDEX', 'hash')
 
+        # Any older annotations?
         if update_field == "Comments":
-            # Append merged annotations to end of existing Comments
-
-            # Any older annotations?
-            comments = library_db.comments(cid, index_is_id=True)
-            if comments is None:
-                comments = unicode(new_soup)
-            else:
-                # Keep comments, update annotations
-                comments_soup = BeautifulSoup(comments)
-                comments = merge_annotations_with_comments(self, cid, comments_soup, new_soup)
-            new_annotation_string = comments
+            old_value = library_db.comments(cid, index_is_id=True)
         else:
-            # Generate annotations formatted for custom field
-            # Any older annotations?
-            if mi.get_user_metadata(update_field, False)['#value#'] is None:
-                new_annotation_string = unicode(new_soup)
-            else:
-                # Merge new hashes into old
-                self._log_location("Current Annotation in library=%s" % mi.get_user_metadata(update_field, False)['#value#'])
-                old_soup = BeautifulSoup(mi.get_user_metadata(update_field, False)['#value#'])
-                self._log_location("Have old soup=%s" % old_soup)
-                merged_soup = merge_annotations(self, cid, old_soup, new_soup)
-                new_annotation_string = unicode(merged_soup)
-#                 self._log_location("Have merged soup=%s" % merged_soup)
+            mi = library_db.get_metadata(cid, index_is_id=True)
+            old_value = mi.get_user_metadata(update_field, False)['#value#']
+        self._log_debug("Current Annotation in library=%s", old_value)
+        stored = self.opts.db.get_library_annotations(library_db.library_id, cid,
+                                                      update_field, old_value)
+
+        # Anything new? A hash merge adds only content hashes not already stored
+        if stored is not None and merge_index == 'hash':
+            chashes = set(ann['chash'] for ann in stored['annotations'])
+            if self.opts.db.get_content_hashes(annotations_db, book_mi['book_id']) <= chashes:
+                self._log(" annotations unchanged: '%s' cid:%d " % (book_mi['title'], cid))
+                return None
 
-#         self._log_location("Updateing GUI view")
-        #self.gui.library_view.select_rows([cid], using_ids=True)
+        # Get the newly imported annotations
+        self._log_location("Getting new annotations as HTML...")
+        new_html = self.opts.db.annotations_to_html(annotations_db, book_mi)
+        self._log_debug("New raw_annotations=%s", new_html)
 
-        self._log(" annotations updated: '%s' cid:%d " % (mi.title, cid))
-        return new_annotation_string
+        self._log(" annotations queued: '%s' cid:%d " % (book_mi['title'], cid))
+        return merge_task(cid, update_field, old_value, new_html, merge_index, stored)
 
     def create_menu_item(self, m, menu_text, image=None, tooltip=None, shortcut=None):
         ac = self.create_action(spec=(menu_text, None, tooltip, shortcut), attr=menu_text)
@@ -316,12 +304,15 @@ class AnnotationsAction(InterfaceAction, Logger):
                     self.opts.pb.show()
 
                     updated_annotations = 0
+                    unchanged_annotations = 0
 
                     try:
                         for reader_app in d.selected_books:
                             Application.processEvents()
                             annotations_db = ReaderApp.generate_annotations_db_name(reader_app, source)
-                            updated_annotations += self.process_selected_books(d.selected_books, reader_app, annotations_db)
+                            updated, unchanged = self.process_selected_books(d.selected_books, reader_app, annotations_db)
+                            updated_annotations += updated
+                            unchanged_annotations += unchanged
                     except:
                         import traceback
                         traceback.print_exc()
@@ -331,8 +322,8 @@ class AnnotationsAction(InterfaceAction, Logger):
                         MessageBox(MessageBox.ERROR, title, msg, det_msg, show_copy_button=False).exec_()
                         self._log_location("ERROR: %s" % msg)
                     self.opts.pb.hide()
-                    if updated_annotations:
-                        self.report_updated_annotations(updated_annotations)
+                    if updated_annotations or unchanged_annotations:
+                        self.report_updated_annotations(updated_annotations, unchanged_annotations)
 
         else:
             title = _("No annotated books found on device")
@@ -536,7 +527,7 @@ class AnnotationsAction(InterfaceAction, Logger):
             ra.get_active_annotations()
             books_db = ra.generate_books_db_name(reader_app, self.ios.device_name)
             annotations_db = ra.generate_annotations_db_name(reader_app, self.ios.device_name)
-            books = ra.get_books(books_db)
+            books = self.opts.db.get_annotated_books(books_db, annotations_db)
             ra.close()
             self.opts.pb.hide()
 
@@ -545,27 +536,19 @@ class AnnotationsAction(InterfaceAction, Logger):
 
             # Get the books for this db
             this_book_list = []
-            for book in books:
-                book_mi = {}
-                for key in list(book.keys()):
-                    book_mi[key] = book[key]
-                if not book_mi['active']:
-                    continue
-                annotation_count = self.opts.db.get_annotation_count(annotations_db, book_mi['book_id'])
-                last_update = self.opts.db.get_last_update(books_db, book_mi['book_id'], as_timestamp=True)
-                if annotation_count:
-                    this_book_list.append({
-                        'annotations': annotation_count,
-                        'author': book_mi['author'],
-                        'author_sort': book_mi['author_sort'] if book_mi['author_sort'] else book_mi['author'],
-                        'book_id': book_mi['book_id'],
-                        'genre': book_mi['genre'],
-                        'last_update': last_update,
-                        'reader_app': reader_app,
-                        'title': book_mi['title'],
-                        'title_sort': book_mi['title_sort'] if book_mi['title_sort'] else book_mi['title'],
-                        'uuid': book_mi['uuid'],
-                        })
+            for book_mi in books:
+                this_book_list.append({
+                    'annotations': book_mi['annotations'],
+                    'author': book_mi['author'],
+                    'author_sort': book_mi['author_sort'] if book_mi['author_sort'] else book_mi['author'],
+                    'book_id': book_mi['book_id'],
+                    'genre': book_mi['genre'],
+                    'last_update': book_mi['last_update'],
+                    'reader_app': reader_app,
+                    'title': book_mi['title'],
+                    'title_sort': book_mi['title_sort'] if book_mi['title_sort'] else book_mi['title'],
+                    'uuid': book_mi['uuid'],
+                    })
             annotated_book_list += this_book_list
 
         except:
@@ -598,36 +581,27 @@ class AnnotationsAction(InterfaceAction, Logger):
         ra.get_active_annotations()
         books_db = ra.generate_books_db_name(reader_app, self.opts.device_name)
         annotations_db = ra.generate_annotations_db_name(reader_app, self.opts.device_name)
-        books = ra.get_books(books_db)
+        books = self.opts.db.get_annotated_books(books_db, annotations_db)
         ra.close()
 
-        #books = self.opts.db.get_books(books_db)
         if books is not None:
             self.opts.pb.set_label(_("Compiling annotations for a book"))
             self.opts.pb.set_value(0)
             # Get the books for this db
             this_book_list = []
-            for book in books:
-                book_mi = {}
-                for key in list(book.keys()):
-                    book_mi[key] = book[key]
-                if not book_mi['active']:
-                    continue
-                annotation_count = self.opts.db.get_annotation_count(annotations_db, book_mi['book_id'])
-                last_update = self.opts.db.get_last_update(books_db, book_mi['book_id'], as_timestamp=True)
-                if annotation_count:
-                    this_book_list.append({
-                        'annotations': annotation_count,
-                        'author': book_mi['author'],
-                        'author_sort': book_mi['author_sort'] if book_mi['author_sort'] else book_mi['author'],
-                        'book_id': book_mi['book_id'],
-                        'genre': book_mi['genre'],
-                        'last_update': last_update,
-                        'reader_app': reader_app,
-                        'title': book_mi['title'],
-                        'title_sort': book_mi['title_sort'] if book_mi['title_sort'] else book_mi['title'],
-                        'uuid': book_mi['uuid'],
-                        })
+            for book_mi in books:
+                this_book_list.append({
+                    'annotations': book_mi['annotations'],
+                    'author': book_mi['author'],
+                    'author_sort': book_mi['author_sort'] if book_mi['author_sort'] else book_mi['author'],
+                    'book_id': book_mi['book_id'],
+                    'genre': book_mi['genre'],
+                    'last_update': book_mi['last_update'],
+                    'reader_app': reader_app,
+                    'title': book_mi['title'],
+                    'title_sort': book_mi['title_sort'] if book_mi['title_sort'] else book_mi['title'],
+                    'uuid': book_mi['uuid'],
+                    })
             annotated_book_list += this_book_list
 
         self.opts.pb.hide()
@@ -723,6 +697,7 @@ class AnnotationsAction(InterfaceAction, Logger):
         Build an opts object with a ProgressBar
         """
         opts = Struct(
+            delta_sync=plugin_prefs.get('cfg_delta_sync_checkbox', False),
             disable_caching=plugin_prefs.get('cfg_disable_caching_checkbox', True),
             gui=self.gui,
             icon=get_icon(PLUGIN_ICONS[0]),
@@ -734,6 +709,7 @@ class AnnotationsAction(InterfaceAction, Logger):
 
         opts['pb'] = ProgressBar(parent=self.gui, window_title=self.name)
         self._log_location("disable_caching: %s" % opts.disable_caching)
+        self._log_location("delta_sync: %s" % opts.delta_sync)
         return opts
 
     def init_prefs(self):
@@ -986,6 +962,7 @@ class AnnotationsAction(InterfaceAction, Logger):
             pb.increment()
 
         self.gui.library_view.model().refresh_ids(book_ids_updated)
+        self.opts.db.purge_library_annotations(db.library_id)
     
         # Hide the progress bar
         pb.hide()
@@ -1025,8 +1002,10 @@ class AnnotationsAction(InterfaceAction, Logger):
                 self.opts.pb.set_label(_("Adding annotations to calibre"))
                 self.opts.pb.set_value(0)
                 self.opts.pb.show()
+                updated_annotations = unchanged_annotations = 0
                 try:
-                    updated_annotations = self.process_selected_books(d.selected_books, rac.app_name, rac.annotations_db)
+                    updated_annotations, unchanged_annotations = self.process_selected_books(
+                        d.selected_books, rac.app_name, rac.annotations_db)
                 except:
                     import traceback
                     traceback.print_exc()
@@ -1036,8 +1015,8 @@ class AnnotationsAction(InterfaceAction, Logger):
                     MessageBox(MessageBox.ERROR, title, msg, det_msg, show_copy_button=False).exec_()
                     self._log_location("ERROR: %s" % msg)
                 self.opts.pb.hide()
-                if updated_annotations:
-                    self.report_updated_annotations(updated_annotations)
+                if updated_annotations or unchanged_annotations:
+                    self.report_updated_annotations(updated_annotations, unchanged_annotations)
 
     def format_as_paragraph(self, msg):
         return '<p>{0}</p>'.format(msg)
@@ -1048,6 +1027,7 @@ class AnnotationsAction(InterfaceAction, Logger):
         '''
         self._log_location()
         updated_annotations = 0
+        unchanged_annotations = 0
 
         library_db = self.opts.gui.current_db
 
@@ -1057,7 +1037,19 @@ class AnnotationsAction(InterfaceAction, Logger):
         update_field = get_cc_mapping('annotations', 'field', 'Comments')
         self._log_location(update_field)
         
-        book_ids_updated = {}
+        # Merge tasks by cid, run after the loop, in worker processes when there are many
+        merge_tasks = OrderedDict()
+
+        def _queue(task):
+            # Several imports into one book, e.g. News clippings, merge in turn
+            # Returns False if there was nothing new to merge
+            if task is None:
+                return False
+            if task['cid'] in merge_tasks:
+                merge_tasks[task['cid']]['new_html'].extend(task['new_html'])
+            else:
+                merge_tasks[task['cid']] = task
+            return True
 
         for book_mi in selected_books[reader_app]:
 
@@ -1071,11 +1063,11 @@ class AnnotationsAction(InterfaceAction, Logger):
                 book_mi['cid'], confidence = self.generate_confidence(book_mi)
 
             if confidence >= 3: # and False: # Uncomment this to force Kobo devices to go through the prompts.
-                new_annotation_string = self.add_annotations_to_calibre(book_mi, annotations_db, book_mi['cid'])
-                if new_annotation_string is not None:
+                if _queue(self.annotations_merge_task(book_mi, annotations_db, book_mi['cid'])):
                     self._log(" '%s' (confidence: %d) annotations added automatically" % (book_mi['title'], confidence))
                     updated_annotations += 1
-                    book_ids_updated[book_mi['cid']] = new_annotation_string
+                else:
+                    unchanged_annotations += 1
             else:
                 # Low or zero confidence, confirm with user
                 if confidence == 0:
@@ -1151,25 +1143,40 @@ class AnnotationsAction(InterfaceAction, Logger):
                                     show_copy_button=False,
                                     default_yes=True)
                 if d.exec_() == d.Accepted:
-                    new_annotation_string = self.add_annotations_to_calibre(book_mi, annotations_db, book_mi['cid'])
-                    if new_annotation_string is not None:
-                        self._log(" '%s' (confidence: %d) annotations added automatically" % (book_mi['title'], confidence))
+                    if _queue(self.annotations_merge_task(book_mi, annotations_db, book_mi['cid'])):
                         updated_annotations += 1
-                        book_ids_updated[book_mi['cid']] = new_annotation_string
-                    self._log(" '{0}' annotations added to '{2}' with user confirmation (confidence: {1})".format(
-                        book_mi['title'], confidence, proposed_mi.title))
+                        self._log(" '{0}' annotations added to '{2}' with user confirmation (confidence: {1})".format(
+                            book_mi['title'], confidence, proposed_mi.title))
+                    else:
+                        unchanged_annotations += 1
                 else:
                     self._log(" NO CONFIDENCE: '%s' (confidence: %d), annotations not added to '%s'" %
                             (book_mi['title'], confidence, self.selected_mi.title))
             self.opts.pb.increment()
+
+        # Merge, then update every book with one set_field()
+        book_ids_updated = {}
+        book_ids_stored = {}
+        for result in RenderPool(self.opts.db).run(list(merge_tasks.values()),
+                                                   progress=self.opts.pb.refresh):
+            book_ids_updated[result['cid']] = result['value']
+            book_ids_stored[result['cid']] = result['stored']
         if len(book_ids_updated) > 0:
             debug_print("process_selected_books - Updating metadata - for column: %s number of changes=%d" % (update_field, len(book_ids_updated)))
             library_db.new_api.set_field(update_field.lower(), book_ids_updated)
+            for cid, value in book_ids_updated.items():
+                stored = book_ids_stored[cid]
+                if stored is None:
+                    self.opts.db.index_library_html(library_db.library_id, cid, value, update_field)
+                else:
+                    self.opts.db.index_library_annotations(library_db.library_id, cid,
+                                                           stored['annotations'], update_field,
+                                                           value, stored['comments'])
             self._log("About to update UI for %s books" % len(book_ids_updated))
             self.gui.library_view.model().refresh_ids(book_ids_updated,
                                           current_row=self.gui.library_view.currentIndex().row())
 
-        return updated_annotations
+        return updated_annotations, unchanged_annotations
 
     def rebuild_menus(self):
         with self.menus_lock:
@@ -1297,11 +1304,18 @@ class AnnotationsAction(InterfaceAction, Logger):
 
         self.gui.keyboard.finalize()
 
-    def report_updated_annotations(self, updated_annotations):
-        suffix = _(" from 1 book ")
-        if updated_annotations > 1:
-            suffix = _(" from {0} books ").format(updated_annotations)
-        msg = "<p>" + _("Annotations") + suffix + _("added to") + " <b>{0}</b>.</p>".format(get_cc_mapping('annotations', 'combobox', 'Comments'))
+    def report_updated_annotations(self, updated_annotations, unchanged_annotations=0):
+        msg = ''
+        if updated_annotations:
+            suffix = _(" from 1 book ")
+            if updated_annotations > 1:
+                suffix = _(" from {0} books ").format(updated_annotations)
+            msg = "<p>" + _("Annotations") + suffix + _("added to") + " <b>{0}</b>.</p>".format(get_cc_mapping('annotations', 'combobox', 'Comments'))
+        if unchanged_annotations:
+            if unchanged_annotations > 1:
+                msg += self.format_as_paragraph(_("{0} books had no new annotations.").format(unchanged_annotations))
+            else:
+                msg += self.format_as_paragraph(_("1 book had no new annotations."))
         MessageBox(MessageBox.INFO,
                    '',
                    msg=msg,
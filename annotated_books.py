@@ -6,7 +6,7 @@ __copyright__ = '2013, Greg Riker <griker@hotmail.com>, 2014-2020 additions by D
 __docformat__ = 'restructuredtext en'
 
 import operator
-from time import time, localtime, strftime
+from time import time
 
 # calibre Python 3 compatibility.
 import six
@@ -38,7 +38,7 @@ from calibre.constants import islinux, isosx, iswindows
 
 from calibre_plugins.annotations.common_utils import (
     BookStruct, HelpView, SizePersistedDialog,
-    get_clippings_cid, get_icon)
+    get_clippings_cid, get_icon, timestamp_formatter)
 
 from calibre_plugins.annotations.config import plugin_prefs
 from calibre_plugins.annotations.reader_app_support import ReaderApp
@@ -197,9 +197,6 @@ class AnnotatedBooksDialog(SizePersistedDialog):
         self.setLayout(self.l)
         self.perfect_width = 0
 
-        from calibre_plugins.annotations.appearance import default_timestamp
-        friendly_timestamp_format = plugin_prefs.get('appearance_timestamp_format', default_timestamp)
-
         # Are we collecting News clippings?
         collect_news_clippings = self.opts.prefs.get('cfg_news_clippings_checkbox', False)
         news_clippings_destination = self.opts.prefs.get('cfg_news_clippings_lineEdit', None)
@@ -214,8 +211,7 @@ class AnnotatedBooksDialog(SizePersistedDialog):
             last_annotation_timestamp = time() if book_data['last_update'] is None else book_data['last_update']
 #             debug_print("AnnotatedBooksDialog::__init__ title=%s, i=%d, the_timestamp=%s" % (book_data['title'], i, the_timestamp))
             last_annotation = SortableTableWidgetItem(
-                strftime(friendly_timestamp_format,
-                         localtime(last_annotation_timestamp)),
+                timestamp_formatter.format(last_annotation_timestamp),
                 last_annotation_timestamp)
 
             # reader_app sorts case-insensitive
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2026, agent <agent@local>'
+__docformat__ = 'restructuredtext en'
+
+'''
+Read the annotations rendered into a Comments or custom column value in one
+pass of lxml's HTML parser. Parser events feed a target that keeps only the
+annotation divs, so no document tree is built, and the records match what
+AnnotationsDB.capture_content() captures from the parsed user_annotations.
+'''
+
+import re
+
+from lxml import etree
+
+# calibre Python 3 compatibility.
+from six import text_type as unicode
+
+from calibre_plugins.annotations.common_utils import AnnotationStruct, Struct
+
+# Marker of the plugin's markup, values without it have no annotations
+USER_ANNOTATIONS = 'user_annotations'
+
+# Fields join whole serialized documents, Comments then annotations. libxml2 stops
+# at the first </html>, where html5-parser carries on into the next document.
+DOCUMENT_TAGS = re.compile(r'</?(?:html|body)\b[^>]*>', re.IGNORECASE)
+
+
+class _Comment(unicode):
+    '''
+    An HTML comment, a child of its own that adjacent text does not merge into
+    '''
+
+
+class AnnotationsTarget(object):
+    '''
+    lxml parser target collecting the annotation divs that are children of
+    the first user_annotations div, each as a light [tag, classes, attrib, children]
+    node
+    '''
+    def __init__(self):
+        # (node, is the first user_annotations) per open element
+        self.stack = []
+        self.user_annotations = False
+        self.divs = []
+
+    def start(self, tag, attrib):
+        parent = self.stack[-1][0] if self.stack else None
+        node = None
+        first_uas = False
+        if parent is not None:
+            # Only the attributes read by _record()
+            node = [tag, attrib.get('class', '').split(),
+                    dict(attrib) if tag in ('table', 'td') else None, []]
+            parent[3].append(node)
+        elif tag == 'div':
+            classes = attrib.get('class', '').split()
+            if classes and classes[0] == 'annotation' and self.stack and self.stack[-1][1]:
+                node = [tag, classes, dict(attrib), []]
+                self.divs.append(node)
+            elif USER_ANNOTATIONS in classes and not self.user_annotations:
+                self.user_annotations = first_uas = True
+        self.stack.append((node, first_uas))
+
+    def end(self, tag):
+        if self.stack:
+            self.stack.pop()
+
+    def data(self, data):
+        node = self.stack[-1][0] if self.stack else None
+        if node is None:
+            return
+        children = node[3]
+        if children and type(children[-1]) is unicode:
+            children[-1] += data
+        else:
+            children.append(unicode(data))
+
+    def comment(self, text):
+        node = self.stack[-1][0] if self.stack else None
+        if node is not None:
+            node[3].append(_Comment(text))
+
+    def close(self):
+        return self
+
+
+class UserAnnotationsTarget(object):
+    '''
+    lxml parser target noting whether there is a user_annotations div
+    '''
+    def __init__(self):
+        self.user_annotations = False
+
+    def start(self, tag, attrib):
+        if tag == 'div' and not self.user_annotations:
+            self.user_annotations = USER_ANNOTATIONS in attrib.get('class', '').split()
+
+    def close(self):
+        return self.user_annotations
+
+
+def has_user_annotations(html):
+    '''
+    Return True if html, a Comments or custom column value, holds rendered annotations
+    '''
+    if not html or USER_ANNOTATIONS not in html:
+        return False
+    parser = etree.HTMLParser(target=UserAnnotationsTarget())
+    parser.feed(DOCUMENT_TAGS.sub('', html))
+    return parser.close()
+
+
+def parse_annotations(html, book_id=None):
+    '''
+    Return the annotations rendered into html as a Struct:
+        annotations: AnnotationStruct records in document order, as
+        capture_content() returns for the parsed user_annotations
+        user_annotations: whether html has a user_annotations div
+    '''
+    if not html or USER_ANNOTATIONS not in html:
+        return Struct(annotations=[], user_annotations=False)
+    parser = etree.HTMLParser(target=AnnotationsTarget())
+    parser.feed(DOCUMENT_TAGS.sub('', html))
+    target = parser.close()
+    return Struct(annotations=[_record(div, book_id) for div in target.divs],
+                  user_annotations=target.user_annotations)
+
+
+def date_range(annotations):
+    '''
+    Return (oldest, newest) timestamp of annotations, None if there are none
+    '''
+    timestamps = []
+    for ann in annotations:
+        try:
+            timestamps.append(float(ann['last_modification']))
+        except (TypeError, ValueError):
+            continue
+    if not timestamps:
+        return None
+    return (min(timestamps), max(timestamps))
+
+
+def _descendants(node):
+    '''
+    Element nodes below node in document order, the order BeautifulSoup's find() searches
+    '''
+    for child in node[3]:
+        if isinstance(child, list):
+            yield child
+            for descendant in _descendants(child):
+                yield descendant
+
+
+def _string(node):
+    '''
+    BeautifulSoup's .string: the only child string, looking through only children
+    '''
+    children = node[3]
+    if len(children) != 1:
+        return None
+    if isinstance(children[0], list):
+        return _string(children[0])
+    return children[0]
+
+
+def _joined_strings(nodes):
+    strings = [_string(node) for node in nodes]
+    if None in strings:
+        return None
+    return '\n'.join(strings)
+
+
+def _record(div, book_id):
+    '''
+    Return the AnnotationStruct of an annotation div node, as capture_content()
+    '''
+    attrib = div[2]
+    table = timestamp = location = None
+    highlights, notes = [], []
+    for node in _descendants(div):
+        tag, classes = node[0], node[1]
+        if tag == 'table':
+            if table is None:
+                table = node
+        elif tag == 'td':
+            if timestamp is None and 'timestamp' in classes:
+                timestamp = node
+            if location is None and 'location' in classes:
+                location = node
+        elif tag == 'p':
+            if 'highlight' in classes:
+                highlights.append(node)
+            if 'note' in classes:
+                notes.append(node)
+
+    this_ua = AnnotationStruct()
+    this_ua.book_id = book_id
+    this_ua.hash = attrib.get('hash')
+    this_ua.chash = attrib.get('chash')
+    this_ua.genre = attrib.get('genre')
+    this_ua.highlight_color = table[2].get('color', 'gray') if table is not None else 'gray'
+    this_ua.reader = attrib.get('reader', '')
+    this_ua.last_modification = timestamp[2].get('uts', '0') if timestamp is not None else '0'
+    this_ua.location = _string(location) if location is not None else ''
+    this_ua.location_sort = attrib.get('location_sort', '')
+    highlight_text = _joined_strings(highlights)
+    if highlight_text is not None:
+        this_ua.highlight_text = highlight_text
+    note_text = _joined_strings(notes)
+    if note_text is not None:
+        this_ua.note_text = note_text
+    return this_ua
@@ -8,18 +8,27 @@ __license__ = 'GPL v3'
 __copyright__ = '2013, Greg Riker <griker@hotmail.com>, 2014-2020 additions by David Forrester <davidfor@internode.on.net>'
 __docformat__ = 'restructuredtext en'
 
-import hashlib, re
+import hashlib, io, json, re, struct, unicodedata
+from collections import OrderedDict, deque
+from itertools import islice
 
 # calibre Python 3 compatibility.
 import six
 from six import text_type as unicode
 
-from datetime import datetime
 from xml.sax.saxutils import escape
 
+try:
+    from html import unescape as html_unescape
+except ImportError:
+    from six.moves.html_parser import HTMLParser
+    html_unescape = HTMLParser().unescape
+
 from calibre.devices.usbms.driver import debug_print
 from calibre.ebooks.BeautifulSoup import BeautifulSoup, Tag
-from calibre_plugins.annotations.common_utils import Logger
+from calibre_plugins.annotations.annotation_parser import parse_annotations
+from calibre_plugins.annotations.common_utils import (LOG_DEBUG, Logger, log_level,
+                                                      timestamp_formatter)
 from calibre_plugins.annotations.config import plugin_prefs
 
 COLOR_MAP = {
@@ -45,6 +54,7 @@ class Annotation(object):
     div_style = "margin-bottom:1em"
 
     all_fields = [
+                    'chash',
                     'description',
                     'genre',
                     'hash',
@@ -60,16 +70,351 @@ class Annotation(object):
     def __init__(self, annotation):
         for p in self.all_fields:
             setattr(self, p, annotation.get(p))
+        self.sort_key = annotation.get('sort_key') or location_sort_key(self.location_sort,
+                                                                         self.timestamp)
 
     def __str__(self):
         return '\n'.join(["%s: %s" % (field, getattr(self, field, None)) for field in self.all_fields])
 
+def new_div_tag():
+    try:
+        ka_soup = BeautifulSoup()
+        return ka_soup.new_tag('div')
+    except:
+        return Tag(BeautifulSoup(), 'div')
+
+
+def content_hash(text, note, location, timestamp):
+    '''
+    Style-independent identity of an annotation: md5 over its highlight
+    text, note, location and timestamp, normalized so that raw device text
+    and the same text captured back from rendered HTML hash alike.
+    text, note: strings or lists of lines
+    timestamp: seconds since the epoch, fractions ignored
+    '''
+    def _normalized(value):
+        if value is None:
+            return ''
+        if isinstance(value, (list, tuple)):
+            value = '\n'.join([unicode(v) for v in value if v is not None])
+        value = html_unescape(CONTENT_MARKUP.sub('', unicode(value)))
+        return ' '.join(unicodedata.normalize('NFC', value).split())
+
+    try:
+        timestamp = '%d' % int(float(timestamp))
+    except (TypeError, ValueError):
+        timestamp = ''
+    m = hashlib.md5()
+    m.update('\x1f'.join([_normalized(text), _normalized(note),
+                          _normalized(location), timestamp]).encode('utf-8'))
+    return m.hexdigest()
+
+
+def div_content_hash(ua):
+    '''
+    Content hash of a rendered annotation div, read from its chash attribute
+    or, for annotations rendered before chash existed, computed from its content
+    '''
+    chash = ua.get('chash')
+    if chash:
+        return chash
+
+    def _strings(tags):
+        return [''.join(tag.findAll(text=True)) for tag in tags]
+
+    location = ua.find('td', 'location')
+    timestamp = ua.find('td', 'timestamp')
+    return content_hash(_strings(ua.findAll('p', 'highlight')),
+                        _strings(ua.findAll('p', 'note')),
+                        _strings([location]) if location else None,
+                        timestamp.get('uts') if timestamp else None)
+
+
+def legacy_key(hash, location):
+    '''
+    Key of an annotation on its legacy hash and location, None without a hash
+    Legacy hashes survive readers that stamp a new timestamp on every import,
+    and the location tells apart annotations whose equal text collides.
+    '''
+    if not hash:
+        return None
+    return (hash, ' '.join(unicode(location or '').split()))
+
+
+def div_legacy_key(ua):
+    '''
+    legacy_key() of a rendered annotation div
+    '''
+    location = ua.find('td', 'location')
+    return legacy_key(ua.get('hash'), ''.join(location.findAll(text=True)) if location else None)
+
+
+# Digit runs of a location_sort string
+LOCATION_SORT_PARTS = re.compile(r'\d+')
+
+# Spine of annotations without a location, placing them after located ones
+UNLOCATED = 2 ** 62
+
+# Largest location_sort component packed into an offset
+SORT_OFFSET_MAX = 2 ** 32 - 1
+
+
+def location_sort_key(location_sort, timestamp=None):
+    '''
+    Typed sort key of an annotation: (spine, offset, timestamp)
+    Readers encode location_sort differently: '%06d' locations, Kobo chapter
+    progress, 'page.page', 'spine.ladder.offset', so its digit runs are
+    compared as numbers rather than as strings. spine is the first run, offset
+    the rest packed big-endian, so that offsets compare bytewise in numeric
+    order, in Python and in sqlite alike. Annotations whose location_sort is
+    missing or is their timestamp sort after the located ones, by timestamp.
+    '''
+    try:
+        timestamp = float(timestamp or 0)
+    except (TypeError, ValueError):
+        timestamp = 0.0
+    if location_sort is None or location_sort == '':
+        return (UNLOCATED, b'', timestamp)
+
+    if isinstance(location_sort, six.integer_types + (float,)):
+        # Positions stored as numbers, e.g. Stanza book_position
+        if timestamp and float(location_sort) == timestamp:
+            return (UNLOCATED, b'', timestamp)
+        parts = [int(location_sort)]
+        if isinstance(location_sort, float):
+            parts.append(int(round((location_sort - parts[0]) * 10 ** 6)))
+    else:
+        try:
+            if timestamp and float(location_sort) == timestamp:
+                return (UNLOCATED, b'', timestamp)
+        except ValueError:
+            pass
+        parts = [int(part) for part in LOCATION_SORT_PARTS.findall(location_sort)]
+        if not parts:
+            return (UNLOCATED, b'', timestamp)
+
+    parts = [min(max(part, 0), SORT_OFFSET_MAX) for part in parts]
+    offset = struct.pack(str('>%dI' % (len(parts) - 1)), *parts[1:])
+    return (parts[0], offset, timestamp)
+
+
+def div_sort_key(ua):
+    '''
+    location_sort_key() of a rendered annotation div, timestamped by its uts
+    '''
+    timestamp = ua.find('td', 'timestamp')
+    return location_sort_key(ua.get('location_sort'), timestamp.get('uts') if timestamp else None)
+
+
+# AnnotationStyle instances by settings hash, and the one compiled from plugin_prefs
+_compiled_styles = {}
+_current_style = []
+
+
+def appearance_settings(css=None):
+    '''
+    Return the appearance prefs used when rendering, css overriding appearance_css
+    '''
+    from calibre_plugins.annotations.appearance import default_elements, default_timestamp
+    if css is None:
+        css = plugin_prefs.get('appearance_css', default_elements)
+    return {
+            'appearance_css': css,
+            'appearance_hr_checkbox': plugin_prefs.get('appearance_hr_checkbox', False),
+            'appearance_renderer': plugin_prefs.get('appearance_renderer', 'template'),
+            'appearance_timestamp_format': plugin_prefs.get('appearance_timestamp_format', default_timestamp),
+            'HORIZONTAL_RULE': plugin_prefs.get('HORIZONTAL_RULE', '<hr width="80%" />'),
+            }
+
+
+def compiled_style(css=None):
+    '''
+    Return the AnnotationStyle for the appearance prefs. The style compiled from
+    plugin_prefs is reused until invalidate_compiled_style() is called.
+    css overrides appearance_css, for previews of unsaved edits.
+    '''
+    if css is None and _current_style:
+        return _current_style[0]
+    settings = appearance_settings(css)
+    key = hashlib.md5(repr(sorted(settings.items())).encode('utf-8')).hexdigest()
+    style = _compiled_styles.get(key)
+    if style is None:
+        if len(_compiled_styles) >= 16:
+            _compiled_styles.clear()
+        style = _compiled_styles[key] = AnnotationStyle(settings, key)
+    if css is None:
+        _current_style[:] = [style]
+    return style
+
+
+def invalidate_compiled_style():
+    '''
+    Called when the appearance prefs change
+    '''
+    del _current_style[:]
+
+
+class AnnotationStyle(object):
+    '''
+    Appearance prefs compiled for rendering: element order, per-element CSS,
+    the comments_body template and the AnnotationTemplate built from them
+    '''
+    def __init__(self, settings, key):
+        self.key = key
+        self.hr_checkbox = settings['appearance_hr_checkbox']
+        self.hr_markup = settings['HORIZONTAL_RULE']
+        self.renderer = settings['appearance_renderer']
+        self.timestamp_format = settings['appearance_timestamp_format']
+
+        self.elements = []
+        for element in settings['appearance_css']:
+            self.elements.append(element['name'])
+            if element['name'] == 'Note':
+                note_style = re.sub('\n', '', element['css'])
+            elif element['name'] == 'Text':
+                text_style = re.sub('\n', '', element['css'])
+            elif element['name'] == 'Timestamp':
+                ts_style = re.sub('\n', '', element['css'])
+
+        # Additional CSS for timestamp color and bg to be formatted
+        datetime_style = ("background-color:{0};color:{1};" + ts_style)
+        self.styles = (text_style, note_style, datetime_style)
+
+        # Order the elements according to stored preferences
+        self.comments_body = ''
+        for element in self.elements:
+            if element == 'Text':
+                self.comments_body += '{text}'
+            elif element == 'Note':
+                self.comments_body += '{note}'
+            elif element == 'Timestamp':
+                ts_css = '''<table cellpadding="0" width="100%" style="{ts_style}" color="{color}">
+                                <tr>
+                                    <td class="location" style="text-align:left">{location}</td>
+                                    <td class="timestamp" uts="{unix_timestamp}" style="text-align:right">{friendly_timestamp}</td>
+                                </tr>
+                            </table>'''
+                self.comments_body += re.sub(r'>\s+<', r'><', ts_css)
+
+        # Set by Annotations._compile_template(), wrapper even if template is rejected
+        self.template = None
+        self.wrapper = None
+        self.template_checked = False
+
+# Markup stripped from text before content_hash()
+CONTENT_MARKUP = re.compile(r'<[^>]*>')
+
+# Characters the HTML parser would drop, replace or interpret in template text
+UNSAFE_TEMPLATE_TEXT = re.compile('[&<\x00-\x08\x0b-\x1f\x7f\ufffe\uffff]')
+
+
+class AnnotationTemplate(object):
+    '''
+    Render the user_annotations markup of Annotations.to_HTML() by joining
+    strings, reproducing the BeautifulSoup serialization: html/head/body
+    wrapper, implied tbody, attributes in sorted order, minimal escaping.
+    '''
+    def __init__(self, style):
+        self.elements = style.elements
+        self.styles_safe = not any(self._unsafe(css, attribute=True) for css in style.styles)
+
+        empty = unicode(BeautifulSoup(ANNOTATIONS_HEADER))
+        split = empty.rindex('</div>')
+        self.head, self.tail = empty[:split], empty[split:]
+
+        # Inserting a parsed <hr> nests its whole document, reproduce it once
+        probe = BeautifulSoup(ANNOTATIONS_HEADER)
+        probe.div.insert(0, BeautifulSoup(style.hr_markup))
+        self.hr = ''.join(unicode(child) for child in probe.div.contents)
+
+        # Attributes set to None serialize bare or empty depending on the bs4 version
+        div = new_div_tag()
+        div['none'] = None
+        self.bare_none = unicode(div) == '<div none></div>'
+
+    def document(self, parts):
+        return self.head + ''.join(parts) + self.tail
+
+    def render(self, agroup, fields):
+        '''
+        Return agroup as an annotation div, or None if its content would be
+        altered by the parser
+        '''
+        if not self.styles_safe:
+            return None
+        text = agroup.text or []
+        note = agroup.note or []
+        values = ['{0}'.format(v) for v in list(text) + list(note) +
+                  [fields['location'], fields['friendly_timestamp']]]
+        attributes = ['{0}'.format(fields[k]) for k in ('color', 'ts_style', 'unix_timestamp')]
+        if any(self._unsafe(v) for v in values) or \
+                any(self._unsafe(v, attribute=True) for v in attributes):
+            return None
+
+        body = []
+        for element in self.elements:
+            if element == 'Text':
+                for agt in text:
+                    body.append('<p class="highlight" style=%s>%s</p>' % (
+                        self._attribute(fields['text_style']), self._text(agt)))
+            elif element == 'Note':
+                for agn in note:
+                    body.append('<p class="note" style=%s>%s</p>' % (
+                        self._attribute(fields['note_style']), self._text(agn)))
+            elif element == 'Timestamp':
+                body.append('<table cellpadding="0" color=%s style=%s width="100%%"><tbody><tr>'
+                            '<td class="location" style="text-align:left">%s</td>'
+                            '<td class="timestamp" style="text-align:right" uts=%s>%s</td>'
+                            '</tr></tbody></table>' % (
+                            self._attribute(fields['color']),
+                            self._attribute(fields['ts_style']),
+                            self._text(fields['location']),
+                            self._attribute(fields['unix_timestamp']),
+                            self._text(fields['friendly_timestamp'])))
+
+        genre = escape(agroup.genre) if agroup.genre else ''
+        attrs = [('chash', fields['chash']), ('class', 'annotation'),
+                 ('genre', genre), ('hash', fields['hash']),
+                 ('location_sort', agroup.location_sort), ('reader', agroup.reader_app),
+                 ('style', ANNOTATION_DIV_STYLE)]
+        return '<div %s>%s</div>' % (
+            ' '.join(name if value is None and self.bare_none else
+                     '%s=%s' % (name, self._attribute('' if value is None else value))
+                     for name, value in attrs),
+            ''.join(body))
+
+    def _attribute(self, value):
+        '''
+        Quote value as BeautifulSoup does
+        '''
+        value = self._text(value)
+        if '"' in value:
+            if "'" in value:
+                return '"%s"' % value.replace('"', '&quot;')
+            return "'%s'" % value
+        return '"%s"' % value
+
+    def _text(self, value):
+        return '{0}'.format(value).replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+    def _unsafe(self, value, attribute=False):
+        return bool(UNSAFE_TEMPLATE_TEXT.search(value)) or (attribute and '"' in value)
+
+
 class Annotations(Annotation, Logger):
     '''
     A collection of Annotation objects
     annotations: [{title:, path:, timestamp:, genre:, highlightcolor:, text:} ...]
     Inherits Annotation solely to share style characteristics for agroups
     '''
+    LOG_SUBSYSTEM = 'render'
+
+    # Characters per chunk written by write_HTML()
+    HTML_CHUNK_SIZE = 64 * 1024
+
+    # Annotations whose cached fragments are fetched together
+    FRAGMENT_BATCH_SIZE = 500
+
     @property
     def annotations(self):
         return self.__annotations
@@ -103,232 +448,476 @@ class Annotations(Annotation, Logger):
             time = sts_elems[3]
             return "%s-%s-%s-%s" % (year, month, day, time)
         else:
-            return annotation.location_sort
+            return annotation.sort_key
 
-    def _timestamp_to_datestr(self, timestamp):
+    def _timestamp_to_datestr(self, timestamp, friendly_timestamp_format=None):
         '''
         Convert timestamp to
         01 Jan 2011 12:34:56
         '''
-        from calibre_plugins.annotations.appearance import default_timestamp
-        d = datetime.fromtimestamp(float(timestamp))
-        friendly_timestamp_format = plugin_prefs.get('appearance_timestamp_format', default_timestamp)
+        return timestamp_formatter.format(timestamp, friendly_timestamp_format)
+
+    def to_HTML(self, header='', annotations=None, style=None, fragments=None):
+        '''
+        Generate HTML with user-specified CSS, element order
+        annotations: optional iterable of Annotation objects already in
+        sort key order, consumed lazily in place of self.annotations
+        style: AnnotationStyle to render with, defaults to compiled_style()
+        fragments: optional cache of rendered annotation divs for style,
+        with fetch(digests), get(digest) and put(digest, html). Only the
+        template renderer uses it, the soup renderer renders every div.
+        '''
+        if style is None:
+            style = compiled_style()
+        if style.renderer == 'template' and self._compile_template(style) is not None:
+            return ''.join(self.iter_HTML(annotations=annotations, style=style, fragments=fragments))
+
+        comments_body = style.comments_body
+        self._log_debug("comments_body='%s'", comments_body)
+
+        if annotations is None:
+            annotations = sorted(self.annotations, key=self._annotation_sorter)
+
+        soup = BeautifulSoup(ANNOTATIONS_HEADER)
+        dtc = 0
+        # Add the annotations
+        for i, agroup in enumerate(annotations):
+            if i and style.hr_checkbox:
+                soup.div.insert(dtc, BeautifulSoup(style.hr_markup))
+                dtc += 1
+            fields = self._annotation_fields(agroup, style)
+            divTag = self._annotation_tag(agroup, comments_body, fields)
+            soup.div.insert(dtc, divTag)
+            self._log_debug("Added annotation - divTag=%s", divTag)
+            dtc += 1
+
+        return unicode(soup)
+
+    def iter_HTML(self, annotations=None, style=None, fragments=None, chunk_size=None):
+        '''
+        Yield the to_HTML() document incrementally: the opening markup, each
+        annotation div (and hr), then the closing markup, so only the annotation
+        being rendered is held in memory. With the soup renderer, each div
+        is serialized on its own.
+        chunk_size: yield strings of exactly chunk_size characters, the last shorter
+        '''
+        if style is None:
+            style = compiled_style()
+        if annotations is None:
+            annotations = sorted(self.annotations, key=self._annotation_sorter)
+        pieces = self._iter_HTML_pieces(annotations, style, fragments)
+        if chunk_size:
+            pieces = chunked(pieces, chunk_size)
+        return pieces
+
+    def write_HTML(self, out, annotations=None, style=None, fragments=None, chunk_size=None):
+        '''
+        Write the to_HTML() document to the file-like out in chunks of
+        chunk_size characters, returning the number of characters written
+        '''
+        written = 0
+        for chunk in self.iter_HTML(annotations, style, fragments,
+                                    chunk_size or self.HTML_CHUNK_SIZE):
+            out.write(chunk)
+            written += len(chunk)
+        return written
+
+    def _iter_HTML_pieces(self, annotations, style, fragments):
+        template = self._compile_template(style)
+        if style.renderer != 'template':
+            template = None
+        if template is None:
+            # The soup renderer is the uncached fallback
+            fragments = None
+        wrapper = style.wrapper
+
+        yield wrapper.head
+        annotations = iter(annotations)
+        i = 0
+        while True:
+            # Fetch the cached fragments of a batch of annotations in one lookup
+            batch = [(agroup, self._annotation_fields(agroup, style))
+                     for agroup in islice(annotations, self.FRAGMENT_BATCH_SIZE)]
+            if not batch:
+                break
+            if fragments is not None:
+                digests = [self._render_digest(agroup, fields) for agroup, fields in batch]
+                fragments.fetch(digests)
+            for j, (agroup, fields) in enumerate(batch):
+                if i and style.hr_checkbox:
+                    yield wrapper.hr
+                i += 1
+                html = None
+                if fragments is not None:
+                    html = fragments.get(digests[j])
+                if html is None:
+                    if template is not None:
+                        html = template.render(agroup, fields)
+                    if html is None:
+                        # Soup renderer, or content the parser would alter
+                        html = unicode(self._annotation_tag(agroup, style.comments_body, fields))
+                    if fragments is not None:
+                        fragments.put(digests[j], html)
+                yield html
+        yield wrapper.tail
+
+    def _annotation_fields(self, agroup, style):
+        '''
+        Return the values rendered for agroup, shared by both renderers
+        '''
+        text_style, note_style, datetime_style = style.styles
+        self._log_debug("agroup='%s'", agroup)
+        location = agroup.location
+        if location is None:
+            location = ''
+
+        friendly_timestamp = self._timestamp_to_datestr(agroup.timestamp, style.timestamp_format)
+
+        text = ''
+        if agroup.text:
+            self._log_debug("agroup.text='%s'", agroup.text)
+            for agt in agroup.text:
+                text += '<p class="highlight" style="{0}">{1}</p>'.format(text_style, agt)
+
+        note = ''
+        if agroup.note:
+            self._log_debug("agroup.note='%s'", agroup.note)
+            for agn in agroup.note:
+                note += '<p class="note" style="{0}">{1}</p>'.format(note_style, agn)
+
         try:
-            friendly_timestamp = d.strftime(friendly_timestamp_format)
+            dt_bgcolor = COLOR_MAP[agroup.highlightcolor]['bg']
+            dt_fgcolor = COLOR_MAP[agroup.highlightcolor]['fg']
         except:
-            friendly_timestamp = d.strftime(default_timestamp)
-        return friendly_timestamp
+            if agroup.highlightcolor is None:
+                msg = "No highlight color specified, using Default"
+            else:
+                msg = "Unknown color '%s' specified" % agroup.highlightcolor
+            self._log_debug(msg)
+            dt_bgcolor = COLOR_MAP['Default']['bg']
+            dt_fgcolor = COLOR_MAP['Default']['fg']
+
+        if agroup.hash is not None:
+            # Use existing hash when re-rendering
+            annotation_hash = agroup.hash
+        else:
+            m = hashlib.md5()
+            m.update(text.encode('utf-8'))
+            m.update(note.encode('utf-8'))
+            annotation_hash = m.hexdigest()
+
+        chash = agroup.chash
+        if not chash:
+            chash = content_hash(agroup.text, agroup.note, agroup.location, agroup.timestamp)
+
+        return {
+                'chash': chash,
+                'color': agroup.highlightcolor,
+                'friendly_timestamp': friendly_timestamp,
+                'hash': annotation_hash,
+                'location': location,
+                'note': note,
+                'note_style': note_style,
+                'text': text,
+                'text_style': text_style,
+                'ts_style': datetime_style.format(dt_bgcolor, dt_fgcolor),
+                'unix_timestamp': agroup.timestamp,
+                }
+
+    def _render_digest(self, agroup, fields):
+        '''
+        Digest of everything a rendered annotation div depends on, apart from the style
+        '''
+        m = hashlib.md5()
+        for value in (fields['chash'], fields['hash'], fields['text'], fields['note'],
+                      fields['location'], fields['friendly_timestamp'], fields['unix_timestamp'], fields['color'],
+                      agroup.genre, agroup.location_sort, agroup.reader_app):
+            m.update(('%r\x1f' % (value,)).encode('utf-8'))
+        return m.hexdigest()
+
+    def _annotation_tag(self, agroup, comments_body, fields):
+        '''
+        Render agroup as a BeautifulSoup div
+        '''
+        divTag = new_div_tag()
+
+        content_args = dict((k, fields[k]) for k in ('color', 'friendly_timestamp', 'location',
+                                                     'note', 'text', 'ts_style', 'unix_timestamp'))
+        comments_body_soup = BeautifulSoup(comments_body.format(**content_args))
+        while len(comments_body_soup.body.contents) > 0:
+            divTag.append(comments_body_soup.body.contents[0])
+        divTag['chash'] = fields['chash']
+        divTag['class'] = "annotation"
+        divTag['genre'] = ''
+        if agroup.genre:
+            divTag['genre'] = escape(agroup.genre)
+        divTag['hash'] = fields['hash']
+        divTag['location_sort'] = agroup.location_sort
+        divTag['reader'] = agroup.reader_app
+        divTag['style'] = ANNOTATION_DIV_STYLE
+        self._log_debug("An annotation - divTag=%s", divTag)
+        return divTag
+
+    def _compile_template(self, style):
+        '''
+        Return the AnnotationTemplate of style, or None if its output does not
+        match the BeautifulSoup renderer for a sample annotation
+        '''
+        if not style.template_checked:
+            template = AnnotationTemplate(style)
+            style.wrapper = template
+            sample = Annotation({
+                'genre': 'Fiction & "Fact"',
+                'highlightcolor': 'Yellow',
+                'location': 'Location 42',
+                'location_sort': None,
+                'note': ['A note > a highlight', ''],
+                'reader_app': 'Kindle',
+                'text': ["It's a sample", 'with two lines'],
+                'timestamp': 1356998400.0,
+                })
+            fields = self._annotation_fields(sample, style)
+            expected = unicode(self._annotation_tag(sample, style.comments_body, fields))
+            if template.render(sample, fields) != expected:
+                self._log_location("template renderer disabled, output differs from BeautifulSoup")
+                template = None
+            style.template = template
+            style.template_checked = True
+        return style.template
+
+    def iter_text(self, fmt='text', annotations=None, timestamp_format=None, record=None):
+        '''
+        Yield annotations as plain text, Markdown or JSON Lines, one chunk per
+        annotation, without building any soup
+        fmt: a key of TEXT_RENDERERS
+        annotations: optional iterable of Annotation objects already in
+        sort key order, consumed lazily in place of self.annotations
+        record: optional fields added to every JSON Lines record, e.g. book_id
+        '''
+        try:
+            header, render = TEXT_RENDERERS[fmt]
+        except KeyError:
+            raise ValueError("Unknown annotations text format '%s'" % fmt)
+        if annotations is None:
+            annotations = sorted(self.annotations, key=self._annotation_sorter)
+        if timestamp_format is None:
+            timestamp_format = compiled_style().timestamp_format
+
+        if header and self.title:
+            yield header.format(title=self.title)
+        render = getattr(self, render)
+        for agroup in annotations:
+            yield render(agroup, timestamp_format, record)
+
+    def to_text(self, fmt='text', annotations=None, timestamp_format=None, record=None):
+        '''
+        Return annotations as plain text, Markdown or JSON Lines
+        '''
+        return ''.join(self.iter_text(fmt, annotations, timestamp_format, record))
 
-    def to_HTML(self, header=''):
+    def _jsonl_annotation(self, agroup, timestamp_format, record):
         '''
-        Generate HTML with user-specified CSS, element order
+        Render agroup as one JSON Lines record
+        '''
+        ann = dict(record or {})
+        ann.update({
+            'chash': agroup.chash or content_hash(agroup.text, agroup.note,
+                                                  agroup.location, agroup.timestamp),
+            'genre': agroup.genre if agroup.genre is not None else self.genre,
+            'hash': agroup.hash,
+            'highlight_color': agroup.highlightcolor,
+            'highlight_text': '\n'.join(agroup.text) if agroup.text else None,
+            'location': agroup.location,
+            'location_sort': agroup.location_sort,
+            'note_text': '\n'.join(agroup.note) if agroup.note else None,
+            'reader_app': agroup.reader_app,
+            'timestamp': agroup.timestamp,
+            'title': self.title,
+            })
+        return json.dumps(ann, ensure_ascii=False, sort_keys=True) + '\n'
+
+    def _markdown_annotation(self, agroup, timestamp_format, record):
+        '''
+        Render agroup as a Markdown section: heading, quoted highlight, note
+        '''
+        # Each highlight and note line is a paragraph of its own, as in to_HTML()
+        sections = ['### %s' % markdown_escape(self._text_heading(agroup, timestamp_format))]
+        if agroup.text:
+            sections.append('\n>\n'.join([('> %s' % markdown_escape(t)).rstrip() for t in agroup.text]))
+        if agroup.note:
+            sections.extend([markdown_escape(n) for n in agroup.note])
+        return '\n\n'.join(sections) + '\n\n'
+
+    def _text_annotation(self, agroup, timestamp_format, record):
+        '''
+        Render agroup as an indented plain text paragraph
         '''
-        # Retrieve CSS prefs
-        from calibre_plugins.annotations.appearance import default_elements
-        stored_css = plugin_prefs.get('appearance_css', default_elements)
+        lines = [self._text_heading(agroup, timestamp_format)]
+        if agroup.text:
+            lines.extend(['    %s' % t for t in agroup.text])
+        if agroup.note:
+            lines.extend(['    Note: %s' % n for n in agroup.note])
+        return '\n'.join(lines) + '\n\n'
+
+    def _text_heading(self, agroup, timestamp_format):
+        '''
+        Location, timestamp and color of agroup on one line
+        '''
+        timestamp = ''
+        if agroup.timestamp is not None:
+            timestamp = self._timestamp_to_datestr(agroup.timestamp, timestamp_format)
+        return ' | '.join([unicode(v) for v in (agroup.location, timestamp, agroup.highlightcolor) if v])
 
-        elements = []
-        for element in stored_css:
-            elements.append(element['name'])
-            if element['name'] == 'Note':
-                note_style = re.sub('\n', '', element['css'])
-            elif element['name'] == 'Text':
-                text_style = re.sub('\n', '', element['css'])
-            elif element['name'] == 'Timestamp':
-                ts_style = re.sub('\n', '', element['css'])
 
-        # Additional CSS for timestamp color and bg to be formatted
-        datetime_style = ("background-color:{0};color:{1};" + ts_style)
+def write_pieces(pieces, out=None):
+    '''
+    Write strings to the file-like out, or return them joined if out is None
+    '''
+    if out is None:
+        return ''.join(pieces)
+    for piece in pieces:
+        out.write(piece)
 
-        # Order the elements according to stored preferences
-        comments_body = ''
-        for element in elements:
-            if element == 'Text':
-                comments_body += '{text}'
-            elif element == 'Note':
-                comments_body += '{note}'
-            elif element == 'Timestamp':
-                ts_css = '''<table cellpadding="0" width="100%" style="{ts_style}" color="{color}">
-                                <tr>
-                                    <td class="location" style="text-align:left">{location}</td>
-                                    <td class="timestamp" uts="{unix_timestamp}" style="text-align:right">{friendly_timestamp}</td>
-                                </tr>
-                            </table>'''
-                comments_body += re.sub(r'>\s+<', r'><', ts_css)
-        self._log_location("comments_body='%s'" % comments_body)
-
-        if self.annotations:
-            soup = BeautifulSoup(ANNOTATIONS_HEADER)
-            dtc = 0
-
-            # Add the annotations
-            for i, agroup in enumerate(sorted(self.annotations, key=self._annotation_sorter)):
-                self._log_location("agroup='%s'" % agroup)
-                location = agroup.location
-                if location is None:
-                    location = ''
-
-                friendly_timestamp = self._timestamp_to_datestr(agroup.timestamp)
-
-                text = ''
-                if agroup.text:
-                    self._log_location("agroup.text='%s'" % agroup.text)
-                    for agt in agroup.text:
-                        self._log_location("agt='%s'" % agt)
-                        text += '<p class="highlight" style="{0}">{1}</p>'.format(text_style, agt)
-
-                note = ''
-                if agroup.note:
-                    self._log_location("agroup.note='%s'" % agroup.note)
-                    for agn in agroup.note:
-                        self._log_location("agn='%s'" % agn)
-                        note += '<p class="note" style="{0}">{1}</p>'.format(note_style, agn)
-
-                try:
-                    dt_bgcolor = COLOR_MAP[agroup.highlightcolor]['bg']
-                    dt_fgcolor = COLOR_MAP[agroup.highlightcolor]['fg']
-                except:
-                    if agroup.highlightcolor is None:
-                        msg = "No highlight color specified, using Default"
-                    else:
-                        msg = "Unknown color '%s' specified" % agroup.highlightcolor
-                    self._log_location(msg)
-                    dt_bgcolor = COLOR_MAP['Default']['bg']
-                    dt_fgcolor = COLOR_MAP['Default']['fg']
-
-                if agroup.hash is not None:
-                    # Use existing hash when re-rendering
-                    annotation_hash = agroup.hash
-                else:
-                    m = hashlib.md5()
-                    m.update(text.encode('utf-8'))
-                    m.update(note.encode('utf-8'))
-                    annotation_hash = m.hexdigest()
-
-                try:
-                    ka_soup = BeautifulSoup()
-                    divTag = ka_soup.new_tag('div')
-                    self._log_location("Used ka_soup.new_tag to create tag: %s" % divTag)
-                except:
-                    divTag = Tag(BeautifulSoup(), 'div')
-                    self._log_location("Used Tag(BeautifulSoup() to create tag: %s" % divTag)
-
-                content_args = {
-                            'color': agroup.highlightcolor,
-                            'friendly_timestamp': friendly_timestamp,
-                            'location': location,
-                            'note': note,
-                            'text': text,
-                            'ts_style': datetime_style.format(dt_bgcolor, dt_fgcolor),
-                            'unix_timestamp': agroup.timestamp,
-                            }
-#                 self._log_location("Generated comment soup: %s" % BeautifulSoup(comments_body.format(**content_args)))
-                comments_body_soup = BeautifulSoup(comments_body.format(**content_args))
-                self._log_location("Generated comment soup: comments_body_soup=%s" % comments_body_soup)
-                self._log_location("Generated comment soup: comments_body_soup.body=%s" % comments_body_soup.body)
-                self._log_location("Generated comment soup: comments_body_soup.body.children=%s" % comments_body_soup.body.children)
-                self._log_location("Generated comment soup: comments_body_soup.body.contents=%s" % comments_body_soup.body.contents)
-                self._log_location("Generated comment soup: len(comments_body_soup.body.contents)=%s" % len(comments_body_soup.body.contents))
-                for i in range(0, len(comments_body_soup.body.contents)):
-                    self._log_location("i=%s" % i)
-                    self._log_location("comment_body_tag=%s" % comments_body_soup.body.contents[i])
-                while len(comments_body_soup.body.contents) > 0:
-                    self._log_location("comment_body_tag=%s" % comments_body_soup.body.contents[0])
-                    divTag.append(comments_body_soup.body.contents[0])
-                divTag['class'] = "annotation"
-                divTag['genre'] = ''
-                if agroup.genre:
-                    divTag['genre'] = escape(agroup.genre)
-                divTag['hash'] = annotation_hash
-                divTag['location_sort'] = agroup.location_sort
-                divTag['reader'] = agroup.reader_app
-                divTag['style'] = ANNOTATION_DIV_STYLE
-                self._log_location("An annotation - divTag=%s" % divTag)
-                soup.div.insert(dtc, divTag)
-                self._log_location("Full soup after adding annotation - soup=%s" % soup)
-                dtc += 1
-                if i < len(self.annotations) - 1 and \
-                    plugin_prefs.get('appearance_hr_checkbox', False):
-                    soup.div.insert(dtc, BeautifulSoup(plugin_prefs.get('HORIZONTAL_RULE', '<hr width="80%" />')))
-                    dtc += 1
 
-        else:
-            soup = BeautifulSoup(ANNOTATIONS_HEADER)
-        return unicode(soup)
+def chunked(pieces, chunk_size):
+    '''
+    Regroup an iterable of strings into strings of exactly chunk_size
+    characters, the last one shorter
+    '''
+    parts, size = [], 0
+    for piece in pieces:
+        parts.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            data = ''.join(parts)
+            end = len(data) - len(data) % chunk_size
+            for start in range(0, end, chunk_size):
+                yield data[start:start + chunk_size]
+            parts = [data[end:]]
+            size = len(data) - end
+    if size:
+        yield ''.join(parts)
+
+
+# to_text() formats: (header, Annotations method rendering one annotation)
+TEXT_RENDERERS = {
+    'jsonl': (None, '_jsonl_annotation'),
+    'markdown': ('# {title}\n\n', '_markdown_annotation'),
+    'text': ('{title}\n\n', '_text_annotation'),
+    }
+
+MARKDOWN_SPECIAL = re.compile(r'([\\`*_{}\[\]<>#])')
+
+
+def markdown_escape(text):
+    '''
+    Backslash-escape the characters Markdown would interpret in text
+    '''
+    return MARKDOWN_SPECIAL.sub(r'\\\1', unicode(text))
+
+
+def _log_debug(*args):
+    '''
+    debug_print args when the render subsystem logs at LOG_DEBUG
+    '''
+    if log_level(Annotations.LOG_SUBSYSTEM) >= LOG_DEBUG:
+        debug_print(*args)
+
+
+def index_annotation_divs(divs, key):
+    '''
+    Index annotation divs on key(div) in a single pass
+    Return an OrderedDict of key -> deque of divs, in document order, so that
+    merges look nodes up in constant time instead of walking the tree per key.
+    '''
+    index = OrderedDict()
+    for div in divs:
+        index.setdefault(key(div), deque()).append(div)
+    return index
+
+
+def _div_hash(div):
+    return div.get('hash')
+
+
+def _div_uts(div):
+    return div.find('td', 'timestamp')['uts']
 
 
-def merge_annotations(parent, cid, old_soup, new_soup):
+def merge_annotations(parent, cid, old_soup, new_soup, out=None):
     '''
     old_soup, new_soup: BeautifulSoup()
     Need to strip <hr>, re-sort based on location, build new merged_soup
     with optional interleaved <hr> elements.
+    out: optional file-like the merged HTML is written to, piece by piece,
+    instead of being returned
     '''
-    TRANSIENT_DB = 'transient'
-    debug_print("merge_annotations - cid=", cid)
-    debug_print("merge_annotations - old_soup=", old_soup)
-    debug_print("merge_annotations - new_soup=", new_soup)
+    _log_debug("merge_annotations - cid=", cid)
+    _log_debug("merge_annotations - old_soup=", old_soup)
+    _log_debug("merge_annotations - new_soup=", new_soup)
 
     # Fetch preferred merge index technique
     merge_index = getattr(parent.reader_app_class, 'MERGE_INDEX', 'hash')
 
     if merge_index == 'hash':
-        # Get the hashes of any existing annotations
+        # Index existing annotations on content hash, which bridges legacy
+        # hashes that change with the appearance CSS
         oiuas = old_soup.findAll('div', 'annotation')
-        old_hashes = set([ua['hash'] for ua in oiuas])
-        debug_print("old hashes=", old_hashes)
+        old_index = index_annotation_divs(oiuas, div_content_hash)
+        _log_debug("old chashes=", list(old_index))
+
+        # Readers that stamp every import with the current time change the
+        # content hash, so also match on legacy hash and location
+        old_keys = set(div_legacy_key(ua) for ua in oiuas)
+        old_keys.discard(None)
 
         # Extract old user_annotations
         ouas = old_soup.find('div', 'user_annotations')
         if ouas:
-            debug_print("Getting old annotations - count=", len(ouas))
-            debug_print("Getting old annotations - old_soup=", old_soup)
-            debug_print("Getting old annotations - ouas=", ouas)
+            _log_debug("Getting old annotations - count=", len(ouas))
+            _log_debug("Getting old annotations - old_soup=", old_soup)
+            _log_debug("Getting old annotations - ouas=", ouas)
             ouas.extract()
-            debug_print("Getting old annotations - ouas after extract=", ouas)
-            debug_print("Getting old annotations - old_soup after extract=", old_soup)
+            _log_debug("Getting old annotations - ouas after extract=", ouas)
+            _log_debug("Getting old annotations - old_soup after extract=", old_soup)
 
             # Capture existing annotations
-            annotation_list = parent.opts.db.capture_content(ouas, cid, TRANSIENT_DB)
+            annotation_list = parent.opts.db.capture_content(ouas, cid)
 
             # Regurgitate old_soup with current CSS
             regurgitated_soup = BeautifulSoup(parent.opts.db.rerender_to_html_from_list(annotation_list))
-            debug_print("Getting old annotations - regurgitated_soup=", regurgitated_soup)
+            _log_debug("Getting old annotations - regurgitated_soup=", regurgitated_soup)
         else:
             regurgitated_soup = BeautifulSoup()
 
-        # Find new annotations
-        uas = new_soup.findAll('div', 'annotation')
-        new_hashes = set([ua['hash'] for ua in uas])
-        debug_print("new_hashes=", sorted(new_hashes))
-        debug_print("old hashes=", sorted(old_hashes))
-        debug_print("new_hashes.difference(old_hashes)=", new_hashes.difference(old_hashes))
-
-        updates = list(new_hashes.difference(old_hashes))
-        debug_print("differences between old and new hashs - updates=", updates)
+        # Find new annotations. Legacy hashes omit location and timestamp, and
+        # collide for equal text, so match on content or on legacy hash and
+        # location, and keep the first new div of each content hash rather
+        # than finding them by hash
+        new_index = index_annotation_divs(new_soup.findAll('div', 'annotation'), div_content_hash)
+        _log_debug("new chashes=", list(new_index))
+        updates = [divs[0] for chash, divs in six.iteritems(new_index)
+                   if chash not in old_index and div_legacy_key(divs[0]) not in old_keys]
+        _log_debug("differences between old and new hashs - updates=", [ua['hash'] for ua in updates])
         if ouas is not None:
-            if len(updates):
-                debug_print("have updates and ouas")
-                # Append new to regurgitated
-                dtc = len(regurgitated_soup.div)
-                debug_print("length regurgitated_soup - dtc=", dtc)
-                for new_annotation_id in updates:
-                    debug_print("extending regurgitated_soup - new_annotation_id=", new_annotation_id)
-                    new_annotation = new_soup.find('div', {'hash': new_annotation_id})
-                    regurgitated_soup.div.insert(dtc, new_annotation)
-                    dtc += 1
-            merged_soup = unicode(sort_merged_annotations(regurgitated_soup))
+            # Sort new after regurgitated, without moving the nodes between trees
+            uas = regurgitated_soup.findAll(location_sort=True)
+            uas.extend(ua for ua in updates if ua.get('location_sort') is not None)
+            _log_debug("have ouas - count=", len(uas))
+            # Written to out as each node is serialized
+            merged = iter_sorted_annotations(uas)
         else:
-            debug_print("have updates and ouas")
+            _log_debug("have updates and ouas")
             if not regurgitated_soup == BeautifulSoup():
-                debug_print("adding old_soup and new_soup")
-                debug_print("unicode(regurgitated_soup)=", unicode(regurgitated_soup))
-                debug_print("unicode(new_soup)=", unicode(new_soup))
-                merged_soup = unicode(regurgitated_soup) + unicode(new_soup)
+                _log_debug("adding old_soup and new_soup")
+                _log_debug("regurgitated_soup=", regurgitated_soup)
+                _log_debug("new_soup=", new_soup)
+                merged = [unicode(regurgitated_soup), unicode(new_soup)]
             else:
-                debug_print("just new_soup")
-                merged_soup = unicode(new_soup)
-        debug_print("merged_soup=", merged_soup)
-        return merged_soup
+                _log_debug("just new_soup")
+                merged = [unicode(new_soup)]
+            _log_debug("merged_soup=", merged)
+        return write_pieces(merged, out)
 
     elif merge_index == 'timestamp':
         timestamps = {}
@@ -336,18 +925,19 @@ def merge_annotations(parent, cid, old_soup, new_soup):
         suas = old_soup.findAll('div', 'annotation')
         for sua in suas:
             try:
-                timestamp = sua.find('td', 'timestamp')['uts']
+                timestamp = _div_uts(sua)
                 timestamps[timestamp] = {'stored_hash': sua['hash']}
             except:
                 continue
 
         # Rerender stored annotations
+        regurgitated_soup = BeautifulSoup()
         ouas = old_soup.find('div', 'user_annotations')
         if ouas:
             ouas.extract()
 
             # Capture existing annotations
-            annotation_list = parent.opts.db.capture_content(ouas, cid, TRANSIENT_DB)
+            annotation_list = parent.opts.db.capture_content(ouas, cid)
 
             # Regurgitate old_soup with current CSS
             regurgitated_soup = BeautifulSoup(parent.opts.db.rerender_to_html_from_list(annotation_list))
@@ -356,7 +946,7 @@ def merge_annotations(parent, cid, old_soup, new_soup):
         duas = new_soup.findAll('div', 'annotation')
         for dua in duas:
             try:
-                timestamp = dua.find('td', 'timestamp')['uts']
+                timestamp = _div_uts(dua)
                 if timestamp in timestamps:
                     timestamps[timestamp]['device_hash'] = dua['hash']
                 else:
@@ -365,41 +955,55 @@ def merge_annotations(parent, cid, old_soup, new_soup):
                 print("ERROR: malformed timestamp in device annotation")
                 print(dua.prettify())
 
-        merged_soup = BeautifulSoup(ANNOTATIONS_HEADER)
+        # Index both sides on hash once. Divs sharing a hash are handed out
+        # in document order, as successive finds of moved nodes would.
+        stored_divs = index_annotation_divs(regurgitated_soup.findAll('div', hash=True), _div_hash)
+        device_divs = index_annotation_divs(new_soup.findAll('div', hash=True), _div_hash)
 
+        uas = []
         for ts in sorted(timestamps):
             if 'stored_hash' in timestamps[ts] and not 'device_hash' in timestamps[ts]:
                 # Stored only - add from regurgitated_soup
-                annotation = regurgitated_soup.find('div', {'hash': timestamps[ts]['stored_hash']})
+                divs = stored_divs.get(timestamps[ts]['stored_hash'])
 
             elif not 'stored_hash' in timestamps[ts] and 'device_hash' in timestamps[ts]:
                 # Device only - add from new_soup
-                annotation = new_soup.find('div', {'hash': timestamps[ts]['device_hash']})
+                divs = device_divs.get(timestamps[ts]['device_hash'])
 
             elif timestamps[ts]['stored_hash'] == timestamps[ts]['device_hash']:
                 # Stored matches device - add from regurgitated_soup, as user may have modified
-                annotation = regurgitated_soup.find('div', {'hash': timestamps[ts]['stored_hash']})
+                divs = stored_divs.get(timestamps[ts]['stored_hash'])
 
             elif timestamps[ts]['stored_hash'] != timestamps[ts]['device_hash']:
                 # Device has been updated since initial capture - add from new_soup
-                annotation = new_soup.find('div', {'hash': timestamps[ts]['device_hash']})
+                divs = device_divs.get(timestamps[ts]['device_hash'])
 
             else:
                 continue
 
-            merged_soup.div.append(annotation)
+            if divs:
+                uas.append(divs.popleft())
+
+        return write_pieces(iter_sorted_annotations(ua for ua in uas
+                                                    if ua.get('location_sort') is not None), out)
 
-        return unicode(sort_merged_annotations(merged_soup))
+
+def comments_divider():
+    '''
+    Return the COMMENTS_DIVIDER markup separating Comments from user_annotations
+    '''
+    return '<div class="comments_divider"><p style="text-align:center;margin:1em 0 1em 0">{0}</p></div>'.format(
+        plugin_prefs.get('COMMENTS_DIVIDER', '&middot;  &middot;  &bull;  &middot;  &#x2726;  &middot;  &bull;  &middot; &middot;'))
 
 
-def merge_annotations_with_comments(parent, cid, comments_soup, new_soup):
+def merge_annotations_with_comments(parent, cid, comments_soup, new_soup, out=None):
     '''
     comments_soup: comments potentially with user_annotations
+    out: optional file-like the merged Comments are written to instead of returned
     '''
 
     # Prepare a new COMMENTS_DIVIDER
-    comments_divider = '<div class="comments_divider"><p style="text-align:center;margin:1em 0 1em 0">{0}</p></div>'.format(
-        plugin_prefs.get('COMMENTS_DIVIDER', '&middot;  &middot;  &bull;  &middot;  &#x2726;  &middot;  &bull;  &middot; &middot;'))
+    divider = comments_divider()
 
     # Remove the old comments_divider
     cds = comments_soup.find('div', 'comments_divider')
@@ -421,37 +1025,101 @@ def merge_annotations_with_comments(parent, cid, comments_soup, new_soup):
         # Remove the existing annotations from comments_soup
         uas.extract()
 
-        # Merge old_soup with new_soup
-        merged_soup = unicode(comments_soup) + \
-                      unicode(comments_divider) + \
-                      unicode(merge_annotations(parent, cid, old_soup, new_soup))
+        # Merge old_soup with new_soup, written after the comments rather than concatenated
+        buf = io.StringIO() if out is None else out
+        write_pieces([unicode(comments_soup), unicode(divider)], buf)
+        merge_annotations(parent, cid, old_soup, new_soup, out=buf)
+        if out is None:
+            return buf.getvalue()
     else:
         # No existing, just merge comments_soup with already sorted new_soup
-        merged_soup = unicode(comments_soup) + \
-                      unicode(comments_divider) + \
-                      unicode(new_soup)
+        return write_pieces([unicode(comments_soup), unicode(divider), unicode(new_soup)], out)
+
+
+def merge_field_annotations(parent, cid, field, old_value, new_html):
+    '''
+    Return the new value of field, Comments or a custom column, after merging
+    the rendered annotations new_html into its old_value
+    '''
+    new_soup = BeautifulSoup(new_html)
+    if old_value is None:
+        return unicode(new_soup)
+    # Stream the merge into one buffer rather than joining and concatenating it
+    out = io.StringIO()
+    if field == 'Comments':
+        # Keep comments, update annotations
+        merge_annotations_with_comments(parent, cid, BeautifulSoup(old_value), new_soup, out=out)
+    else:
+        # Merge new hashes into old
+        merge_annotations(parent, cid, BeautifulSoup(old_value), new_soup, out=out)
+    return out.getvalue()
+
+
+def merge_stored_annotations(parent, cid, field, stored, new_html):
+    '''
+    Merge the rendered annotations new_html into the stored annotations of cid,
+    as returned by AnnotationsDB.get_library_annotations(), without parsing
+    the current content of field. Produces what merge_field_annotations()
+    does in hash mode: stored annotations regurgitated with current CSS, new
+    ones inserted as rendered.
+    Return (value, stored): the new content of field and its annotations
+    '''
+    annotations = stored['annotations']
+    new_soup = BeautifulSoup(new_html)
+    if annotations:
+        chashes = set(ann['chash'] for ann in annotations)
+        old_keys = set(legacy_key(ann['hash'], ann['location']) for ann in annotations)
+        old_keys.discard(None)
+        new_index = index_annotation_divs(new_soup.findAll('div', 'annotation'), div_content_hash)
+        updates = [divs[0] for chash, divs in six.iteritems(new_index)
+                   if chash not in chashes and div_legacy_key(divs[0]) not in old_keys and
+                   divs[0].get('location_sort') is not None]
+        _log_debug("merge_stored_annotations - cid=", cid, "updates=", len(updates))
+        regurgitated_soup = BeautifulSoup(parent.opts.db.rerender_to_html_from_list(annotations))
+        uas = regurgitated_soup.findAll(location_sort=True)
+        uas.extend(updates)
+        merged = iter_sorted_annotations(uas)
+    else:
+        merged = [unicode(new_soup)]
 
-    return merged_soup
+    # Stream comments and the sorted annotations into one buffer
+    out = io.StringIO()
+    comments = stored['comments']
+    if field == 'Comments' and comments is not None:
+        write_pieces([comments, comments_divider()], out)
+    else:
+        # Nothing but the annotations
+        comments = unicode(BeautifulSoup(''))
+    start = out.tell()
+    write_pieces(merged, out)
+    value = out.getvalue()
+    annotations = [dict(ann) for ann in parse_annotations(value[start:], cid).annotations]
+    return value, {'annotations': annotations, 'comments': comments}
 
 
 def sort_merged_annotations(merged_soup):
     '''
     Input: a combined group of user annotations
-    Output: sorted by location
-    '''
-    include_hr = plugin_prefs.get('appearance_hr_checkbox', False)
-    locations = merged_soup.findAll(location_sort=True)
-    locs = [loc['location_sort'] for loc in locations]
-    locs.sort()
-
-    sorted_soup = BeautifulSoup(ANNOTATIONS_HEADER)
-    dtc = 0
-    for i, loc in enumerate(locs):
-        next_div = merged_soup.find(attrs={'location_sort': loc})
-        sorted_soup.div.insert(dtc, next_div)
-        dtc += 1
-        if include_hr and i < len(locs) - 1:
-            sorted_soup.div.insert(dtc, BeautifulSoup(plugin_prefs.get('HORIZONTAL_RULE', '<hr width="80%" />')))
-            dtc += 1
+    Output: the user_annotations HTML sorted by location, as an iterator of strings
+    '''
+    return iter_sorted_annotations(merged_soup.findAll(location_sort=True))
 
-    return sorted_soup
+
+def iter_sorted_annotations(uas):
+    '''
+    Yield the user_annotations HTML of the annotation divs uas, sorted by location
+    One stable sort over the nodes, keyed on location_sort with the timestamp
+    breaking ties, each node serialized once. The rule between annotations
+    is parsed once per style and reused.
+    '''
+    style = compiled_style()
+    if style.wrapper is None:
+        style.wrapper = AnnotationTemplate(style)
+    wrapper = style.wrapper
+
+    yield wrapper.head
+    for i, ua in enumerate(sorted(uas, key=div_sort_key)):
+        if i and style.hr_checkbox:
+            yield wrapper.hr
+        yield unicode(ua)
+    yield wrapper.tail
@@ -5,27 +5,222 @@ __license__ = 'GPL v3'
 __copyright__ = '2013, Greg Riker <griker@hotmail.com>, 2014-2020 additions by David Forrester <davidfor@internode.on.net>'
 __docformat__ = 'restructuredtext en'
 
-import os, sqlite3, sys
-from datetime import datetime
+import os, sqlite3, sys, time
+from contextlib import contextmanager
+
+# calibre Python 3 compatibility.
+from six import text_type as unicode
 
 from calibre.devices.usbms.driver import debug_print
-from calibre.ebooks.BeautifulSoup import NavigableString
-from calibre_plugins.annotations.annotations import Annotation, Annotations
-from calibre_plugins.annotations.common_utils import AnnotationStruct, Logger
+from calibre.ebooks.BeautifulSoup import BeautifulSoup, NavigableString
+from calibre_plugins.annotations.annotation_parser import parse_annotations
+from calibre_plugins.annotations.annotations import (Annotation, Annotations, compiled_style,
+                                                      content_hash, location_sort_key)
+from calibre_plugins.annotations.common_utils import (AnnotationStruct, Logger, field_digest,
+                                                      timestamp_formatter)
 from calibre_plugins.annotations.config import plugin_prefs
 
 class AnnotationsDB(Logger):
     """
     Handle I/O with SQLite db
     """
+    LOG_SUBSYSTEM = 'db'
+
+    # Schema version, stored in PRAGMA user_version
+    #  1: heap tables
+    #  2: books keyed on book_id WITHOUT ROWID, annotations indexed on (book_id, location_sort)
+    #  3: annotations.deleted tombstones, sync_state table for delta sync
+    #  4: transient table moved to an attached in-memory database
+    #  5: typed sort key columns, annotations indexed on (book_id, sort key)
+    #  6: library_annotations holds full annotation records
+    version = 6
+
+    # Schema migrations applied in order by migrate(): (user_version, description, method)
+    # Each step brings existing per-device tables forward in place, so cached
+    # content survives a plugin upgrade without being refetched from the device.
+    MIGRATIONS = (
+        (2, 'Key books tables on book_id, index annotations tables on (book_id, location_sort)',
+         '_migrate_to_v2'),
+        (3, 'Add deleted tombstone column to annotations tables', '_migrate_to_v3'),
+        (4, 'Drop the on-disk transient table', '_migrate_to_v4'),
+        (5, 'Add sort key columns to annotations tables, index on (book_id, sort key)',
+         '_migrate_to_v5'),
+        (6, 'Drop library_annotations, rebuilt with full annotation records', '_migrate_to_v6'),
+        )
+
+    # Schema name of the attached :memory: database holding transient tables
+    TRANSIENT_SCHEMA = 'transient_store'
+
+    # Rows handed to each executemany() call by the bulk methods
+    BULK_CHUNK_SIZE = 1000
+
+    # PRAGMAs applied by connect(), overridden by plugin_prefs['db_connection_profile']
+    CONNECTION_PROFILE = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -16000,           # KiB when negative
+        'temp_store': 'MEMORY',
+        'mmap_size': 64 * 1024 * 1024,
+        }
+
+    ANNOTATIONS_COLUMNS = ('book_id', 'annotation_id', 'epubcfi', 'highlight_text',
+                           'note_text', 'location', 'location_sort',
+                           'last_modification', 'highlight_color')
+    BOOKS_COLUMNS = ('active', 'author', 'author_sort', 'book_id', 'genre',
+                     'path', 'title', 'title_sort', 'uuid')
+    TRANSIENT_COLUMNS = ('book_id', 'chash', 'genre', 'hash', 'highlight_color', 'highlight_text',
+                         'location', 'location_sort', 'last_modification', 'note_text',
+                         'reader')
+
+    # Annotation records of the books in each calibre library
+    LIBRARY_COLUMNS = ('library_id', 'cid', 'chash', 'hash', 'genre', 'highlight_color',
+                       'highlight_text', 'last_modification', 'location', 'location_sort',
+                       'note_text', 'reader')
+
+    # Typed sort key stored with each annotation, see annotations.location_sort_key()
+    SORT_KEY_COLUMNS = ('sort_spine', 'sort_offset', 'sort_timestamp')
+    SORT_KEY_ORDER = ', '.join(SORT_KEY_COLUMNS)
+
+    # FTS5 tokenizers tried in order for the library annotations index.
+    # trigram supports substring matching, unicode61 only whole tokens.
+    FTS_TOKENIZERS = ('trigram', 'unicode61')
 
-    version = 1
+    # Number of appearance styles whose rendered fragments are kept
+    RENDERED_FRAGMENT_STYLES = 4
+
+    # Rows pulled per fetchmany() by the iter_* readers
+    FETCH_SIZE = 500
+
+    # Size of sqlite's per-connection prepared statement cache
+    CACHED_STATEMENTS = 256
+
+    # Statement registry. {table} is filled in once per table name by _statement(),
+    # all values are bound as parameters so the SQL text is stable across calls
+    # and sqlite's statement cache gets hits.
+    STATEMENTS = {
+        'annotation_content': '''SELECT
+                                  highlight_text,
+                                  note_text,
+                                  location,
+                                  last_modification
+                                 FROM {table}
+                                 WHERE book_id = ? AND deleted = 0''',
+        'annotation_count': '''SELECT COUNT(*)
+                               FROM {table}
+                               WHERE book_id = ? AND deleted = 0''',
+        'annotations': '''SELECT
+                           highlight_text,
+                           note_text,
+                           highlight_color,
+                           last_modification,
+                           location,
+                           location_sort,
+                           sort_spine,
+                           sort_offset,
+                           sort_timestamp
+                          FROM {table}
+                          WHERE book_id = ? AND deleted = 0
+                          ORDER BY %s''' % SORT_KEY_ORDER,
+        'books': '''SELECT
+                     active,
+                     author,
+                     author_sort,
+                     book_id,
+                     genre,
+                     title,
+                     title_sort,
+                     uuid
+                    FROM {table}''',
+        'create_annotations': '''CREATE TABLE {table}
+                                   (
+                                   annotation_id TEXT UNIQUE,
+                                   book_id TEXT,
+                                   epubcfi TEXT,
+                                   highlight_text TEXT,
+                                   note_text TEXT,
+                                   location TEXT,
+                                   location_sort TEXT,
+                                   last_modification TEXT,
+                                   highlight_color TEXT,
+                                   deleted INTEGER NOT NULL DEFAULT 0,
+                                   sort_spine INTEGER,
+                                   sort_offset BLOB,
+                                   sort_timestamp REAL
+                                   )''',
+        'create_annotations_index': '''CREATE INDEX IF NOT EXISTS {table}_book_id_sort_key
+                                        ON {table} (book_id, %s)''' % SORT_KEY_ORDER,
+        'create_books': '''CREATE TABLE {table}
+                            (
+                             book_id TEXT PRIMARY KEY,
+                             title TEXT,
+                             title_sort TEXT,
+                             author TEXT,
+                             author_sort TEXT,
+                             genre TEXT,
+                             uuid TEXT,
+                             path TEXT,
+                             active INTEGER NOT NULL,
+                             last_annotation DATETIME
+                            ) WITHOUT ROWID''',
+        'genre': '''SELECT genre
+                    FROM {table}
+                    WHERE book_id = ?''',
+        'insert_annotation': '''INSERT OR REPLACE INTO {table}
+                                 (%s)
+                                VALUES(%s)''' % (', '.join(ANNOTATIONS_COLUMNS + SORT_KEY_COLUMNS),
+                                                 ', '.join(['?'] * len(ANNOTATIONS_COLUMNS +
+                                                                       SORT_KEY_COLUMNS))),
+        'insert_book': '''INSERT OR REPLACE INTO {table}
+                           (%s)
+                          VALUES(%s)''' % (', '.join(BOOKS_COLUMNS),
+                                           ', '.join(['?'] * len(BOOKS_COLUMNS))),
+        'insert_transient': '''INSERT OR REPLACE INTO {table}
+                                (%s)
+                               VALUES(%s)''' % (', '.join(TRANSIENT_COLUMNS + SORT_KEY_COLUMNS),
+                                                ', '.join(['?'] * len(TRANSIENT_COLUMNS +
+                                                                      SORT_KEY_COLUMNS))),
+        'last_annotation': '''SELECT last_annotation
+                              FROM {table}
+                              WHERE book_id = ?''',
+        'table_exists': '''SELECT name
+                           FROM {table}
+                           WHERE type='table' AND name = ?''',
+        'title': '''SELECT title
+                    FROM {table}
+                    WHERE book_id = ?''',
+        'transient_annotations': '''SELECT
+                                     chash,
+                                     genre,
+                                     hash,
+                                     highlight_color,
+                                     highlight_text,
+                                     last_modification,
+                                     location,
+                                     location_sort,
+                                     note_text,
+                                     reader,
+                                     sort_spine,
+                                     sort_offset,
+                                     sort_timestamp
+                                    FROM {table}
+                                    WHERE book_id = ?
+                                    ORDER BY %s''' % SORT_KEY_ORDER,
+        'update_last_annotation': '''UPDATE {table}
+                                     SET last_annotation = ?
+                                     WHERE book_id = ?''',
+        }
 
     def __init__(self, opts, path):
         self.conn = None
         self.db_version = None
         self.opts = opts
         self.path = path
+        self.bulk_chunk_size = plugin_prefs.get('bulk_chunk_size', self.BULK_CHUNK_SIZE)
+        self.connection_profile = dict(self.CONNECTION_PROFILE)
+        self.connection_profile.update(plugin_prefs.get('db_connection_profile', {}))
+        self._statements = {}
+        self._transaction_depth = 0
+        self.fts_tokenizer = None
 
     def add_to_annotations_db(self, annotations_db, annotation):
         '''
@@ -39,65 +234,44 @@ class AnnotationsDB(Logger):
          location_sort
          last_modification
          highlight_color
+        The typed sort key is computed from location_sort and last_modification.
         '''
-        self.conn.execute('''
-            INSERT OR REPLACE INTO {0}
-             (book_id,
-              annotation_id,
-              epubcfi,
-              highlight_text,
-              note_text,
-              location,
-              location_sort,
-              last_modification,
-              highlight_color)
-            VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)'''.format(annotations_db),
-              (annotation['book_id'],
-              annotation['annotation_id'],
-              annotation['epubcfi'],
-              annotation['highlight_text'],
-              annotation['note_text'],
-              annotation['location'],
-              annotation['location_sort'],
-              annotation['last_modification'],
-              annotation['highlight_color'])
-             )
+        self.conn.execute(self._statement('insert_annotation', annotations_db),
+                          self._annotation_row(annotation, self.ANNOTATIONS_COLUMNS))
+
+    def add_to_annotations_db_bulk(self, annotations_db, annotations, chunk_size=None):
+        '''
+        annotations is an iterable of AnnotationStruct records, as described in
+        add_to_annotations_db(). Rows are written with executemany() in batches
+        of chunk_size, all within a single transaction.
+        Returns the number of rows written.
+        '''
+        return self._bulk_insert(annotations_db, 'insert_annotation', self.ANNOTATIONS_COLUMNS,
+                                 annotations, chunk_size, row=self._annotation_row)
 
     def add_to_books_db(self, books_db, book):
         '''
         book is a dict containing the metadata describing the book:
          book_id - unique per book for the reader app
         '''
-        self.conn.execute('''INSERT OR REPLACE INTO {0}
-                                   (
-                                    active,
-                                    author,
-                                    author_sort,
-                                    book_id,
-                                    genre,
-                                    path,
-                                    title,
-                                    title_sort,
-                                    uuid
-                                    )
-                                   VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)'''.format(books_db),
-                                   (
-                                    book['active'],
-                                    book['author'],
-                                    book['author_sort'],
-                                    book['book_id'],
-                                    book['genre'],
-                                    book['path'],
-                                    book['title'],
-                                    book['title_sort'],
-                                    book['uuid']
-                                    )
-                                )
+        self.conn.execute(self._statement('insert_book', books_db),
+                          tuple(book[column] for column in self.BOOKS_COLUMNS))
+
+    def add_to_books_db_bulk(self, books_db, books, chunk_size=None):
+        '''
+        books is an iterable of BookStruct records, as described in
+        add_to_books_db(). Rows are written with executemany() in batches
+        of chunk_size, all within a single transaction.
+        Returns the number of rows written.
+        '''
+        return self._bulk_insert(books_db, 'insert_book', self.BOOKS_COLUMNS,
+                                 books, chunk_size)
 
     def add_to_transient_db(self, transient_db, annotation):
         '''
-        Store a captured annotation in preparation for re-rendering
+        Store a captured annotation in the in-memory transient_db in preparation for re-rendering
             book_id
+            chash
             genre
             hash
             highlight_color
@@ -108,127 +282,44 @@ class AnnotationsDB(Logger):
             note_text
             reader
         '''
-        self.conn.execute('''
-            INSERT OR REPLACE INTO {0}
-             (book_id,
-              genre,
-              hash,
-              highlight_color,
-              highlight_text,
-              location,
-              location_sort,
-              last_modification,
-              note_text,
-              reader)
-            VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''.format(transient_db),
-             (annotation['book_id'],
-              annotation['genre'],
-              annotation['hash'],
-              annotation['highlight_color'],
-              annotation['highlight_text'],
-              annotation['location'],
-              annotation['location_sort'],
-              annotation['last_modification'],
-              annotation['note_text'],
-              annotation['reader']
-              )
-             )
-        self.commit()
-
-    def annotations_to_html(self, annotations_db, book_mi):
+        self.conn.execute(self._statement('insert_transient', self._transient_table(transient_db)),
+                          self._annotation_row(annotation, self.TRANSIENT_COLUMNS))
+
+    def annotations_to_html(self, annotations_db, book_mi, out=None):
         """
         Return annotations in HTML format
+        If out is given, the HTML is written to it in chunks and None is returned.
         """
-
-        def _row_to_dict(ann):
-            # Convert sqlite row object to dict
-            # Convert timestamp to float
-            # Translation table: sqlite field:Annotation
-            xl = {
-                  'last_modification': 'timestamp',
-                  'highlight_color': 'highlightcolor',
-                  'location': 'location',
-                  'location_sort': 'location_sort',
-                  'note_text': 'note',
-                  'highlight_text': 'text'
-                  }
-            ann_dict = {}
-            for key in ann.keys():
-                new_key = xl[key]
-                if key == 'last_modification' and ann[key] is not None:
-                    ann_dict[new_key] = float(ann[key])
-                elif key in ['note_text', 'highlight_text']:
-                    # Store text/notes as lists, split on line breaks
-                    if ann[key]:
-                        ann_dict[new_key] = ann[key].split('\n')
-                    else:
-                        ann_dict[new_key] = None
-                else:
-                    ann_dict[new_key] = ann[key]
-            return ann_dict
-
-        # Create an Annotations object to hold annotations
         stored_annotations = Annotations(self.opts, title=book_mi['title'])
-        annotations = self.get_annotations(annotations_db, book_mi['book_id'])
-        for ann in annotations:
-            ann = _row_to_dict(ann)
-            ann['reader_app'] = book_mi['reader_app']
-            ann['genre'] = book_mi['genre']
-            this_annotation = Annotation(ann)
-            stored_annotations.annotations.append(this_annotation)
-
-        soup = stored_annotations.to_HTML()
+        soup = self._render(stored_annotations, out=out,
+                            annotations=self._stored_annotations(annotations_db, book_mi))
         return soup
 
-    def annotations_to_text(self, annotations_db, book_mi):
+    def annotations_to_text(self, annotations_db, book_mi, fmt='text', out=None):
         """
-        Return annotations in text format
+        Return annotations in text format: 'text', 'markdown' or 'jsonl'
+        Rows stream from annotations_db straight into the renderer. If out is
+        given, chunks are written to it as they are rendered and None is returned.
         """
-        def _row_to_dict(ann):
-            # Convert sqlite row object to dict
-            # Convert timestamp to float
-            # Translation table: sqlite field:Annotation
-            xl = {
-                  'last_modification': 'timestamp',
-                  'highlight_color': 'highlightcolor',
-                  'note_text': 'note',
-                  'highlight_text': 'text'
-                  }
-            ann_dict = {}
-            for key in ann.keys():
-                new_key = xl[key]
-                if key == 'last_modification' and ann[key] is not None:
-                    ann_dict[new_key] = float(ann[key])
-                elif key in ['note_text', 'highlight_text']:
-                    # Store text/notes as lists, split on line breaks
-                    if ann[key]:
-                        ann_dict[new_key] = ann[key].split('\n')
-                    else:
-                        ann_dict[new_key] = None
-                else:
-                    ann_dict[new_key] = ann[key]
-            return ann_dict
-
-        # Create an Annotations object to hold annotations
-        stored_annotations = Annotations(self.opts, title=book_mi['title'])
-        annotations = self.get_annotations(annotations_db, book_mi['book_id'])
-        for ann in annotations:
-            ann = _row_to_dict(ann)
-            ann['reader_app'] = book_mi['reader_app']
-            this_annotation = Annotation(ann)
-            stored_annotations.annotations.append(this_annotation)
-
-        return stored_annotations.to_text()
+        stored_annotations = Annotations(self.opts, title=book_mi['title'], genre=book_mi['genre'])
+        chunks = stored_annotations.iter_text(fmt,
+                                              annotations=self._stored_annotations(annotations_db, book_mi),
+                                              record={'book_id': book_mi['book_id']})
+        if out is None:
+            return ''.join(chunks)
+        for chunk in chunks:
+            out.write(chunk)
 
-    def capture_content(self, uas, book_id, transient_db):
+    def capture_content(self, uas, book_id, transient_db=None):
         '''
-        Store a set of annotations to the transient table
+        Return a set of rendered annotations as a list of AnnotationStruct records.
+        The records are kept in process; stage them with add_to_transient_db()
+        if they need to be queried.
         '''
-        self.create_annotations_transient_table(transient_db)
-        self._log_location(book_id, uas)
+        self._log_location(book_id, "%d elements" % len(uas))
         annotation_list = []
         for ua in uas:
-            self._log_location(book_id, ua)
+            self._log_debug("book_id=%s ua=%s", book_id, ua)
             if isinstance(ua, NavigableString):
                 continue
             if ua.name != 'div' or ua['class'][0] != "annotation":
@@ -236,6 +327,7 @@ class AnnotationsDB(Logger):
             this_ua = AnnotationStruct()
             this_ua.book_id = book_id
             this_ua.hash = ua['hash']
+            this_ua.chash = ua.get('chash')
             try:
                 this_ua.genre = ua['genre']
             except:
@@ -268,21 +360,19 @@ class AnnotationsDB(Logger):
 
             try:
                 pels = ua.findAll('p', 'highlight')
-                self._log_location(book_id, "highlight pels={0}".format(pels))
                 this_ua.highlight_text = '\n'.join([p.string for p in pels])
-                self._log_location(book_id, "highlight - this_ua.highlight_text={0}".format(this_ua.highlight_text))
+                self._log_debug("book_id=%s highlight_text=%s", book_id, this_ua.highlight_text)
             except:
                 pass
 
             try:
                 nels = ua.findAll('p', 'note')
-                self._log_location(book_id, "note nels={0}".format(nels))
                 this_ua.note_text = '\n'.join([n.string for n in nels])
-                self._log_location(book_id, "highlight - this_ua.note_text={0}".format(this_ua.note_text))
+                self._log_debug("book_id=%s note_text=%s", book_id, this_ua.note_text)
             except:
                 pass
 
-            self._log_location(book_id, this_ua)
+            self._log_debug("book_id=%s annotation=%s", book_id, this_ua)
             annotation_list.append(this_ua)
         return annotation_list
 
@@ -292,67 +382,95 @@ class AnnotationsDB(Logger):
 
     def connect(self):
         db_existed = os.path.exists(self.path)
-        self.conn = sqlite3.connect(self.path)
+        self.conn = sqlite3.connect(self.path, cached_statements=self.CACHED_STATEMENTS)
+        self._statements = {}
         self.conn.row_factory = sqlite3.Row
+        self.apply_connection_profile()
+        self.conn.execute('''ATTACH DATABASE ':memory:' AS {0}'''.format(self.TRANSIENT_SCHEMA))
         if not db_existed:
             self.set_user_version(self.version)
         self.db_version = self.get_user_version()
         self._log_location("db_version: %s" % (self.db_version))
         self.create_timestamp_table()
+        self.create_sync_state_table()
+        self.create_schema_migrations_table()
+        if self.db_version < self.version:
+            self.migrate()
+        self.create_library_annotations_tables()
+        self.create_rendered_fragments_tables()
         return self.conn
 
+    def apply_connection_profile(self):
+        '''
+        Apply the PRAGMAs in self.connection_profile
+        '''
+        for pragma in sorted(self.connection_profile):
+            if pragma not in self.CONNECTION_PROFILE:
+                self._log_location("ERROR: unsupported pragma '%s'" % pragma)
+                continue
+            value = self.connection_profile[pragma]
+            try:
+                ans = self.conn.execute('''PRAGMA {0}={1}'''.format(pragma, value)).fetchone()
+                self._log_location(pragma, ans[0] if ans else value)
+            except sqlite3.Error as e:
+                self._log_location("ERROR: PRAGMA %s=%s: %s" % (pragma, value, e))
+
     def commit(self):
-        self.conn.commit()
+        '''
+        Commits inside a transaction() scope are deferred to the end of the scope
+        '''
+        if not self._transaction_depth:
+            self.conn.commit()
 
-    def create_annotations_table(self, cached_db):
+    def create_annotations_table(self, cached_db, rebuild=True):
         """
-
+        annotation_id may be NULL for some readers, so the table keeps its rowid.
+        (book_id, sort key) serves both the per-book lookups and ordered reads.
+        Rows vanished from the device are tombstoned with deleted=1 during a delta sync.
+        If rebuild is False, an existing table with the current layout is kept.
+        Returns True if the table was (re)created.
         """
+        if not rebuild and self._has_columns(cached_db, ('deleted',) + self.SORT_KEY_COLUMNS):
+            return False
 
-        self.conn.executescript('''
-            DROP TABLE IF EXISTS {0};
-            CREATE TABLE {0}
-                (
-                annotation_id TEXT UNIQUE,
-                book_id TEXT,
-                epubcfi TEXT,
-                highlight_text TEXT,
-                note_text TEXT,
-                location TEXT,
-                location_sort TEXT,
-                last_modification TEXT,
-                highlight_color TEXT
-                );'''.format(cached_db))
+        self.conn.executescript(';\n'.join([
+            '''DROP TABLE IF EXISTS {0}'''.format(cached_db),
+            self._statement('create_annotations', cached_db),
+            self._statement('create_annotations_index', cached_db)]))
+        self.set_high_water_mark(cached_db, None)
+        return True
 
-    def create_books_table(self, cached_db):
+    def create_books_table(self, cached_db, rebuild=True):
         """
-
+        One row per book, keyed on book_id
+        If rebuild is False, an existing table is kept and all its books are
+        marked inactive, to be reactivated as the installed books are upserted.
+        Returns True if the table was (re)created.
         """
-        self.conn.executescript('''
-            DROP TABLE IF EXISTS {0};
-            CREATE TABLE {0}
-                (
-                 book_id TEXT UNIQUE,
-                 title TEXT,
-                 title_sort TEXT,
-                 author TEXT,
-                 author_sort TEXT,
-                 genre TEXT,
-                 uuid TEXT,
-                 path TEXT,
-                 active INTEGER NOT NULL,
-                 last_annotation DATETIME
-                );'''.format(cached_db))
+        if not rebuild and self._has_columns(cached_db, ['book_id']):
+            self.conn.execute('''UPDATE {0} SET active = 0'''.format(cached_db))
+            return False
+
+        self.conn.executescript(';\n'.join([
+            '''DROP TABLE IF EXISTS {0}'''.format(cached_db),
+            self._statement('create_books', cached_db)]))
+        return True
 
     def create_annotations_transient_table(self, transient_table):
         '''
-        Used to temporarily store annotations when moving or re-rendering
+        Used to temporarily store annotations when moving or re-rendering.
+        The table lives in an in-memory database attached once per connection,
+        so the cache file sees no DDL. An existing table is emptied and reused.
         '''
+        if self._has_transient_table(transient_table):
+            self.conn.execute('''DELETE FROM {0}'''.format(self._transient_table(transient_table)))
+            return
+
         self.conn.executescript('''
-            DROP TABLE IF EXISTS {0};
             CREATE TABLE {0}
                 (
                 book_id TEXT,
+                chash TEXT,
                 genre TEXT,
                 hash TEXT,
                 highlight_color TEXT,
@@ -361,8 +479,132 @@ class AnnotationsDB(Logger):
                 last_modification TEXT,
                 location TEXT,
                 location_sort TEXT,
-                reader TEXT
-                );'''.format(transient_table))
+                reader TEXT,
+                sort_spine INTEGER,
+                sort_offset BLOB,
+                sort_timestamp REAL
+                );
+            CREATE INDEX {1}.{2}_book_id
+                ON {2} (book_id);'''.format(self._transient_table(transient_table),
+                                             self.TRANSIENT_SCHEMA, transient_table))
+
+    def create_library_annotations_tables(self):
+        '''
+        library_annotations holds the records of the annotations rendered into
+        each calibre library, in document order, library_annotations_fts indexes
+        their text with FTS5, kept in sync by triggers. library_fields holds the
+        digest of each book's field as last written, to detect manual edits.
+        Sets self.fts_tokenizer, None if FTS5 is unavailable.
+        '''
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS library_annotations
+                             (library_id TEXT NOT NULL,
+                              cid INTEGER NOT NULL,
+                              chash TEXT NOT NULL,
+                              hash TEXT,
+                              genre TEXT,
+                              highlight_color TEXT,
+                              highlight_text TEXT,
+                              last_modification TEXT,
+                              location TEXT,
+                              location_sort TEXT,
+                              note_text TEXT,
+                              reader TEXT)
+                          ''')
+        self.conn.execute('''CREATE INDEX IF NOT EXISTS library_annotations_library_id_cid
+                             ON library_annotations (library_id, cid)''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS library_fields
+                             (library_id TEXT NOT NULL,
+                              cid INTEGER NOT NULL,
+                              field TEXT NOT NULL,
+                              digest TEXT,
+                              comments TEXT,
+                              PRIMARY KEY (library_id, cid))
+                          ''')
+
+        fts = self.get('''SELECT sql
+                          FROM sqlite_master
+                          WHERE type='table' AND name='library_annotations_fts'
+                       ''', all=False)
+        if fts:
+            self.fts_tokenizer = ([t for t in self.FTS_TOKENIZERS if t in fts] or [None])[0]
+        else:
+            for tokenizer in self.FTS_TOKENIZERS:
+                try:
+                    self.conn.execute('''CREATE VIRTUAL TABLE library_annotations_fts
+                                         USING fts5(highlight_text, note_text,
+                                                    content='library_annotations',
+                                                    content_rowid='rowid',
+                                                    tokenize='{0}')'''.format(tokenizer))
+                except sqlite3.OperationalError as e:
+                    self._log_location("FTS5 tokenizer '%s' unavailable: %s" % (tokenizer, e))
+                    continue
+                self.fts_tokenizer = tokenizer
+                self.conn.execute('''INSERT INTO library_annotations_fts(library_annotations_fts)
+                                     VALUES('rebuild')''')
+                break
+
+        if self.fts_tokenizer:
+            self.conn.execute('''CREATE TRIGGER IF NOT EXISTS library_annotations_ai
+                                 AFTER INSERT ON library_annotations BEGIN
+                                  INSERT INTO library_annotations_fts(rowid, highlight_text, note_text)
+                                  VALUES (new.rowid, new.highlight_text, new.note_text);
+                                 END''')
+            self.conn.execute('''CREATE TRIGGER IF NOT EXISTS library_annotations_ad
+                                 AFTER DELETE ON library_annotations BEGIN
+                                  INSERT INTO library_annotations_fts(library_annotations_fts, rowid,
+                                                                      highlight_text, note_text)
+                                  VALUES ('delete', old.rowid, old.highlight_text, old.note_text);
+                                 END''')
+            self.conn.execute('''CREATE TRIGGER IF NOT EXISTS library_annotations_au
+                                 AFTER UPDATE ON library_annotations BEGIN
+                                  INSERT INTO library_annotations_fts(library_annotations_fts, rowid,
+                                                                      highlight_text, note_text)
+                                  VALUES ('delete', old.rowid, old.highlight_text, old.note_text);
+                                  INSERT INTO library_annotations_fts(rowid, highlight_text, note_text)
+                                  VALUES (new.rowid, new.highlight_text, new.note_text);
+                                 END''')
+        self._log_location("fts_tokenizer: %s" % self.fts_tokenizer)
+        self.conn.commit()
+
+    def create_rendered_fragments_tables(self):
+        '''
+        rendered_fragments maps (render input digest, style hash) to the
+        rendered annotation div, rendered_styles tracks when each style was last used
+        '''
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS rendered_fragments
+                             (digest TEXT NOT NULL,
+                              style TEXT NOT NULL,
+                              html TEXT NOT NULL,
+                              PRIMARY KEY (digest, style)) WITHOUT ROWID
+                          ''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS rendered_styles
+                             (style TEXT PRIMARY KEY,
+                              last_used DATETIME) WITHOUT ROWID
+                          ''')
+        self.conn.commit()
+
+    def create_schema_migrations_table(self):
+        '''
+        One row per applied migration step, with its elapsed time in seconds
+        '''
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS schema_migrations
+                             (version INTEGER PRIMARY KEY,
+                              description TEXT,
+                              applied DATETIME,
+                              elapsed REAL)
+                          ''')
+        self.conn.commit()
+
+    def create_sync_state_table(self):
+        '''
+        Per-table high-water marks recorded by delta syncs
+        '''
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS sync_state
+                     (db TEXT PRIMARY KEY,
+                      high_water_mark TEXT)
+                     WITHOUT ROWID
+                     ''')
+        self.conn.commit()
 
     def create_timestamp_table(self):
         #c = self.conn.cursor()
@@ -381,30 +623,62 @@ class AnnotationsDB(Logger):
             return ans[0]
         return ans.fetchall()
 
+    def get_annotated_books(self, books_db, annotations_db):
+        """
+        Return the active books in books_db having annotations in annotations_db,
+        with their annotation count and most recent last_modification.
+        Returns None if books_db does not exist.
+        """
+        table_exists = self.get(self._statement('table_exists', 'sqlite_master'), (books_db,))
+        if not table_exists:
+            return None
+
+        return self.get('''SELECT
+                             b.author,
+                             b.author_sort,
+                             b.book_id,
+                             b.genre,
+                             b.title,
+                             b.title_sort,
+                             b.uuid,
+                             COUNT(*) AS annotations,
+                             MAX(CAST(a.last_modification AS REAL)) AS last_update
+                            FROM {0} AS b
+                            JOIN {1} AS a ON a.book_id = b.book_id
+                            WHERE b.active = 1 AND a.deleted = 0
+                            GROUP BY b.book_id'''.format(books_db, annotations_db))
+
+    def get_annotated_book_ids(self, annotations_db):
+        """
+        Return the set of book_ids having cached rows in annotations_db, including tombstones
+        """
+        rows = self.get("""SELECT DISTINCT
+                            book_id
+                           FROM {0}""".format(annotations_db))
+        return set(row[0] for row in rows)
+
     def get_annotation_count(self, annotations_db, book_id):
         """
         Count annotations from annotations_db for book_id
         """
-        annotations = self.get("""SELECT
-                                   highlight_text
-                                  FROM {0}
-                                  WHERE book_id = '{1}'""".format(annotations_db, book_id))
-        return len(annotations)
+        return self.get(self._statement('annotation_count', annotations_db), (book_id,), all=False)
+
+    def get_annotation_ids(self, annotations_db):
+        """
+        Return the set of annotation_ids cached in annotations_db, including tombstones
+        """
+        rows = self.get("""SELECT
+                            annotation_id
+                           FROM {0}
+                           WHERE annotation_id IS NOT NULL""".format(annotations_db))
+        return set(row[0] for row in rows)
 
     def get_annotations(self, annotations_db, book_id):
         self._log_location(book_id)
         """
         Get annotations from annotations_db for book_id
         """
-        annotations = self.get("""SELECT
-                                   highlight_text,
-                                   note_text,
-                                   highlight_color,
-                                   last_modification,
-                                   location,
-                                   location_sort
-                                  FROM {0}
-                                  WHERE book_id = '{1}'""".format(annotations_db, book_id))
+        annotations = self.get(self._statement('annotations', annotations_db), (book_id,))
 
         return annotations
 
@@ -413,55 +687,112 @@ class AnnotationsDB(Logger):
         Get books from books_db
         """
         books = None
-        table_exists = self.get('''SELECT name
-                                   FROM sqlite_master
-                                   WHERE type='table' AND name='{0}'
-                                '''.format(books_db))
+        table_exists = self.get(self._statement('table_exists', 'sqlite_master'), (books_db,))
         if table_exists:
-            books = self.get('''SELECT
-                                 active,
-                                 author,
-                                 author_sort,
-                                 book_id,
-                                 genre,
-                                 title,
-                                 title_sort,
-                                 uuid
-                                FROM {0}'''.format(books_db))
+            books = self.get(self._statement('books', books_db))
         return books
 
+    def get_content_hashes(self, annotations_db, book_id):
+        '''
+        Return the set of content hashes of the cached annotations of book_id,
+        as they will be rendered, without rendering them
+        '''
+        return set(content_hash(*row) for row in
+                   self.iterate(self._statement('annotation_content', annotations_db), (book_id,)))
+
     def get_genres(self, books_db, book_id):
         '''
         Return genres as list
         '''
-        genre = self.get("""SELECT
-                             genre
-                            FROM {0}
-                            WHERE book_id = '{1}'""".format(books_db, book_id))
+        genre = self.get(self._statement('genre', books_db), (book_id,))
         genres = []
         if genre:
             genres = genre[0][0].split(', ')
         return genres
 
+    def get_fts_cids(self, library_id, highlight_text=None, note_text=None):
+        '''
+        Return the set of cids in library_id with an annotation whose highlight
+        contains highlight_text and whose note contains note_text, case-insensitively.
+        Returns None unless the index supports substring matching and each
+        term is at least 3 characters.
+        '''
+        terms = [(column, text) for column, text in (('highlight_text', highlight_text),
+                                                     ('note_text', note_text)) if text]
+        if self.fts_tokenizer != 'trigram' or not terms or \
+                any(len(text) < 3 for column, text in terms):
+            return None
+        query = ' AND '.join('{0} : {1}'.format(column, self.fts_phrase(text))
+                             for column, text in terms)
+        rows = self.get('''SELECT DISTINCT la.cid
+                           FROM library_annotations_fts
+                           JOIN library_annotations AS la ON la.rowid = library_annotations_fts.rowid
+                           WHERE library_annotations_fts MATCH ? AND la.library_id = ?''',
+                        (query, library_id))
+        return set(row[0] for row in rows)
+
+    def get_high_water_mark(self, cached_db):
+        """
+        Return the high-water mark recorded by the last delta sync of cached_db
+        """
+        return self.get('''SELECT high_water_mark
+                           FROM sync_state
+                           WHERE db = ?''', (cached_db,), all=False)
+
     def get_last_update(self, books_db, book_id, as_timestamp=False):
         """
         Return the last annotation created for book_id
         """
-        result = self.get("""SELECT
-                              last_annotation
-                             FROM {0}
-                             WHERE book_id = '{1}'""".format(books_db, book_id))
+        result = self.get(self._statement('last_annotation', books_db), (book_id,))
         last_update = result[0]['last_annotation']
         if last_update:
             if not as_timestamp:
                 last_update = self._timestamp_to_datestr(last_update)
         return last_update
 
+    def get_library_annotations(self, library_id, cid, field, value):
+        '''
+        Return the stored annotations of cid, if value is the content of field
+        last written by the plugin: {'annotations': AnnotationStruct records in
+        document order, 'comments': the field's content outside the annotations}
+        Returns None if value was edited since, or never indexed, in which case
+        it has to be parsed.
+        '''
+        row = self.conn.execute('''SELECT field, digest, comments
+                                   FROM library_fields
+                                   WHERE library_id = ? AND cid = ?''', (library_id, cid)).fetchone()
+        if row is None or row['field'] != field or row['digest'] != field_digest(value):
+            return None
+        annotations = []
+        for ann in self.iterate('''SELECT %s
+                                   FROM library_annotations
+                                   WHERE library_id = ? AND cid = ?
+                                   ORDER BY rowid''' % ', '.join(self.LIBRARY_COLUMNS[2:]),
+                                (library_id, cid)):
+            this_ua = AnnotationStruct()
+            this_ua.update(zip(ann.keys(), ann))
+            this_ua.book_id = cid
+            annotations.append(this_ua)
+        return {'annotations': annotations, 'comments': row['comments']}
+
+    def get_library_digests(self, library_id, field):
+        '''
+        Return {cid: (digest, annotation count, oldest, newest timestamp)} for
+        the books of library_id whose field was last written by the plugin
+        '''
+        rows = self.get('''SELECT lf.cid, lf.digest,
+                            COUNT(la.cid),
+                            MIN(CAST(la.last_modification AS REAL)),
+                            MAX(CAST(la.last_modification AS REAL))
+                           FROM library_fields AS lf
+                           LEFT JOIN library_annotations AS la
+                            ON la.library_id = lf.library_id AND la.cid = lf.cid
+                           WHERE lf.library_id = ? AND lf.field = ?
+                           GROUP BY lf.cid''', (library_id, field))
+        return dict((row[0], tuple(row[1:])) for row in rows)
+
     def get_title(self, books_db, book_id):
-        title = self.get("""SELECT
-                             title
-                            FROM {0}
-                            WHERE book_id = '{1}'""".format(books_db, book_id))
+        title = self.get(self._statement('title', books_db), (book_id,))
         return title[0][0]
 
     def get_transient_annotations(self, transient_db, book_id):
@@ -469,32 +800,192 @@ class AnnotationsDB(Logger):
         Models get_annotations()
         '''
         self._log_location(book_id)
-        annotations = self.get('''SELECT
-                                   genre,
-                                   hash,
-                                   highlight_color,
-                                   highlight_text,
-                                   last_modification,
-                                   location,
-                                   location_sort,
-                                   note_text,
-                                   reader
-                                  FROM {0}
-                                  WHERE book_id = "{1}"'''.format(transient_db, book_id))
+        annotations = self.get(self._statement('transient_annotations',
+                                               self._transient_table(transient_db)),
+                               (book_id,))
 
         return annotations
 
+    def get_unverified_cids(self, library_id, field, values):
+        '''
+        Return the set of cids in values, {cid: current content of field}, whose
+        indexed annotations cannot be trusted: never indexed for field, or
+        edited since the plugin wrote them
+        '''
+        digests = self.get_library_digests(library_id, field)
+        return set(cid for cid, value in values.items()
+                   if cid not in digests or digests[cid][0] != field_digest(value))
+
     def get_user_version(self):
         cur = self.conn.cursor()
         cur.execute('''PRAGMA user_version''')
         user_version = cur.fetchone()[0]
         return user_version
 
+    def fts_phrase(self, text):
+        '''
+        Quote text as a literal FTS5 phrase
+        '''
+        return '"{0}"'.format(text.replace('"', '""'))
+
+    def index_library_annotations(self, library_id, cid, annotations, field=None, value=None,
+                                  comments=None):
+        '''
+        Replace the stored annotations of cid in library_id.
+        annotations is an iterable of AnnotationStruct records as returned by
+        capture_content(), in document order.
+        With field, value is recorded as the content written to field and
+        comments as its content outside the annotations, for
+        get_library_annotations(). Without, the stored records are not trusted
+        and the field will be parsed.
+        '''
+        rows = []
+        for ann in annotations:
+            chash = ann.get('chash') or content_hash(ann['highlight_text'], ann['note_text'],
+                                                     ann['location'], ann['last_modification'])
+            rows.append((library_id, cid, chash) +
+                        tuple(ann.get(column) for column in self.LIBRARY_COLUMNS[3:]))
+        with self.transaction():
+            self.conn.execute('''DELETE FROM library_annotations
+                                 WHERE library_id = ? AND cid = ?''', (library_id, cid))
+            self.conn.executemany('''INSERT INTO library_annotations
+                                     (%s)
+                                     VALUES(%s)''' % (', '.join(self.LIBRARY_COLUMNS),
+                                                      ', '.join(['?'] * len(self.LIBRARY_COLUMNS))),
+                                  rows)
+            if field is None:
+                self.conn.execute('''DELETE FROM library_fields
+                                     WHERE library_id = ? AND cid = ?''', (library_id, cid))
+            else:
+                self.conn.execute('''INSERT OR REPLACE INTO library_fields
+                                     (library_id, cid, field, digest, comments)
+                                     VALUES(?, ?, ?, ?, ?)''',
+                                  (library_id, cid, field, field_digest(value), comments))
+
+    def index_library_html(self, library_id, cid, html, field=None):
+        '''
+        Index the user_annotations rendered into a book's Comments or custom field,
+        parsing it. With field, html is recorded as its content.
+        '''
+        parsed = parse_annotations(html, cid)
+        comments = None
+        if html and field is not None:
+            if parsed.user_annotations and not parsed.annotations:
+                # An empty user_annotations merges differently than none, parse it
+                field = None
+            else:
+                # The rest of the field, serialized as merges write it
+                soup = BeautifulSoup(html)
+                uas = soup.find('div', 'user_annotations')
+                if uas:
+                    uas.extract()
+                if field == 'Comments':
+                    cd = soup.find('div', 'comments_divider')
+                    if cd:
+                        cd.extract()
+                comments = unicode(soup)
+        self.index_library_annotations(library_id, cid, parsed.annotations, field, html, comments)
+
+    def iter_annotations(self, annotations_db, book_id):
+        '''
+        Generator form of get_annotations(), yielding rows in sort key order
+        '''
+        return self.iterate(self._statement('annotations', annotations_db), (book_id,))
+
+    def iter_books(self, books_db):
+        '''
+        Generator form of get_books(), yielding nothing if books_db does not exist
+        '''
+        if not self.get(self._statement('table_exists', 'sqlite_master'), (books_db,)):
+            return iter(())
+        return self.iterate(self._statement('books', books_db))
+
+    def iter_transient_annotations(self, transient_db, book_id):
+        '''
+        Generator form of get_transient_annotations()
+        '''
+        return self.iterate(self._statement('transient_annotations',
+                                            self._transient_table(transient_db)),
+                            (book_id,))
+
+    def iterate(self, sql, parameters=(), fetch_size=None):
+        '''
+        Yield the rows of a query fetch_size at a time, rather than
+        materializing the whole result set as get() does
+        '''
+        fetch_size = fetch_size or self.FETCH_SIZE
+        cur = self.conn.execute(sql, parameters)
+        try:
+            while True:
+                rows = cur.fetchmany(fetch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            cur.close()
+
+    def migrate(self):
+        '''
+        Apply the MIGRATIONS steps newer than the stored user_version, in order.
+        Each step and its user_version bump run in one transaction, and the
+        time taken is logged and recorded in schema_migrations.
+        If a step fails, the cached tables are dropped and will be refetched.
+        '''
+        for version, description, method in self.MIGRATIONS:
+            if version <= self.db_version:
+                continue
+            started = time.time()
+            try:
+                with self.transaction():
+                    getattr(self, method)()
+                    self.set_user_version(version)
+                    self.conn.execute('''INSERT OR REPLACE INTO schema_migrations
+                                         (version, description, applied, elapsed)
+                                         VALUES(?, ?, ?, ?)''',
+                                      (version, description, self.now(), time.time() - started))
+            except sqlite3.Error as e:
+                self._log_location("ERROR: migration to v%d failed: %s" % (version, e))
+                self._drop_cached_tables()
+                return
+            self.db_version = version
+            self._log_location("v%d: %s (%.3fs)" % (version, description, time.time() - started))
+
+        if self.db_version < self.version:
+            self.set_user_version(self.version)
+            self.commit()
+            self.db_version = self.version
+
     def now(self):
         c = self.conn.cursor()
         c.execute("SELECT datetime('now', 'localtime')")
         return c.fetchone()[0]
 
+    def purge_rendered_fragments(self, keep=None):
+        '''
+        Keep the fragments of the keep most recently used styles
+        '''
+        if keep is None:
+            keep = self.RENDERED_FRAGMENT_STYLES
+        with self.transaction():
+            self.conn.execute('''DELETE FROM rendered_styles
+                                 WHERE style NOT IN (SELECT style
+                                                     FROM rendered_styles
+                                                     ORDER BY last_used DESC
+                                                     LIMIT ?)''', (keep,))
+            self.conn.execute('''DELETE FROM rendered_fragments
+                                 WHERE style NOT IN (SELECT style FROM rendered_styles)''')
+
+    def purge_library_annotations(self, library_id):
+        '''
+        Drop the indexed annotations of library_id
+        '''
+        with self.transaction():
+            self.conn.execute('''DELETE FROM library_annotations
+                                 WHERE library_id = ?''', (library_id,))
+            self.conn.execute('''DELETE FROM library_fields
+                                 WHERE library_id = ?''', (library_id,))
+
     def purge_orphans(self, rac, preview):
         """
         rac: reader_app_class instance
@@ -552,7 +1043,7 @@ class AnnotationsDB(Logger):
                                    '''.format(cached_db))
             self.commit()
 
-    def rerender_to_html(self, transient_table, book_id):
+    def rerender_to_html(self, transient_table, book_id, out=None):
         '''
         Rerender a set of annotations with the current style
         Models annotations_to_html()
@@ -562,6 +1053,7 @@ class AnnotationsDB(Logger):
             # Convert timestamp to float
             # Translation table: sqlite field:Annotation
             xl = {
+                  'chash': 'chash',
                   'genre': 'genre',
                   'hash': 'hash',
                   'highlight_color': 'highlightcolor',
@@ -572,15 +1064,17 @@ class AnnotationsDB(Logger):
                   'note_text': 'note',
                   'reader': 'reader_app'
                   }
-            ann_dict = {}
+            ann_dict = {'sort_key': self._sort_key(ann)}
             for key in ann.keys():
+                if key in self.SORT_KEY_COLUMNS:
+                    continue
                 new_key = xl[key]
                 if key == 'last_modification' and ann[key] is not None:
                     ann_dict[new_key] = float(ann[key])
                 elif key in ['note_text', 'highlight_text']:
                     # Store text/notes as lists, split on line breaks
                     if ann[key]:
-                        self._log_location(key, ann[key])
+                        self._log_debug("%s=%s", key, ann[key])
                         ann_dict[new_key] = ann[key].split('\n')
                     else:
                         ann_dict[new_key] = None
@@ -588,18 +1082,16 @@ class AnnotationsDB(Logger):
                     ann_dict[new_key] = ann[key]
             return ann_dict
 
-        # Create an Annotations object to hold the re-rendered annotations
+        def _annotations():
+            for ann in self.iter_transient_annotations(transient_table, book_id):
+                yield Annotation(_row_to_dict(ann))
+
+        self._log_location(book_id)
         rerendered_annotations = Annotations(self.opts)
-        annotations = self.get_transient_annotations(transient_table, book_id)
-        self._log_location(book_id, annotations)
-        for ann in annotations:
-            ann = _row_to_dict(ann)
-            this_annotation = Annotation(ann)
-            rerendered_annotations.annotations.append(this_annotation)
-        soup = rerendered_annotations.to_HTML()
+        soup = self._render(rerendered_annotations, out=out, annotations=_annotations())
         return soup
 
-    def rerender_to_html_from_list(self, annotation_list):
+    def rerender_to_html_from_list(self, annotation_list, out=None):
         '''
         Rerender a set of annotations with the current style
         Models annotations_to_html()
@@ -610,6 +1102,7 @@ class AnnotationsDB(Logger):
             # Convert timestamp to float
             # Translation table: sqlite field:Annotation
             xl = {
+                  'chash': 'chash',
                   'genre': 'genre',
                   'hash': 'hash',
                   'highlight_color': 'highlightcolor',
@@ -631,7 +1124,7 @@ class AnnotationsDB(Logger):
                 elif key in ['note_text', 'highlight_text']:
                     # Store text/notes as lists, split on line breaks
                     if ann[key]:
-                        self._log_location(key, ann[key])
+                        self._log_debug("%s=%s", key, ann[key])
                         ann_dict[new_key] = ann[key].strip().split('\n')
                     else:
                         ann_dict[new_key] = None
@@ -641,21 +1134,124 @@ class AnnotationsDB(Logger):
 
         # Create an Annotations object to hold the re-rendered annotations
         rerendered_annotations = Annotations(self.opts)
-        self._log_location(annotation_list)
+        self._log_location("%d annotations" % len(annotation_list))
         for ann in annotation_list:
             ann = _row_to_dict(ann)
             this_annotation = Annotation(ann)
             rerendered_annotations.annotations.append(this_annotation)
-        soup = rerendered_annotations.to_HTML()
+        soup = self._render(rerendered_annotations, out=out)
         return soup
 
+    def refresh_last_annotations(self, books_db, annotations_db):
+        '''
+        Recompute last_annotation in books_db from the live rows in annotations_db
+        '''
+        self.conn.execute('''UPDATE {0}
+                             SET last_annotation =
+                              (SELECT MAX(CAST(a.last_modification AS REAL))
+                               FROM {1} AS a
+                               WHERE a.book_id = {0}.book_id AND a.deleted = 0)
+                          '''.format(books_db, annotations_db))
+
+    def search_annotations(self, library_id, query, limit=50):
+        '''
+        Ranked full-text search of the annotations rendered into library_id.
+        query uses FTS5 syntax, see fts_phrase() to match a literal.
+        Returns a list of (cid, hash, snippet), best match first, or [] if
+        FTS5 is unavailable.
+        '''
+        if not self.fts_tokenizer:
+            return []
+        rows = self.get('''SELECT
+                            la.cid,
+                            la.hash,
+                            snippet(library_annotations_fts, -1, '<b>', '</b>', '...', 32)
+                           FROM library_annotations_fts
+                           JOIN library_annotations AS la ON la.rowid = library_annotations_fts.rowid
+                           WHERE library_annotations_fts MATCH ? AND la.library_id = ?
+                           ORDER BY bm25(library_annotations_fts)
+                           LIMIT ?''', (query, library_id, limit))
+        return [(row[0], row[1], row[2]) for row in rows]
+
+    def set_high_water_mark(self, cached_db, high_water_mark):
+        if high_water_mark is None:
+            self.conn.execute('''DELETE FROM sync_state
+                                 WHERE db = ?''', (cached_db,))
+        else:
+            self.conn.execute('''INSERT OR REPLACE INTO sync_state
+                                 (db, high_water_mark) VALUES(?, ?)''',
+                                 (cached_db, high_water_mark))
+
     def set_user_version(self, db_version):
         self.conn.execute('''PRAGMA user_version={0}'''.format(db_version))
 
+    def tombstone_annotations(self, annotations_db, live_annotation_ids, chunk_size=None):
+        '''
+        Mark rows whose annotation_id is not in live_annotation_ids as deleted.
+        Returns the number of rows tombstoned.
+        '''
+        self.conn.execute('''CREATE TEMP TABLE IF NOT EXISTS live_annotations
+                             (annotation_id TEXT PRIMARY KEY)''')
+        rows = ((annotation_id,) for annotation_id in live_annotation_ids)
+        with self.transaction():
+            self.conn.execute('''DELETE FROM temp.live_annotations''')
+            for chunk in self._chunks(rows, chunk_size):
+                self.conn.executemany('''INSERT OR IGNORE INTO temp.live_annotations
+                                         VALUES(?)''', chunk)
+            cur = self.conn.execute('''UPDATE {0}
+                                       SET deleted = 1
+                                       WHERE deleted = 0 AND
+                                        annotation_id NOT IN
+                                         (SELECT annotation_id FROM temp.live_annotations)
+                                    '''.format(annotations_db))
+        self._log_location(annotations_db, "%d tombstoned" % cur.rowcount)
+        return cur.rowcount
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Scoped transaction, committed when the outermost scope exits and
+        rolled back if it exits with an exception. Nested scopes join the
+        enclosing transaction. Note that executescript(), used by the
+        create_*_table() methods, commits any pending transaction.
+        '''
+        if self._transaction_depth:
+            self._transaction_depth += 1
+            try:
+                yield self.conn
+            finally:
+                self._transaction_depth -= 1
+            return
+
+        # Commit statements pending from an implicitly opened transaction
+        self.conn.commit()
+        self.conn.execute('''BEGIN''')
+        self._transaction_depth = 1
+        try:
+            yield self.conn
+        except:
+            self._transaction_depth = 0
+            self.conn.rollback()
+            raise
+        else:
+            self._transaction_depth = 0
+            self.conn.commit()
+
     def update_book_last_annotation(self, books_db, timestamp, book_id):
-        self.conn.execute('''UPDATE {0}
-                             SET last_annotation=?
-                             WHERE book_id=?'''.format(books_db), (timestamp, book_id))
+        self.conn.execute(self._statement('update_last_annotation', books_db), (timestamp, book_id))
+
+    def update_book_last_annotation_bulk(self, books_db, last_annotations, chunk_size=None):
+        '''
+        last_annotations is a dict {book_id: timestamp}, or an iterable of
+        (book_id, timestamp) pairs
+        '''
+        if isinstance(last_annotations, dict):
+            last_annotations = last_annotations.items()
+        sql = self._statement('update_last_annotation', books_db)
+        rows = ((timestamp, book_id) for book_id, timestamp in last_annotations)
+        with self.transaction():
+            for chunk in self._chunks(rows, chunk_size):
+                self.conn.executemany(sql, chunk)
 
     def update_timestamp(self, cached_db):
         self.conn.execute(
@@ -664,10 +1260,298 @@ class AnnotationsDB(Logger):
                (cached_db, self.now()))
 
     # Helpers
+    def _render(self, collection, out=None, **kw):
+        '''
+        Render an Annotations collection with the current style, reusing and
+        storing rendered fragments. With out, stream the HTML to it instead
+        of returning it. Unconnected, as in render workers, nothing is cached.
+        '''
+        style = compiled_style()
+        fragments = None
+        if self.conn is not None:
+            fragments = RenderedFragments(self, style.key)
+        if out is None:
+            html = collection.to_HTML(style=style, fragments=fragments, **kw)
+        else:
+            collection.write_HTML(out, style=style, fragments=fragments, **kw)
+            html = None
+        if fragments is not None:
+            fragments.flush()
+        return html
+
+    def _cached_tables(self, columns):
+        '''
+        Return the names of the per-device cache tables having all of columns
+        '''
+        tables = self.get('''SELECT name
+                             FROM sqlite_master
+                             WHERE type='table' AND name NOT LIKE 'sqlite_%'
+                             ORDER BY name''')
+        return [row[0] for row in tables if self._has_columns(row[0], columns)]
+
+    def _drop_cached_tables(self):
+        '''
+        Last resort when a migration fails: discard all cached device content
+        '''
+        with self.transaction():
+            tables = set(self._cached_tables(self.BOOKS_COLUMNS))
+            tables.update(self._cached_tables(self.ANNOTATIONS_COLUMNS))
+            for table in sorted(tables):
+                self.conn.execute('''DROP TABLE IF EXISTS {0}'''.format(table))
+            self.conn.execute('''DELETE FROM timestamps''')
+            self.conn.execute('''DELETE FROM sync_state''')
+            self.conn.execute('''DROP TABLE IF EXISTS transient''')
+            self.set_user_version(self.version)
+        self.db_version = self.version
+
+    def _annotation_row(self, annotation, columns=None):
+        '''
+        Values of columns from annotation, followed by its typed sort key
+        '''
+        spine, offset, timestamp = location_sort_key(annotation['location_sort'],
+                                                     annotation['last_modification'])
+        return (tuple(annotation[column] for column in columns or self.ANNOTATIONS_COLUMNS) +
+                (spine, sqlite3.Binary(offset), timestamp))
+
+    def _bulk_insert(self, table, statement, columns, records, chunk_size, row=None):
+        '''
+        INSERT OR REPLACE records into table in chunks, committing once
+        row: optional function returning the values of a record
+        '''
+        sql = self._statement(statement, table)
+        if row is None:
+            rows = (tuple(record[column] for column in columns) for record in records)
+        else:
+            rows = (row(record, columns) for record in records)
+        count = 0
+        with self.transaction():
+            for chunk in self._chunks(rows, chunk_size):
+                self.conn.executemany(sql, chunk)
+                count += len(chunk)
+        self._log_location(table, "%d rows" % count)
+        return count
+
+    def _has_columns(self, table, columns):
+        '''
+        True if table exists and has all of columns
+        '''
+        existing = set(row[1] for row in self.conn.execute('''PRAGMA table_info({0})'''.format(table)))
+        return bool(existing) and set(columns).issubset(existing)
+
+    def _has_transient_table(self, transient_table):
+        return bool(self.get(self._statement('table_exists',
+                                             '{0}.sqlite_master'.format(self.TRANSIENT_SCHEMA)),
+                             (transient_table,)))
+
+    def _stored_annotations(self, annotations_db, book_mi):
+        '''
+        Yield the cached annotations of book_mi as Annotation objects, in
+        sort key order, without materializing the result set
+        '''
+        # Translation table: sqlite field:Annotation
+        xl = {
+              'last_modification': 'timestamp',
+              'highlight_color': 'highlightcolor',
+              'location': 'location',
+              'location_sort': 'location_sort',
+              'note_text': 'note',
+              'highlight_text': 'text'
+              }
+        for row in self.iter_annotations(annotations_db, book_mi['book_id']):
+            ann = {'sort_key': self._sort_key(row)}
+            for key in row.keys():
+                if key in self.SORT_KEY_COLUMNS:
+                    continue
+                new_key = xl[key]
+                if key == 'last_modification' and row[key] is not None:
+                    ann[new_key] = float(row[key])
+                elif key in ['note_text', 'highlight_text']:
+                    # Store text/notes as lists, split on line breaks
+                    if row[key]:
+                        ann[new_key] = row[key].split('\n')
+                    else:
+                        ann[new_key] = None
+                else:
+                    ann[new_key] = row[key]
+            ann['reader_app'] = book_mi['reader_app']
+            ann['genre'] = book_mi['genre']
+            yield Annotation(ann)
+
+    def _sort_key(self, row):
+        '''
+        Typed sort key stored in row, None if the row predates it
+        '''
+        if row['sort_spine'] is None:
+            return None
+        return (row['sort_spine'], bytes(row['sort_offset']), row['sort_timestamp'])
+
+    def _statement(self, name, table):
+        '''
+        Return the SQL text of registered statement name for table, building it
+        once per (name, table)
+        '''
+        key = (name, table)
+        sql = self._statements.get(key)
+        if sql is None:
+            sql = self._statements[key] = self.STATEMENTS[name].format(table=table)
+        return sql
+
+    def _transient_table(self, transient_table):
+        '''
+        Return the qualified name of transient_table in the in-memory database
+        '''
+        return '{0}.{1}'.format(self.TRANSIENT_SCHEMA, transient_table)
+
+    def _chunks(self, rows, chunk_size=None):
+        '''
+        Yield lists of at most chunk_size rows
+        '''
+        chunk_size = chunk_size or self.bulk_chunk_size
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _migrate_to_v2(self):
+        '''
+        Rebuild books tables as WITHOUT ROWID tables keyed on book_id,
+        index annotations tables on (book_id, location_sort)
+        '''
+        for table in self._cached_tables(self.BOOKS_COLUMNS):
+            if any(row['pk'] for row in self.get('''PRAGMA table_info({0})'''.format(table))):
+                continue
+            columns = ', '.join(self.BOOKS_COLUMNS + ('last_annotation',))
+            migrating = '{0}_migrating'.format(table)
+            self.conn.execute('''DROP TABLE IF EXISTS {0}'''.format(migrating))
+            self.conn.execute(self.STATEMENTS['create_books'].format(table=migrating))
+            self.conn.execute('''INSERT OR REPLACE INTO {0} ({2})
+                                 SELECT {2} FROM {1}
+                                 WHERE book_id IS NOT NULL'''.format(migrating, table, columns))
+            self.conn.execute('''DROP TABLE {0}'''.format(table))
+            self.conn.execute('''ALTER TABLE {0} RENAME TO {1}'''.format(migrating, table))
+        for table in self._cached_tables(self.ANNOTATIONS_COLUMNS):
+            self.conn.execute('''CREATE INDEX IF NOT EXISTS {0}_book_id_location_sort
+                                 ON {0} (book_id, location_sort)'''.format(table))
+
+    def _migrate_to_v3(self):
+        '''
+        Add the deleted column used to tombstone annotations during a delta sync
+        '''
+        for table in self._cached_tables(self.ANNOTATIONS_COLUMNS):
+            if not self._has_columns(table, ['deleted']):
+                self.conn.execute('''ALTER TABLE {0}
+                                     ADD COLUMN deleted INTEGER NOT NULL DEFAULT 0'''.format(table))
+
+    def _migrate_to_v4(self):
+        '''
+        Transient tables now live in the attached in-memory database
+        '''
+        self.conn.execute('''DROP TABLE IF EXISTS transient''')
+
+    def _migrate_to_v5(self):
+        '''
+        Add the typed sort key columns, fill them from location_sort and
+        last_modification, and replace the (book_id, location_sort) index
+        '''
+        column_types = {'sort_spine': 'INTEGER', 'sort_offset': 'BLOB', 'sort_timestamp': 'REAL'}
+        for table in self._cached_tables(self.ANNOTATIONS_COLUMNS):
+            for column in self.SORT_KEY_COLUMNS:
+                if not self._has_columns(table, [column]):
+                    self.conn.execute('''ALTER TABLE {0}
+                                         ADD COLUMN {1} {2}'''.format(table, column,
+                                                                      column_types[column]))
+            rows = self.iterate('''SELECT rowid, location_sort, last_modification
+                                   FROM {0}'''.format(table))
+            keys = []
+            for row in rows:
+                spine, offset, timestamp = location_sort_key(row[1], row[2])
+                keys.append((spine, sqlite3.Binary(offset), timestamp, row[0]))
+            for chunk in self._chunks(keys):
+                self.conn.executemany('''UPDATE {0}
+                                         SET sort_spine = ?, sort_offset = ?, sort_timestamp = ?
+                                         WHERE rowid = ?'''.format(table), chunk)
+            self.conn.execute('''DROP INDEX IF EXISTS {0}_book_id_location_sort'''.format(table))
+            self.conn.execute(self._statement('create_annotations_index', table))
+
+    def _migrate_to_v6(self):
+        '''
+        library_annotations only held highlight and note text, unique on the
+        legacy hash. It is derived from the library, so drop it with its FTS5
+        index, to be recreated with full records and refilled as books are written.
+        '''
+        for trigger in ('library_annotations_ai', 'library_annotations_ad', 'library_annotations_au'):
+            self.conn.execute('''DROP TRIGGER IF EXISTS {0}'''.format(trigger))
+        self.conn.execute('''DROP TABLE IF EXISTS library_annotations_fts''')
+        self.conn.execute('''DROP TABLE IF EXISTS library_annotations''')
+
     def _timestamp_to_datestr(self, timestamp):
         '''
         Convert timestamp to
         01 Jan 2011 12:34:56
         '''
-        d = datetime.fromtimestamp(float(timestamp))
-        return d.strftime('%d %b %Y %H:%M:%S')
+        return timestamp_formatter.format(timestamp, '%d %b %Y %H:%M:%S')
+
+
+class RenderedFragments(object):
+    '''
+    Rendered annotation divs of one style, looked up in the rendered_fragments
+    table and written back by flush()
+    '''
+    # Digests bound per lookup, within sqlite's default limit of 999 parameters
+    FETCH_CHUNK_SIZE = 500
+
+    def __init__(self, db, style_key):
+        self.db = db
+        self.style_key = style_key
+        self.fetched = {}
+        self.pending = {}
+        self.used = False
+
+    def fetch(self, digests):
+        '''
+        Look up the fragments of digests not seen yet, with one query per
+        FETCH_CHUNK_SIZE digests, for get()
+        '''
+        self.used = True
+        wanted = [digest for digest in set(digests)
+                  if digest not in self.fetched and digest not in self.pending]
+        for chunk in self.db._chunks(wanted, self.FETCH_CHUNK_SIZE):
+            self.fetched.update((digest, None) for digest in chunk)
+            self.fetched.update(tuple(row) for row in self.db.get(
+                '''SELECT digest, html
+                   FROM rendered_fragments
+                   WHERE style = ? AND digest IN (%s)''' % ', '.join(['?'] * len(chunk)),
+                [self.style_key] + chunk))
+
+    def get(self, digest):
+        if digest in self.pending:
+            return self.pending[digest]
+        if digest not in self.fetched:
+            self.fetch([digest])
+        return self.fetched[digest]
+
+    def put(self, digest, html):
+        self.pending[digest] = html
+
+    def flush(self):
+        if not self.used:
+            return
+        with self.db.transaction():
+            new_style = not self.db.get('''SELECT style
+                                          FROM rendered_styles
+                                          WHERE style = ?''', (self.style_key,))
+            self.db.conn.execute('''INSERT OR REPLACE INTO rendered_styles
+                                    (style, last_used) VALUES(?, ?)''',
+                                 (self.style_key, self.db.now()))
+            self.db.conn.executemany('''INSERT OR REPLACE INTO rendered_fragments
+                                        (digest, style, html) VALUES(?, ?, ?)''',
+                                     [(digest, self.style_key, html)
+                                      for digest, html in self.pending.items()])
+        self.pending = {}
+        self.used = False
+        if new_style:
+            self.db.purge_rendered_fragments()
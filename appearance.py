@@ -363,13 +363,15 @@ class AnnotationElementsTable(QTableWidget):
         '''
         Construct a dummy annotation for preview purposes
         '''
-        from calibre_plugins.annotations.annotations import Annotation, Annotations
+        from calibre_plugins.annotations.annotations import (Annotation, Annotations,
+                                                             compiled_style)
 
         pas = Annotations(None, title=_("Preview"))
         pas.annotations.append(Annotation(self.sample_ann_1))
         pas.annotations.append(Annotation(self.sample_ann_2))
         pas.annotations.append(Annotation(self.sample_ann_3))
-        self.parent.wv.setHtml(pas.to_HTML())
+        # Preview the CSS as currently edited in the table
+        self.parent.wv.setHtml(pas.to_HTML(style=compiled_style(css=self.get_data())))
 
     def resize_row_height(self, lines, row):
         point_size = self.FONT.pointSize()
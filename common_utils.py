@@ -8,8 +8,9 @@ __license__ = 'GPL v3'
 __copyright__ = '2013, Greg Riker <griker@hotmail.com>, 2014-2020 additions by David Forrester <davidfor@internode.on.net>'
 __docformat__ = 'restructuredtext en'
 
-import re, os, sys, zipfile
-from collections import defaultdict
+import hashlib, re, os, sys, zipfile
+from collections import defaultdict, OrderedDict
+from datetime import datetime
 from time import sleep
 
 # calibre Python 3 compatibility.
@@ -43,7 +44,7 @@ except ImportError as e:
     from PyQt4.QtWebKit import QWebView
     from PyQt4.uic import compileUi
 
-from calibre.constants import iswindows
+from calibre.constants import iswindows, preferred_encoding
 from calibre.devices.usbms.driver import debug_print
 from calibre.ebooks import normalize
 from calibre.ebooks.BeautifulSoup import BeautifulSoup, BeautifulStoneSoup
@@ -107,27 +108,86 @@ plugin_icon_resources = {}
 
 '''     Base classes    '''
 
-class Logger():
+# Log levels, gated once per subsystem by log_level()
+LOG_OFF, LOG_INFO, LOG_DEBUG = 0, 1, 2
+LOG_LEVEL_NAMES = {'off': LOG_OFF, 'info': LOG_INFO, 'debug': LOG_DEBUG}
+_log_levels = {}
+
+
+def log_level(subsystem):
+    '''
+    Return the cached log level of subsystem
+    With debug logging enabled, subsystems log everything, as before levels
+    existed, unless cfg_plugin_debug_log_levels lowers them, e.g. {"db": "info", "reader": "off"}
+    '''
+    try:
+        return _log_levels[subsystem]
+    except KeyError:
+        pass
+    from calibre_plugins.annotations.config import plugin_prefs
+    level = LOG_OFF
+    if plugin_prefs.get('cfg_plugin_debug_log_checkbox', False):
+        overrides = plugin_prefs.get('cfg_plugin_debug_log_levels', None) or {}
+        level = LOG_LEVEL_NAMES.get(overrides.get(subsystem), LOG_DEBUG)
+    _log_levels[subsystem] = level
+    return level
+
+
+def invalidate_log_levels():
+    '''
+    Re-read the log settings on next use
+    '''
+    _log_levels.clear()
+
+
+def log_message(msg, args):
+    '''
+    Apply deferred %-style args to msg
+    '''
+    if args:
+        return msg % args
+    return msg
+
+
+class Logger(object):
     LOCATION_TEMPLATE = "{cls}:{func}({arg1}) {arg2}"
-    def _log(self, msg=None):
+    LOG_SUBSYSTEM = 'plugin'
+
+    def _log(self, msg=None, *args):
         '''
-        Print msg to console
+        Print msg % args to console
         '''
-        from calibre_plugins.annotations.config import plugin_prefs
-        if not plugin_prefs.get('cfg_plugin_debug_log_checkbox', False):
+        if log_level(self.LOG_SUBSYSTEM) < LOG_INFO:
             return
 
         if msg:
-            debug_print(" %s" % str(msg))
+            debug_print(" %s" % str(log_message(msg, args)))
         else:
             debug_print()
 
+    def _log_debug(self, msg, *args):
+        '''
+        Print location, msg % args to console at LOG_DEBUG
+        For per-annotation traces, formatted only when the subsystem logs at LOG_DEBUG
+        '''
+        if log_level(self.LOG_SUBSYSTEM) < LOG_DEBUG:
+            return
+
+        debug_print(self.LOCATION_TEMPLATE.format(cls=self.__class__.__name__,
+                    func=sys._getframe(1).f_code.co_name,
+                    arg1='', arg2=log_message(msg, args)))
+
+    def _log_enabled(self, level=LOG_INFO):
+        '''
+        True if this subsystem logs at level, to guard costly log arguments
+        '''
+        return log_level(self.LOG_SUBSYSTEM) >= level
+
     def _log_location(self, *args):
         '''
         Print location, args to console
         '''
-        from calibre_plugins.annotations.config import plugin_prefs
-        if not plugin_prefs.get('cfg_plugin_debug_log_checkbox', False):
+        if log_level(self.LOG_SUBSYSTEM) < LOG_INFO:
             return
 
         arg1 = arg2 = ''
@@ -162,6 +222,7 @@ class AnnotationStruct(Struct):
         super(AnnotationStruct, self).__init__(
             annotation_id=None,
             book_id=None,
+            chash=None,
             epubcfi=None,
             genre=None,
             highlight_color=None,
@@ -193,6 +254,75 @@ class BookStruct(Struct):
             )
 
 
+class TimestampFormatter(Logger):
+    '''
+    Format unix timestamps as friendly local times, memoizing the results in
+    an LRU cache keyed on (timestamp, format). Formats are checked once before
+    use, unusable ones fall back to appearance.default_timestamp.
+    '''
+    MAX_ENTRIES = 10000
+
+    def __init__(self):
+        self.cache = OrderedDict()
+        self.checked_formats = {}
+        self.current_format = None
+
+    def format(self, timestamp, timestamp_format=None):
+        '''
+        timestamp_format defaults to the appearance_timestamp_format pref
+        '''
+        if timestamp_format is None:
+            timestamp_format = self.get_current_format()
+        key = (float(timestamp), timestamp_format)
+        try:
+            ans = self.cache.pop(key)
+        except KeyError:
+            ans = self._strftime(datetime.fromtimestamp(key[0]), self.check_format(timestamp_format))
+            if len(self.cache) >= self.MAX_ENTRIES:
+                self.cache.popitem(last=False)
+        self.cache[key] = ans
+        return ans
+
+    def check_format(self, timestamp_format):
+        '''
+        Return timestamp_format if strftime accepts it, else the default format
+        '''
+        if timestamp_format not in self.checked_formats:
+            from calibre_plugins.annotations.appearance import default_timestamp
+            checked = timestamp_format
+            try:
+                self._strftime(datetime(2013, 1, 1, 12, 34, 56), timestamp_format)
+            except Exception as e:
+                self._log_location("invalid timestamp format %s: %s" % (repr(timestamp_format), e))
+                checked = default_timestamp
+            self.checked_formats[timestamp_format] = checked
+        return self.checked_formats[timestamp_format]
+
+    def get_current_format(self):
+        if self.current_format is None:
+            from calibre_plugins.annotations.appearance import default_timestamp
+            from calibre_plugins.annotations.config import plugin_prefs
+            self.current_format = plugin_prefs.get('appearance_timestamp_format', default_timestamp)
+        return self.current_format
+
+    def invalidate(self):
+        '''
+        Called when the timestamp format pref changes
+        '''
+        self.cache.clear()
+        self.checked_formats.clear()
+        self.current_format = None
+
+    def _strftime(self, d, timestamp_format):
+        ans = d.strftime(timestamp_format)
+        if isinstance(ans, bytes):
+            ans = ans.decode(preferred_encoding, 'replace')
+        return ans
+
+
+timestamp_formatter = TimestampFormatter()
+
+
 class PlainTextEdit(QPlainTextEdit, Logger):
     """
     Subclass enabling drag 'n drop
@@ -733,16 +863,15 @@ class CompileUI(Logger):
 
 '''     Helper functions   '''
 
-def _log(msg=None):
+def _log(msg=None, *args):
     '''
-    Print msg to console
+    Print msg % args to console
     '''
-    from calibre_plugins.annotations.config import plugin_prefs
-    if not plugin_prefs.get('cfg_plugin_debug_log_checkbox', False):
+    if log_level('plugin') < LOG_INFO:
         return
 
     if msg:
-        debug_print(" %s" % str(msg))
+        debug_print(" %s" % str(log_message(msg, args)))
     else:
         debug_print()
 
@@ -750,8 +879,7 @@ def _log(msg=None):
 def _log_location(*args):
     LOCATION_TEMPLATE = "{cls}:{func}({arg1}) {arg2}"
 
-    from calibre_plugins.annotations.config import plugin_prefs
-    if not plugin_prefs.get('cfg_plugin_debug_log_checkbox', False):
+    if log_level('plugin') < LOG_INFO:
         return
 
     arg1 = arg2 = ''
@@ -770,7 +898,7 @@ def existing_annotations(parent, field, return_all=False):
     '''
     Return count of existing annotations, or existence of any
     '''
-    import calibre_plugins.annotations.config as cfg
+    from calibre_plugins.annotations.annotation_parser import has_user_annotations
     annotation_map = []
     if field:
         db = parent.opts.gui.current_db
@@ -778,13 +906,10 @@ def existing_annotations(parent, field, return_all=False):
         for i, record in enumerate(db.data.iterall()):
             mi = db.get_metadata(record[id], index_is_id=True)
             if field == 'Comments':
-                if mi.comments:
-                    soup = BeautifulSoup(mi.comments)
-                else:
-                    continue
+                value = mi.comments
             else:
-                soup = BeautifulSoup(mi.get_user_metadata(field, False)['#value#'])
-            if soup.find('div', 'user_annotations') is not None:
+                value = mi.get_user_metadata(field, False)['#value#']
+            if has_user_annotations(value):
                 annotation_map.append(mi.id)
                 if not return_all:
                     break
@@ -794,6 +919,16 @@ def existing_annotations(parent, field, return_all=False):
         return annotation_map
 
 
+def field_digest(value):
+    '''
+    Digest of a Comments or custom field value as written to the library,
+    None for an empty field
+    '''
+    if not value:
+        return None
+    return hashlib.md5(unicode(value).encode('utf-8')).hexdigest()
+
+
 def get_cc_mapping(cc_name, element, default=None):
     '''
     Return the element mapped to cc_name in prefs
@@ -957,7 +1092,8 @@ def move_annotations(parent, annotation_map, old_destination_field, new_destinat
     Move annotations from old_destination_field to new_destination_field
     annotation_map precalculated in thread in config.py
     '''
-    import calibre_plugins.annotations.config as cfg
+    from calibre_plugins.annotations.annotations import comments_divider
+    from calibre_plugins.annotations.parallel_render import RenderPool, move_task
 
     _log_location("%s -> %s" % (old_destination_field, new_destination_field))
 
@@ -974,158 +1110,41 @@ def move_annotations(parent, annotation_map, old_destination_field, new_destinat
 
     id_map_old_destination_field = {}
     id_map_new_destination_field = {}
-    transient_db = 'transient'
 
     # Prepare a new COMMENTS_DIVIDER
-    comments_divider = '<div class="comments_divider"><p style="text-align:center;margin:1em 0 1em 0">{0}</p></div>'.format(
-        cfg.plugin_prefs.get('COMMENTS_DIVIDER', '&middot;  &middot;  &bull;  &middot;  &#x2726;  &middot;  &bull;  &middot; &middot;'))
-
-    for cid in annotation_map:
-        mi = library_db.get_metadata(cid, index_is_id=True)
-
-        # Comments -> custom
-        if old_destination_field == 'Comments' and new_destination_field.startswith('#'):
-            if mi.comments:
-                old_soup = BeautifulSoup(mi.comments)
-                uas = old_soup.find('div', 'user_annotations')
-                if uas:
-                    # Remove user_annotations from Comments
-                    uas.extract()
-
-                    # Remove comments_divider from Comments
-                    cd = old_soup.find('div', 'comments_divider')
-                    if cd:
-                        cd.extract()
-
-                    # Capture content
-                    annotation_list = parent.opts.db.capture_content(uas, cid, transient_db)
-
-                    # Regurgitate content with current CSS style
-                    new_soup = parent.opts.db.rerender_to_html_from_list(annotation_list)
-
-                    id_map_old_destination_field[cid] = unicode(old_soup)
-                    id_map_new_destination_field[cid] = unicode(new_soup)
-
-                    pb.increment()
-
-        # custom -> Comments
-        elif old_destination_field.startswith('#') and new_destination_field == 'Comments':
-            if mi.get_user_metadata(old_destination_field, False)['#value#'] is not None:
-                old_soup = BeautifulSoup(mi.get_user_metadata(old_destination_field, False)['#value#'])
-                uas = old_soup.find('div', 'user_annotations')
-                if uas:
-                    # Remove user_annotations from custom field
-                    uas.extract()
-
-                    # Capture content
-                    annotation_list = parent.opts.db.capture_content(uas, cid, transient_db)
-
-                    # Regurgitate content with current CSS style
-                    new_soup = parent.opts.db.rerender_to_html_from_list(annotation_list)
-
-                    # Add user_annotations to Comments
-                    new_comments = ''
-                    if mi.comments is None:
-                        new_comments = unicode(new_soup)
-                    else:
-                        new_comments = mi.comments + \
-                                      unicode(comments_divider) + \
-                                      unicode(new_soup)
-
-#                     # Update the record with stripped custom field, updated Comments
-#                     library_db.set_metadata(cid, mi, set_title=False, set_authors=False,
-#                                     commit=True, force_changes=True, notify=True)
-                    id_map_old_destination_field[cid] = unicode(old_soup)
-                    id_map_new_destination_field[cid] = new_comments
-                    pb.increment()
-
-        # custom -> custom
-        elif old_destination_field.startswith('#') and new_destination_field.startswith('#'):
-
-            if mi.get_user_metadata(old_destination_field, False)['#value#'] is not None:
-                old_soup = BeautifulSoup(mi.get_user_metadata(old_destination_field, False)['#value#'])
-                uas = old_soup.find('div', 'user_annotations')
-                if uas:
-                    # Remove user_annotations from originating custom field
-                    uas.extract()
-
-                    # Capture content
-                    annotation_list = parent.opts.db.capture_content(uas, cid, transient_db)
-
-                    # Regurgitate content with current CSS style
-                    new_soup = parent.opts.db.rerender_to_html_from_list(annotation_list)
-
-                    id_map_old_destination_field[cid] = unicode(old_soup)
-                    id_map_new_destination_field[cid] = unicode(new_soup)
-                    pb.increment()
+    divider = comments_divider()
 
+    if old_destination_field == new_destination_field:
         # same field -> same field - called from config:configure_appearance()
-        elif (old_destination_field == new_destination_field):
-            pb.set_label('{:^100}'.format(_('Updating annotations for {0} books').format(total_books)))
-
-            if new_destination_field == 'Comments':
-                if mi.comments:
-                    old_soup = BeautifulSoup(mi.comments)
-                    uas = old_soup.find('div', 'user_annotations')
-                    if uas:
-                        # Remove user_annotations from Comments
-                        uas.extract()
-
-                        # Remove comments_divider from Comments
-                        cd = old_soup.find('div', 'comments_divider')
-                        if cd:
-                            cd.extract()
-
-                        # Save stripped Comments
-                        mi.comments = unicode(old_soup)
-
-                        # Capture content
-                        annotation_list = parent.opts.db.capture_content(uas, cid, transient_db)
-
-                        # Regurgitate content with current CSS style
-                        new_soup = parent.opts.db.rerender_to_html_from_list(annotation_list)
-
-                        # Add user_annotations to Comments
-                        new_comments = ''
-                        if mi.comments is None:
-                            new_comments = unicode(new_soup)
-                        else:
-                            new_comments = mi.comments + \
-                                          unicode(comments_divider) + \
-                                          unicode(new_soup)
-
-                        # Update the record with stripped custom field, updated Comments
-#                         library_db.set_metadata(cid, mi, set_title=False, set_authors=False,
-#                                         commit=True, force_changes=True, notify=True)
-                        id_map_old_destination_field[cid] = unicode(old_soup)
-                        id_map_new_destination_field[cid] = unicode(new_soup)
-                        pb.increment()
+        pb.set_label('{:^100}'.format(_('Updating annotations for {0} books').format(total_books)))
 
-            else:
-                # Update custom field
-                old_soup = BeautifulSoup(mi.get_user_metadata(old_destination_field, False)['#value#'])
-                uas = old_soup.find('div', 'user_annotations')
-                if uas:
-                    # Remove user_annotations from originating custom field
-                    uas.extract()
-
-                    # Capture content
-                    annotation_list = parent.opts.db.capture_content(uas, cid, transient_db)
-
-                    # Regurgitate content with current CSS style
-                    new_soup = parent.opts.db.rerender_to_html_from_list(annotation_list)
-
-#                     # Add stripped old_soup plus new_soup to destination field
-#                     um = mi.metadata_for_field(new_destination_field)
-#                     um['#value#'] = unicode(old_soup) + unicode(new_soup)
-#                     mi.set_user_metadata(new_destination_field, um)
-# 
-#                     # Update the record
-#                     library_db.set_metadata(cid, mi, set_title=False, set_authors=False,
-#                                     commit=True, force_changes=True, notify=True)
-                    id_map_old_destination_field[cid] = unicode(old_soup)
-                    id_map_new_destination_field[cid] = unicode(new_soup)
-                    pb.increment()
+    # Gather each book's fields, then capture and re-render them, in worker processes for many books
+    tasks = []
+    for cid in annotation_map:
+        mi = library_db.get_metadata(cid, index_is_id=True)
+        old_value = None
+        if old_destination_field.startswith('#'):
+            old_value = mi.get_user_metadata(old_destination_field, False)['#value#']
+        stored = parent.opts.db.get_library_annotations(
+            library_db.library_id, cid, old_destination_field,
+            mi.comments if old_destination_field == 'Comments' else old_value)
+        tasks.append(move_task(cid, old_destination_field, new_destination_field,
+                               mi.comments, old_value, divider, stored))
+
+    for result in RenderPool(parent.opts.db).run(tasks, progress=pb.increment):
+        if result is None:
+            continue
+        cid = result['cid']
+        comments = result['comments']
+        if comments is None and new_destination_field.startswith('#'):
+            # A custom field holds nothing but the annotations
+            comments = unicode(BeautifulSoup(''))
+        parent.opts.db.index_library_annotations(library_db.library_id, cid,
+                                                 result['annotations'], new_destination_field,
+                                                 result['new_value'], comments)
+        if result['old_value'] is not None:
+            id_map_old_destination_field[cid] = result['old_value']
+        id_map_new_destination_field[cid] = result['new_value']
 
     if len(id_map_old_destination_field) > 0:
         debug_print("move_annotations - Updating metadata - for column: %s number of changes=%d" % (old_destination_field, len(id_map_old_destination_field)))
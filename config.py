@@ -33,7 +33,6 @@ except ImportError as e:
         QRect, QThread, QTimer, QToolButton, QVBoxLayout, QWidget,
         pyqtSignal)
 
-from calibre.ebooks.BeautifulSoup import BeautifulSoup
 from calibre.gui2.dialogs.message_box import MessageBox
 from calibre.constants import islinux, iswindows
 from calibre.devices.usbms.driver import debug_print
@@ -41,10 +40,12 @@ from calibre.utils.config import JSONConfig, config_dir
 from calibre.utils.logging import Log
 
 from calibre_plugins.annotations.action import LIBIMOBILEDEVICE_AVAILABLE
+from calibre_plugins.annotations.annotation_parser import date_range, parse_annotations
 from calibre_plugins.annotations.appearance import AnnotationsAppearance
 from calibre_plugins.annotations.common_utils import (Logger, Struct,
-    existing_annotations, get_cc_mapping, get_icon, inventory_controls,
-    move_annotations, restore_state, save_state, set_cc_mapping)
+    existing_annotations, field_digest, get_cc_mapping, get_icon, inventory_controls,
+    invalidate_log_levels, move_annotations, restore_state, save_state,
+    set_cc_mapping)
 
 try:
     debug_print("Annotations::config.py - loading translations")
@@ -95,6 +96,13 @@ class ConfigWidget(QWidget, Logger):
         self.cfg_disable_caching_checkbox.setChecked(False)
         self.cfg_runtime_options_qvl.addWidget(self.cfg_disable_caching_checkbox)
 
+        # ~~~~~~~~ Delta sync checkbox ~~~~~~~~
+        self.cfg_delta_sync_checkbox = QCheckBox(_('Only fetch changed annotations from Kindle and Kobo devices'))
+        self.cfg_delta_sync_checkbox.setObjectName('cfg_delta_sync_checkbox')
+        self.cfg_delta_sync_checkbox.setToolTip(_('Update the cached annotations incrementally instead of rebuilding them on every fetch'))
+        self.cfg_delta_sync_checkbox.setChecked(False)
+        self.cfg_runtime_options_qvl.addWidget(self.cfg_delta_sync_checkbox)
+
         # ~~~~~~~~ plugin logging checkbox ~~~~~~~~
         self.cfg_plugin_debug_log_checkbox = QCheckBox(_('Enable debug logging for Annotations plugin'))
         self.cfg_plugin_debug_log_checkbox.setObjectName('cfg_plugin_debug_log_checkbox')
@@ -205,6 +213,7 @@ class ConfigWidget(QWidget, Logger):
 
         # Hook changes to diagnostic checkboxes
         self.cfg_disable_caching_checkbox.stateChanged.connect(self.restart_required)
+        self.cfg_delta_sync_checkbox.stateChanged.connect(self.restart_required)
         self.cfg_libimobiledevice_debug_log_checkbox.stateChanged.connect(self.restart_required)
         self.cfg_plugin_debug_log_checkbox.stateChanged.connect(self.restart_required)
 
@@ -215,7 +224,7 @@ class ConfigWidget(QWidget, Logger):
 
         # Launch the annotated_books_scanner
         field = get_cc_mapping('annotations', 'field', 'Comments')
-        self.annotated_books_scanner = InventoryAnnotatedBooks(self.gui, field)
+        self.annotated_books_scanner = InventoryAnnotatedBooks(self.gui, field, db=self.opts.db)
         self.annotated_books_scanner.signal.connect(self.inventory_complete)
 #        self.connect(self.annotated_books_scanner, self.annotated_books_scanner.signal,
 #            self.inventory_complete)
@@ -310,6 +319,8 @@ class ConfigWidget(QWidget, Logger):
     def configure_appearance(self):
         '''
         '''
+        from calibre_plugins.annotations.annotations import invalidate_compiled_style
+        from calibre_plugins.annotations.common_utils import timestamp_formatter
         from calibre_plugins.annotations.appearance import default_elements
         from calibre_plugins.annotations.appearance import default_timestamp
         appearance_settings = {
@@ -339,6 +350,8 @@ class ConfigWidget(QWidget, Logger):
             for setting in appearance_settings:
                 plugin_prefs.set(setting, original_settings[setting])
             nsh = osh
+        invalidate_compiled_style()
+        timestamp_formatter.invalidate()
 
         # If there were changes, and there are existing annotations, offer to re-render
         field = get_cc_mapping('annotations', 'field', None)
@@ -491,6 +504,7 @@ class ConfigWidget(QWidget, Logger):
 
     def save_settings(self):
         save_state(self)
+        invalidate_log_levels()
 
         # Save the annotation destination field
         ann_dest = unicode(self.cfg_annotations_destination_comboBox.currentText())
@@ -508,7 +522,7 @@ class InventoryAnnotatedBooks(QThread, Logger):
 
     signal = pyqtSignal(object)
 
-    def __init__(self, gui, field, get_date_range=False):
+    def __init__(self, gui, field, get_date_range=False, db=None):
         QThread.__init__(self, gui)
         self.annotation_map = []
         self.cdb = gui.current_db
@@ -517,6 +531,15 @@ class InventoryAnnotatedBooks(QThread, Logger):
         self.oldest_annotation = mktime(datetime.today().timetuple())
         self.field = field
 
+        # Snapshot the stored annotations here, the connection belongs to this thread.
+        # Books whose field still has its recorded digest need not be parsed.
+        self.digests = {}
+        if db is not None and field:
+            self.digests = db.get_library_digests(self.cdb.library_id, field)
+
+        # (oldest, newest) annotation timestamp of each annotated book
+        self.date_ranges = {}
+
     def run(self):
         self.find_all_annotated_books()
         if self.get_date_range:
@@ -540,42 +563,39 @@ class InventoryAnnotatedBooks(QThread, Logger):
         for record in self.cdb.data.iterall():
             mi = self.cdb.get_metadata(record[id], index_is_id=True)
             if self.field == 'Comments':
-                if mi.comments:
-                    soup = BeautifulSoup(mi.comments)
-                else:
+                value = mi.comments
+                if not value:
                     continue
             else:
-                soup = BeautifulSoup(mi.get_user_metadata(self.field, False)['#value#'])
+                value = mi.get_user_metadata(self.field, False)['#value#']
+
+            stored = self.digests.get(mi.id)
+            if stored is not None and stored[0] == field_digest(value):
+                if stored[1]:
+                    self.annotation_map.append(mi.id)
+                    self.date_ranges[mi.id] = stored[2:]
+                continue
 
-            if soup.find('div', 'user_annotations') is not None:
+            parsed = parse_annotations(value, mi.id)
+            if parsed.user_annotations:
                 self.annotation_map.append(mi.id)
+                self.date_ranges[mi.id] = date_range(parsed.annotations) or (None, None)
 
     def get_annotations_date_range(self):
         '''
-        Find oldest, newest annotation in annotated books
+        Find oldest, newest annotation in annotated books, from the ranges
+        gathered by find_all_annotated_books()
         initial values of self.oldest, self.newest are reversed to allow update comparisons
         if no annotations, restore to correct values
         '''
         annotations_found = False
 
         for cid in self.annotation_map:
-            mi = self.cdb.get_metadata(cid, index_is_id=True)
-            if self.field == 'Comments':
-                soup = BeautifulSoup(mi.comments)
-            else:
-                soup = BeautifulSoup(mi.get_user_metadata(self.field, False)['#value#'])
-
-            uas = soup.findAll('div', 'annotation')
-            for ua in uas:
-                try:
-                    timestamp = float(ua.find('td', 'timestamp')['uts'])
-                    if timestamp < self.oldest_annotation:
-                        self.oldest_annotation = timestamp
-                    if timestamp > self.newest_annotation:
-                        self.newest_annotation = timestamp
-                    annotations_found = True
-                except:
-                    continue
+            oldest, newest = self.date_ranges[cid]
+            if oldest is not None:
+                self.oldest_annotation = min(self.oldest_annotation, oldest)
+                self.newest_annotation = max(self.newest_annotation, newest)
+                annotations_found = True
 
         if not annotations_found:
             temp = self.newest_annotation
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+'''
+Compare reading the annotations of every annotated book with BeautifulSoup
+and AnnotationsDB.capture_content() against annotation_parser.parse_annotations(),
+checking that both return the same records.
+Run with the plugin installed, on the current calibre library or the one at
+library_path:
+    calibre-debug -e dev/benchmark_parser.py [library_path] [field]
+'''
+
+import sys, time
+
+from calibre.customize.ui import initialize_plugins
+initialize_plugins()
+
+from calibre.ebooks.BeautifulSoup import BeautifulSoup
+from calibre_plugins.annotations.annotation_parser import USER_ANNOTATIONS, parse_annotations
+from calibre_plugins.annotations.annotations_db import AnnotationsDB
+
+
+class Opts(object):
+    verbose = False
+
+
+def library_values(library_path=None, field='Comments'):
+    '''
+    Return the content of field for every book of the calibre library at library_path
+    '''
+    from calibre.library import db as library_db
+    from calibre.utils.config import prefs
+    cdb = library_db(library_path or prefs['library_path']).new_api
+    key = 'comments' if field == 'Comments' else field
+    return [cdb.field_for(key, book_id) for book_id in cdb.all_book_ids()]
+
+
+def benchmark_parser(values):
+    values = [value for value in values if value and USER_ANNOTATIONS in value]
+    db = AnnotationsDB(Opts(), None)
+
+    def soup_records(value, cid):
+        uas = BeautifulSoup(value).find('div', 'user_annotations')
+        return db.capture_content(uas, cid) if uas else []
+
+    def parser_records(value, cid):
+        return parse_annotations(value, cid).annotations
+
+    results = {}
+    for label, records in (('soup', soup_records), ('lxml', parser_records)):
+        start = time.time()
+        results[label] = [records(value, cid) for cid, value in enumerate(values)]
+        elapsed = time.time() - start
+        count = sum(len(annotations) for annotations in results[label])
+        print("%-5s %d books, %d annotations in %.3fs, %.2f ms/book" % (
+              label, len(values), count, elapsed, elapsed * 1e3 / max(len(values), 1)))
+    mismatched = [cid for cid, annotations in enumerate(results['soup'])
+                  if [dict(ann) for ann in annotations] !=
+                     [dict(ann) for ann in results['lxml'][cid]]]
+    print("records differ for %d books" % len(mismatched))
+    return len(mismatched)
+
+
+if __name__ == '__main__':
+    sys.exit(1 if benchmark_parser(library_values(*sys.argv[1:])) else 0)
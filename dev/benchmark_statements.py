@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+'''
+Compare per-call latency of str.format()-built lookups against the
+AnnotationsDB statement registry on a scratch database.
+Run with the plugin installed:
+    calibre-debug -e dev/benchmark_statements.py [lookups] [books]
+'''
+
+import os, shutil, sys, tempfile, time
+
+from calibre.customize.ui import initialize_plugins
+initialize_plugins()
+
+from calibre_plugins.annotations.annotations_db import AnnotationsDB
+from calibre_plugins.annotations.common_utils import BookStruct
+
+
+class Opts(object):
+    verbose = False
+
+
+def benchmark_statements(lookups=50000, books=500):
+    tdir = tempfile.mkdtemp()
+    db = AnnotationsDB(Opts(), os.path.join(tdir, 'benchmark.db'))
+    db.connect()
+    books_db = 'benchmark_books'
+    db.create_books_table(books_db)
+    records = []
+    for i in range(books):
+        book = BookStruct()
+        book.active = True
+        book.author = book.author_sort = 'Author %d' % i
+        book.book_id = 'book-%d' % i
+        book.genre = 'Genre'
+        book.path = None
+        book.title = book.title_sort = 'Title %d' % i
+        book.uuid = None
+        records.append(book)
+    db.add_to_books_db_bulk(books_db, records)
+
+    def formatted(book_id):
+        return db.conn.execute("""SELECT title
+                                  FROM {0}
+                                  WHERE book_id = '{1}'""".format(books_db, book_id)).fetchall()
+
+    def registered(book_id):
+        return db.conn.execute(db._statement('title', books_db), (book_id,)).fetchall()
+
+    for label, lookup in (('str.format', formatted), ('registry', registered)):
+        start = time.time()
+        for i in range(lookups):
+            lookup('book-%d' % (i % books))
+        elapsed = time.time() - start
+        print("%-10s %d lookups in %.3fs, %.2f us/call" % (label, lookups, elapsed,
+                                                           elapsed * 1e6 / lookups))
+    db.close()
+    shutil.rmtree(tdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    benchmark_statements(*[int(arg) for arg in sys.argv[1:]])
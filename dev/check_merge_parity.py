@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+'''
+Check that merge_annotations() returns the same HTML as the merge it replaced,
+which found every annotation node by walking the trees. The reference below is
+that merge as it stood before the divs were indexed, kept frozen: do not
+update it along with merge_annotations().
+Run with the plugin installed:
+    calibre-debug -e dev/check_merge_parity.py [cases]
+'''
+
+import random, sys, time
+
+from calibre.customize.ui import initialize_plugins
+initialize_plugins()
+
+# calibre Python 3 compatibility.
+from six import text_type as unicode
+
+from calibre.ebooks.BeautifulSoup import BeautifulSoup
+from calibre_plugins.annotations.annotations import (ANNOTATIONS_HEADER, Annotation,
+    Annotations, div_content_hash, location_sort_key, merge_annotations, write_pieces)
+from calibre_plugins.annotations.annotations_db import AnnotationsDB
+from calibre_plugins.annotations.common_utils import Struct
+from calibre_plugins.annotations.config import plugin_prefs
+
+
+def baseline_merge_annotations(parent, cid, old_soup, new_soup, out=None):
+    '''
+    old_soup, new_soup: BeautifulSoup()
+    Need to strip <hr>, re-sort based on location, build new merged_soup
+    with optional interleaved <hr> elements.
+    out: optional file-like the merged HTML is written to, piece by piece,
+    instead of being returned
+    '''
+
+    # Fetch preferred merge index technique
+    merge_index = getattr(parent.reader_app_class, 'MERGE_INDEX', 'hash')
+
+    if merge_index == 'hash':
+        # Get the hashes of any existing annotations
+        oiuas = old_soup.findAll('div', 'annotation')
+        old_hashes = set([ua['hash'] for ua in oiuas])
+
+        # Content hashes bridge legacy hashes, which change with the appearance CSS
+        old_chashes = set([div_content_hash(ua) for ua in oiuas])
+
+        # Extract old user_annotations
+        ouas = old_soup.find('div', 'user_annotations')
+        if ouas:
+            ouas.extract()
+
+            # Capture existing annotations
+            annotation_list = parent.opts.db.capture_content(ouas, cid)
+
+            # Regurgitate old_soup with current CSS
+            regurgitated_soup = BeautifulSoup(parent.opts.db.rerender_to_html_from_list(annotation_list))
+        else:
+            regurgitated_soup = BeautifulSoup()
+
+        # Find new annotations
+        uas = new_soup.findAll('div', 'annotation')
+        new_hashes = set([ua['hash'] for ua in uas])
+
+        # Legacy hashes omit location and timestamp, and collide for equal text,
+        # so match on content and keep the new divs rather than finding them by hash
+        updates = []
+        for ua in uas:
+            chash = div_content_hash(ua)
+            if chash not in old_chashes:
+                old_chashes.add(chash)
+                updates.append(ua)
+        if ouas is not None:
+            if len(updates):
+                # Append new to regurgitated
+                dtc = len(regurgitated_soup.div)
+                for new_annotation in updates:
+                    regurgitated_soup.div.insert(dtc, new_annotation)
+                    dtc += 1
+            merged = [unicode(baseline_sort_merged_annotations(regurgitated_soup))]
+        else:
+            if not regurgitated_soup == BeautifulSoup():
+                merged = [unicode(regurgitated_soup), unicode(new_soup)]
+            else:
+                merged = [unicode(new_soup)]
+        return write_pieces(merged, out)
+
+    elif merge_index == 'timestamp':
+        timestamps = {}
+        # Get the timestamps and hashes of the stored annotations
+        suas = old_soup.findAll('div', 'annotation')
+        for sua in suas:
+            try:
+                timestamp = sua.find('td', 'timestamp')['uts']
+                timestamps[timestamp] = {'stored_hash': sua['hash']}
+            except:
+                continue
+
+        # Rerender stored annotations
+        ouas = old_soup.find('div', 'user_annotations')
+        if ouas:
+            ouas.extract()
+
+            # Capture existing annotations
+            annotation_list = parent.opts.db.capture_content(ouas, cid)
+
+            # Regurgitate old_soup with current CSS
+            regurgitated_soup = BeautifulSoup(parent.opts.db.rerender_to_html_from_list(annotation_list))
+
+        # Add device annotation timestamps and hashes
+        duas = new_soup.findAll('div', 'annotation')
+        for dua in duas:
+            try:
+                timestamp = dua.find('td', 'timestamp')['uts']
+                if timestamp in timestamps:
+                    timestamps[timestamp]['device_hash'] = dua['hash']
+                else:
+                    timestamps[timestamp] = {'device_hash': dua['hash']}
+            except:
+                print("ERROR: malformed timestamp in device annotation")
+                print(dua.prettify())
+
+        merged_soup = BeautifulSoup(ANNOTATIONS_HEADER)
+
+        for ts in sorted(timestamps):
+            if 'stored_hash' in timestamps[ts] and not 'device_hash' in timestamps[ts]:
+                # Stored only - add from regurgitated_soup
+                annotation = regurgitated_soup.find('div', {'hash': timestamps[ts]['stored_hash']})
+
+            elif not 'stored_hash' in timestamps[ts] and 'device_hash' in timestamps[ts]:
+                # Device only - add from new_soup
+                annotation = new_soup.find('div', {'hash': timestamps[ts]['device_hash']})
+
+            elif timestamps[ts]['stored_hash'] == timestamps[ts]['device_hash']:
+                # Stored matches device - add from regurgitated_soup, as user may have modified
+                annotation = regurgitated_soup.find('div', {'hash': timestamps[ts]['stored_hash']})
+
+            elif timestamps[ts]['stored_hash'] != timestamps[ts]['device_hash']:
+                # Device has been updated since initial capture - add from new_soup
+                annotation = new_soup.find('div', {'hash': timestamps[ts]['device_hash']})
+
+            else:
+                continue
+
+            merged_soup.div.append(annotation)
+
+        return write_pieces([unicode(baseline_sort_merged_annotations(merged_soup))], out)
+
+
+def baseline_sort_merged_annotations(merged_soup):
+    '''
+    Input: a combined group of user annotations
+    Output: sorted by location
+    '''
+    include_hr = plugin_prefs.get('appearance_hr_checkbox', False)
+    locations = merged_soup.findAll(location_sort=True)
+    locs = [loc['location_sort'] for loc in locations]
+    locs.sort(key=location_sort_key)
+
+    sorted_soup = BeautifulSoup(ANNOTATIONS_HEADER)
+    dtc = 0
+    for i, loc in enumerate(locs):
+        next_div = merged_soup.find(attrs={'location_sort': loc})
+        sorted_soup.div.insert(dtc, next_div)
+        dtc += 1
+        if include_hr and i < len(locs) - 1:
+            sorted_soup.div.insert(dtc, BeautifulSoup(plugin_prefs.get('HORIZONTAL_RULE', '<hr width="80%" />')))
+            dtc += 1
+
+    return sorted_soup
+
+
+class Opts(object):
+    verbose = False
+
+
+def generated_html(rnd, count, stored):
+    '''
+    Annotations HTML of count annotations drawn from a small pool, so that
+    stored and device annotations overlap and repeat.
+    Each annotation of the pool has one text, note, location, timestamp and
+    legacy hash, as a device reports them, and its own location_sort. Only
+    the highlight color varies between copies. A content hash is missing
+    from about a third of the stored sets, as before content hashes existed.
+    '''
+    annotations = []
+    for i in range(count):
+        j, k = rnd.randint(0, 12), rnd.randint(0, 2)
+        annotations.append(Annotation({
+            'genre': 'Generated',
+            'hash': 'legacy %d %d' % (j, k),
+            'highlightcolor': rnd.choice(['Blue', 'Yellow']),
+            'location': 'Location %d' % j,
+            'location_sort': '%05d' % (j * 10 + k),
+            'note': ['Note %d' % j] if k else None,
+            'reader_app': 'Generated',
+            'text': ['Text %d %d' % (j, k)],
+            'timestamp': 1600000000 + j * 10 + k}))
+    soup = BeautifulSoup(Annotations(None).to_HTML(annotations=annotations))
+    if stored and rnd.random() < 0.3:
+        for div in soup.findAll('div', 'annotation'):
+            del div['chash']
+    return unicode(soup)
+
+
+def check_merge_parity(cases=100):
+    '''
+    Merge cases generated from fixed seeds with merge_annotations() and with
+    baseline_merge_annotations(), in both MERGE_INDEX modes, and report the
+    seeds whose merged HTML differs
+    Return the number of differing cases
+    '''
+    db = AnnotationsDB(Opts(), None)
+    differing = 0
+    for merge_index in ('hash', 'timestamp'):
+        parent = Struct(opts=Struct(db=db), reader_app_class=Struct(MERGE_INDEX=merge_index))
+        mismatched = []
+        elapsed = {'index': 0.0, 'baseline': 0.0}
+        for seed in range(cases):
+            rnd = random.Random(seed)
+            # The baseline timestamp merge needs stored annotations
+            old_html = generated_html(rnd, rnd.randint(1, 25), True)
+            new_html = generated_html(rnd, rnd.randint(1, 25), False)
+            results = {}
+            for label, merge in (('index', merge_annotations), ('baseline', baseline_merge_annotations)):
+                old_soup, new_soup = BeautifulSoup(old_html), BeautifulSoup(new_html)
+                start = time.time()
+                results[label] = unicode(merge(parent, seed, old_soup, new_soup))
+                elapsed[label] += time.time() - start
+            if results['index'] != results['baseline']:
+                mismatched.append(seed)
+        print("%-9s %d cases, index %.3fs, baseline %.3fs, %d differ %s" % (
+              merge_index, cases, elapsed['index'], elapsed['baseline'], len(mismatched), mismatched[:10]))
+        differing += len(mismatched)
+    return differing
+
+
+if __name__ == '__main__':
+    sys.exit(1 if check_merge_parity(*[int(arg) for arg in sys.argv[1:]]) else 0)
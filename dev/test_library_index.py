@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+'''
+Tests of the library annotations index behind Find annotations.
+Run with the plugin installed:
+    calibre-debug -e dev/test_library_index.py
+'''
+
+import os, shutil, tempfile, unittest
+
+from calibre.customize.ui import initialize_plugins
+initialize_plugins()
+
+from calibre_plugins.annotations.annotations import Annotation, Annotations
+from calibre_plugins.annotations.annotations_db import AnnotationsDB
+
+
+class Opts(object):
+    verbose = False
+
+
+def rendered(*texts):
+    '''
+    Annotations HTML of one highlight per text
+    '''
+    return Annotations(None).to_HTML(annotations=[Annotation({
+        'genre': 'Test',
+        'highlightcolor': 'Yellow',
+        'location': 'Location %d' % i,
+        'location_sort': '%05d' % i,
+        'reader_app': 'Test',
+        'text': [text],
+        'timestamp': 1600000000 + i}) for i, text in enumerate(texts)])
+
+
+class LibraryIndexTest(unittest.TestCase):
+
+    LIBRARY_ID = 'test-library'
+    FIELD = '#annotations'
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db = AnnotationsDB(Opts(), os.path.join(self.tmp, 'annotations.db'))
+        self.db.connect()
+        if self.db.fts_tokenizer != 'trigram':
+            self.skipTest('sqlite has no FTS5 trigram tokenizer')
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmp)
+
+    def candidates(self, values, text):
+        # As FindAnnotationsDialog.update_results() narrows the books to scan
+        fts_cids = self.db.get_fts_cids(self.LIBRARY_ID, text)
+        unverified = self.db.get_unverified_cids(self.LIBRARY_ID, self.FIELD, values)
+        return set(cid for cid in values if cid in fts_cids or cid in unverified)
+
+    def test_edited_field_is_scanned(self):
+        values = {1: rendered('an indexed highlight'), 2: rendered('another book')}
+        for cid, value in values.items():
+            self.db.index_library_html(self.LIBRARY_ID, cid, value, self.FIELD)
+        self.assertEqual(self.candidates(values, 'indexed'), set([1]))
+
+        # Edited in calibre after it was indexed
+        values[2] = rendered('another book', 'text typed by hand')
+        self.assertEqual(self.candidates(values, 'typed by hand'), set([2]))
+        self.assertEqual(self.candidates(values, 'indexed'), set([1, 2]))
+
+        # Found in the index once re-indexed
+        self.db.index_library_html(self.LIBRARY_ID, 2, values[2], self.FIELD)
+        self.assertEqual(self.db.get_fts_cids(self.LIBRARY_ID, 'typed by hand'), set([2]))
+        self.assertEqual(self.candidates(values, 'typed by hand'), set([2]))
+        self.assertEqual(self.candidates(values, 'indexed'), set([1]))
+
+    def test_unindexed_field_is_scanned(self):
+        values = {1: rendered('an indexed highlight'), 2: rendered('never indexed')}
+        self.db.index_library_html(self.LIBRARY_ID, 1, values[1], self.FIELD)
+        self.assertEqual(self.candidates(values, 'never indexed'), set([2]))
+
+
+if __name__ == '__main__':
+    unittest.main()
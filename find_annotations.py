@@ -15,7 +15,6 @@ from dateutil.tz import tzlocal, tzutc
 from functools import partial
 from time import mktime
 
-from calibre.ebooks.BeautifulSoup import BeautifulSoup
 from calibre.gui2.metadata.basic_widgets import DateEdit
 
 try:
@@ -49,6 +48,9 @@ except NameError:
 utc_tz = tzutc()
 EPOCH = datetime(1969,12,31, tzinfo=tzlocal())
 
+# Text queries containing these are regular expressions, not literals
+REGEX_METACHARACTERS = re.compile(r'[\\.^$*+?{}\[\]|()]')
+
 class MyDateEdit(DateEdit):
     TOOLTIP = ''
     LABEL = '&Date:'
@@ -259,7 +261,8 @@ class FindAnnotationsDialog(SizePersistedDialog, Logger):
         # ~~~~~~~~ Allow dialog to render before doing inventory ~~~~~~~~
         #field = self.prefs.get('cfg_annotations_destination_field', None)
         field = get_cc_mapping('annotations', 'field', None)
-        self.annotated_books_scanner = InventoryAnnotatedBooks(self.opts.gui, field, get_date_range=True)
+        self.annotated_books_scanner = InventoryAnnotatedBooks(self.opts.gui, field, get_date_range=True,
+                                                               db=self.opts.db)
         self.annotated_books_scanner.signal.connect(self.inventory_available)
         QTimer.singleShot(1, self.start_inventory_scan)
 
@@ -379,65 +382,68 @@ class FindAnnotationsDialog(SizePersistedDialog, Logger):
         matched_titles = []
         self.matched_ids = set()
 
-        for cid in annotation_map:
+        # Narrow the books to scan with the full-text index when the text
+        # queries are literals it can answer. The index is trusted only for books
+        # whose field is unchanged since it was indexed, the others are still
+        # scanned, and re-indexed below.
+        candidates = annotation_map
+        if not (REGEX_METACHARACTERS.search(text_to_match) or
+                REGEX_METACHARACTERS.search(note_to_match)):
+            fts_cids = self.opts.db.get_fts_cids(db.library_id, text_to_match, note_to_match)
+            if fts_cids is not None:
+                values = db.new_api.all_field_for('comments' if field == 'Comments' else field.lower(),
+                                                  annotation_map)
+                unverified = self.opts.db.get_unverified_cids(db.library_id, field, values)
+                candidates = [cid for cid in annotation_map
+                              if cid in fts_cids or cid in unverified]
+
+        for cid in candidates:
             mi = db.get_metadata(cid, index_is_id=True)
-            soup = None
             if field == 'Comments':
-                if mi.comments:
-                    soup = BeautifulSoup(mi.comments)
+                value = mi.comments
             else:
-                if mi.get_user_metadata(field, False)['#value#'] is not None:
-                    soup = BeautifulSoup(mi.get_user_metadata(field, False)['#value#'])
-            if soup:
-                uas = soup.findAll('div', 'annotation')
-                for ua in uas:
-                    # Are we already logged?
-                    if cid in self.matched_ids:
+                value = mi.get_user_metadata(field, False)['#value#']
+
+            # Match on the stored annotations, re-indexing books edited since written
+            stored = self.opts.db.get_library_annotations(db.library_id, cid, field, value)
+            if stored is None:
+                self.opts.db.index_library_html(db.library_id, cid, value, field)
+                stored = self.opts.db.get_library_annotations(db.library_id, cid, field, value)
+                if stored is None:
+                    # Empty user_annotations, nothing indexed and nothing to match
+                    continue
+
+            for ann in stored['annotations']:
+                # Check reader
+                if reader_to_match != self.GENERIC_READER:
+                    if ann['reader'] != reader_to_match:
+                        continue
+
+                # Check color
+                if color_to_match != self.GENERIC_STYLE:
+                    if ann['highlight_color'] != color_to_match:
+                        continue
+
+                # Check date range, allow for mangled timestamp
+                try:
+                    timestamp = float(ann['last_modification'])
+                    if timestamp < from_date or timestamp > to_date:
+                        continue
+                except:
+                    continue
+
+                if text_to_match > '':
+                    if not re.search(text_to_match, ann['highlight_text'] or '', flags=re.IGNORECASE):
                         continue
 
-                    # Check reader
-                    if reader_to_match != self.GENERIC_READER:
-                        this_reader = ua['reader']
-                        if this_reader != reader_to_match:
-                            continue
-
-                    # Check color
-                    if color_to_match != self.GENERIC_STYLE:
-                        this_color = ua.find('table')['color']
-                        if this_color != color_to_match:
-                            continue
-
-                    # Check date range, allow for mangled timestamp
-                    try:
-                        timestamp = float(ua.find('td', 'timestamp')['uts'])
-                        if timestamp < from_date or timestamp > to_date:
-                            continue
-                    except:
+                if note_to_match > '':
+                    if not re.search(note_to_match, ann['note_text'] or '', flags=re.IGNORECASE):
                         continue
 
-                    highlight_text = ''
-                    try:
-                        pels = ua.findAll('p', 'highlight')
-                        highlight_text = '\n'.join([p.string for p in pels])
-                    except:
-                        pass
-                    if text_to_match > '':
-                        if not re.search(text_to_match, highlight_text, flags=re.IGNORECASE):
-                            continue
-
-                    note_text = ''
-                    try:
-                        nels = ua.findAll('p', 'note')
-                        note_text = '\n'.join([n.string for n in nels])
-                    except:
-                        pass
-                    if note_to_match > '':
-                        if not re.search(note_to_match, note_text, flags=re.IGNORECASE):
-                            continue
-
-                    # If we made it this far, add the id to matched_ids
-                    self.matched_ids.add(cid)
-                    matched_titles.append(mi.title)
+                # If we made it this far, add the id to matched_ids
+                self.matched_ids.add(cid)
+                matched_titles.append(mi.title)
+                break
 
         # Update the results box
         matched_titles.sort()
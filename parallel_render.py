@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2026, agent <agent@local>'
+__docformat__ = 'restructuredtext en'
+
+'''
+Per-book render and merge work, run in process or fanned out to calibre
+worker processes. Tasks and results are plain dicts of strings and lists,
+so they pickle across the process boundary without any Qt or library objects.
+'''
+
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+# calibre Python 3 compatibility.
+from six import text_type as unicode
+
+from calibre.ebooks.BeautifulSoup import BeautifulSoup
+
+from calibre_plugins.annotations.annotation_parser import parse_annotations
+from calibre_plugins.annotations.annotations import (merge_field_annotations,
+                                                      merge_stored_annotations)
+from calibre_plugins.annotations.annotations_db import AnnotationsDB
+from calibre_plugins.annotations.common_utils import Logger, Struct
+from calibre_plugins.annotations.config import plugin_prefs
+
+
+def merge_task(cid, field, old_value, new_html, merge_index='hash', stored=None):
+    '''
+    Merge the rendered annotations new_html into old_value, the current
+    content of field for cid
+    stored: the annotations of old_value from AnnotationsDB.get_library_annotations(),
+    merged instead of parsing old_value
+    '''
+    return {'kind': 'merge', 'cid': cid, 'field': field, 'old_value': old_value,
+            'new_html': [new_html], 'merge_index': merge_index,
+            'stored': _plain_stored(stored)}
+
+
+def move_task(cid, old_field, new_field, comments, old_value, comments_divider, stored=None):
+    '''
+    Re-render the annotations of cid with the current style, moving them from
+    old_field to new_field
+    comments: the book's Comments
+    old_value: the content of old_field, if it is a custom column
+    stored: the annotations of old_field from AnnotationsDB.get_library_annotations(),
+    used instead of parsing it
+    '''
+    return {'kind': 'move', 'cid': cid, 'old_field': old_field, 'new_field': new_field,
+            'comments': comments, 'old_value': old_value,
+            'comments_divider': comments_divider, 'stored': _plain_stored(stored)}
+
+
+def _plain_stored(stored):
+    '''
+    stored annotations as plain dicts, for pickling
+    '''
+    if stored is None:
+        return None
+    return {'annotations': [dict(ann) for ann in stored['annotations']],
+            'comments': stored['comments']}
+
+
+def run_tasks(tasks, db=None):
+    '''
+    Run tasks in order, returning one result per task. This is the entry point
+    of the worker processes.
+    db: the plugin's AnnotationsDB when run in process, whose rendered
+    fragment cache is then used. Workers render with an unconnected one.
+    '''
+    if db is None:
+        db = AnnotationsDB(None, None)
+    return [TASKS[task['kind']](db, task) for task in tasks]
+
+
+def _merge(db, task):
+    '''
+    Return {cid, value, stored}, the merged content of field and, if known
+    without parsing it, its annotations
+    Several imports into the same book, e.g. News clippings, merge in turn.
+    '''
+    parent = Struct(opts=Struct(db=db),
+                    reader_app_class=Struct(MERGE_INDEX=task['merge_index']))
+    value, stored = task['old_value'], task['stored']
+    for new_html in task['new_html']:
+        if stored is not None and task['merge_index'] == 'hash':
+            value, stored = merge_stored_annotations(parent, task['cid'], task['field'],
+                                                     stored, new_html)
+        else:
+            value = merge_field_annotations(parent, task['cid'], task['field'], value, new_html)
+            stored = None
+    return {'cid': task['cid'], 'value': value, 'stored': stored}
+
+
+def _move(db, task):
+    '''
+    Return {cid, annotations, old_value, new_value, comments}, or None if the
+    book has no user_annotations. old_value is None when both fields are the
+    same, comments is the content of new_field outside the annotations.
+    '''
+    old_field, new_field = task['old_field'], task['new_field']
+    stored = task['stored']
+    if stored is not None and stored['comments'] is not None:
+        # Verified unedited since written, no need to parse it
+        if not stored['annotations']:
+            return None
+        stripped = stored['comments']
+        annotation_list = stored['annotations']
+    else:
+        source = task['comments'] if old_field == 'Comments' else task['old_value']
+        if not source:
+            return None
+        old_soup = BeautifulSoup(source)
+        uas = old_soup.find('div', 'user_annotations')
+        if not uas:
+            return None
+
+        # Remove user_annotations, and the comments_divider from Comments
+        uas.extract()
+        if old_field == 'Comments':
+            cd = old_soup.find('div', 'comments_divider')
+            if cd:
+                cd.extract()
+        stripped = unicode(old_soup)
+
+        # Capture content
+        annotation_list = [dict(ann) for ann in parse_annotations(source, task['cid']).annotations]
+
+    # Regurgitate it with current CSS style
+    new_html = db.rerender_to_html_from_list(annotation_list)
+
+    comments = None
+    if new_field == 'Comments':
+        # Add user_annotations to Comments
+        comments = stripped if old_field == 'Comments' else task['comments']
+        if comments is None:
+            new_value = new_html
+        else:
+            new_value = comments + task['comments_divider'] + new_html
+    else:
+        new_value = new_html
+
+    return {'cid': task['cid'],
+            'annotations': annotation_list,
+            'old_value': None if old_field == new_field else stripped,
+            'new_value': new_value,
+            'comments': comments}
+
+
+TASKS = {
+    'merge': _merge,
+    'move': _move,
+    }
+
+
+class RenderPool(Logger):
+    '''
+    Run per-book tasks, in worker processes when there are enough of them
+    plugin_prefs:
+        parallel_render_min_books: fewest tasks worth starting workers for, 0 never
+        parallel_render_workers: worker processes, 0 for one per core
+    '''
+    LOG_SUBSYSTEM = 'render'
+
+    # Fewest tasks fanned out to workers, below this process startup dominates
+    MIN_BOOKS = 50
+
+    # Most tasks handed to one worker process
+    BATCH_SIZE = 250
+
+    # Seconds a worker may take over one batch
+    WORKER_TIMEOUT = 30 * 60
+
+    def __init__(self, db):
+        self.db = db
+        self.min_books = plugin_prefs.get('parallel_render_min_books', self.MIN_BOOKS)
+        self.workers = plugin_prefs.get('parallel_render_workers', 0) or multiprocessing.cpu_count()
+
+    def run(self, tasks, progress=None):
+        '''
+        Return the results of tasks, in order
+        progress: called on the calling thread once per finished task
+        '''
+        if not self.min_books or len(tasks) < self.min_books or self.workers < 2:
+            results = []
+            for task in tasks:
+                results.extend(run_tasks([task], self.db))
+                if progress:
+                    progress()
+            return results
+
+        # Several batches per worker, so uneven books still spread over every core
+        batch_size = max(1, min(self.BATCH_SIZE, -(-len(tasks) // (self.workers * 4))))
+        batches = [tasks[i:i + batch_size] for i in range(0, len(tasks), batch_size)]
+        self._log_location("%d tasks" % len(tasks),
+                           "%d batches, %d workers" % (len(batches), self.workers))
+
+        results = []
+        pool = ThreadPool(min(self.workers, len(batches)))
+        try:
+            for batch, batch_results in zip(batches, pool.imap(self._fork, batches)):
+                if batch_results is None:
+                    batch_results = run_tasks(batch, self.db)
+                results.extend(batch_results)
+                if progress:
+                    for task in batch:
+                        progress()
+        finally:
+            pool.close()
+            pool.join()
+        return results
+
+    def _fork(self, batch):
+        '''
+        Run batch in a worker process, returning None if the worker failed
+        '''
+        from calibre.utils.ipc.simple_worker import fork_job
+        try:
+            return fork_job('calibre_plugins.annotations.parallel_render', 'run_tasks',
+                            args=(batch,), timeout=self.WORKER_TIMEOUT,
+                            no_output=True)['result']
+        except Exception as e:
+            self._log_location("ERROR: worker failed, rendering %d books in process" % len(batch), e)
+            return None
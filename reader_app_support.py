@@ -73,24 +73,39 @@ class ReaderApp(object):
     NSTimeIntervalSince1970 = 978307200.0
 
     LOCATION_TEMPLATE = "{cls}:{func}({arg1}) {arg2}"
+    LOG_SUBSYSTEM = 'reader'
 
-    def _log(self, msg=None):
+    def _log(self, msg=None, *args):
         '''
-        Print msg to console
+        Print msg % args to console
         '''
-        if not plugin_prefs.get('cfg_plugin_debug_log_checkbox', False):
+        from calibre_plugins.annotations.common_utils import LOG_INFO, log_level, log_message
+        if log_level(self.LOG_SUBSYSTEM) < LOG_INFO:
             return
 
         if msg:
-            debug_print(" %s" % str(msg))
+            debug_print(" %s" % str(log_message(msg, args)))
         else:
             debug_print()
 
+    def _log_debug(self, msg, *args):
+        '''
+        Print location, msg % args to console at LOG_DEBUG
+        '''
+        from calibre_plugins.annotations.common_utils import LOG_DEBUG, log_level, log_message
+        if log_level(self.LOG_SUBSYSTEM) < LOG_DEBUG:
+            return
+
+        debug_print(self.LOCATION_TEMPLATE.format(cls=self.__class__.__name__,
+                    func=sys._getframe(1).f_code.co_name,
+                    arg1='', arg2=log_message(msg, args)))
+
     def _log_location(self, *args):
         '''
         Print location, args to console
         '''
-        if not plugin_prefs.get('cfg_plugin_debug_log_checkbox', False):
+        from calibre_plugins.annotations.common_utils import LOG_INFO, log_level
+        if log_level(self.LOG_SUBSYSTEM) < LOG_INFO:
             return
 
         arg1 = arg2 = ''
@@ -104,7 +119,6 @@ class ReaderApp(object):
                     func=sys._getframe(1).f_code.co_name,
                     arg1=arg1, arg2=arg2))
 
-
     def __init__(self, parent):
         """
         Basic initialization
@@ -140,19 +154,25 @@ class ReaderApp(object):
     def add_to_annotations_db(self, annotations_db, annotation_mi):
         self.opts.db.add_to_annotations_db(annotations_db, annotation_mi)
 
+    def add_to_annotations_db_bulk(self, annotations_db, annotations):
+        return self.opts.db.add_to_annotations_db_bulk(annotations_db, annotations)
+
     def add_to_books_db(self, books_db, book_mi):
         self.opts.db.add_to_books_db(books_db, book_mi)
 
-    def create_annotations_table(self, cached_db):
-        self.opts.db.create_annotations_table(cached_db)
+    def add_to_books_db_bulk(self, books_db, books):
+        return self.opts.db.add_to_books_db_bulk(books_db, books)
 
-    def create_books_table(self, cached_db):
+    def create_annotations_table(self, cached_db, rebuild=True):
+        return self.opts.db.create_annotations_table(cached_db, rebuild=rebuild)
+
+    def create_books_table(self, cached_db, rebuild=True):
         """
         The <app>_books_<device> table contains a list of books installed on the device.
         book_id is the unique id that the app uses to reference the book in its
         associated annotations table.
         """
-        self.opts.db.create_books_table(cached_db)
+        return self.opts.db.create_books_table(cached_db, rebuild=rebuild)
 
     @staticmethod
     def generate_annotations_db_name(reader_app, device_name):
@@ -162,6 +182,12 @@ class ReaderApp(object):
     def generate_books_db_name(reader_app, device_name):
         return ReaderApp.BOOKS_DB_TEMPLATE.format(re.sub('\W', '_', reader_app), re.sub('\W', '_', device_name))
 
+    def get_annotated_book_ids(self, annotations_db):
+        return self.opts.db.get_annotated_book_ids(annotations_db)
+
+    def get_annotation_ids(self, annotations_db):
+        return self.opts.db.get_annotation_ids(annotations_db)
+
     def get_books(self, books_db):
         return self.opts.db.get_books(books_db)
 
@@ -198,6 +224,9 @@ class ReaderApp(object):
     def get_genres(self, books_db, book_id):
         return self.opts.db.get_genres(books_db, book_id)
 
+    def get_high_water_mark(self, cached_db):
+        return self.opts.db.get_high_water_mark(cached_db)
+
     @staticmethod
     def get_reader_app_classes():
         """
@@ -217,9 +246,21 @@ class ReaderApp(object):
     def get_title(self, books_db, book_id):
         return self.opts.db.get_title(books_db, book_id)
 
+    def refresh_last_annotations(self, books_db, annotations_db):
+        self.opts.db.refresh_last_annotations(books_db, annotations_db)
+
+    def set_high_water_mark(self, cached_db, high_water_mark):
+        self.opts.db.set_high_water_mark(cached_db, high_water_mark)
+
+    def tombstone_annotations(self, annotations_db, live_annotation_ids):
+        return self.opts.db.tombstone_annotations(annotations_db, live_annotation_ids)
+
     def update_book_last_annotation(self, books_db, timestamp, book_id):
         self.opts.db.update_book_last_annotation(books_db, timestamp, book_id)
 
+    def update_book_last_annotation_bulk(self, books_db, last_annotations):
+        self.opts.db.update_book_last_annotation_bulk(books_db, last_annotations)
+
     def update_timestamp(self, cached_db):
         self.opts.db.update_timestamp(cached_db)
 
@@ -235,7 +276,7 @@ class ReaderApp(object):
         """
         cached_timestamp = self.opts.db.get('''SELECT timestamp
                                                FROM timestamps
-                                               WHERE db="{0}"'''.format(cached_db), all=False)
+                                               WHERE db = ?''', (cached_db,), all=False)
         current_timestamp = unicode(datetime.fromtimestamp(os.path.getmtime(dependent_file)))
 
         if False and self.opts.verbose:
@@ -498,7 +539,7 @@ class iOSReaderApp(ReaderApp):
         """
         cached_timestamp = self.opts.db.get('''SELECT timestamp
                                                FROM timestamps
-                                               WHERE db="{0}"'''.format(cached_db), all=False)
+                                               WHERE db = ?''', (cached_db,), all=False)
 
         unix_timestamp = dependent_file_stats['st_mtime']
         current_timestamp = unicode(datetime.fromtimestamp(unix_timestamp))
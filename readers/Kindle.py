@@ -8,7 +8,7 @@ __license__ = 'GPL v3'
 __copyright__ = '2013, Greg Riker <griker@hotmail.com>'
 __docformat__ = 'restructuredtext en'
 
-import glob, os, re
+import glob, hashlib, json, os, re
 
 from time import localtime, mktime
 
@@ -20,6 +20,7 @@ from calibre_plugins.annotations.common_utils import (AnnotationStruct, BookStru
 KINDLE_FORMATS = [u'azw', u'azw1', u'azw3', u'kfx', u'mobi', u'pdf']
 KINDLE_TEMPLATES = ['*.azw', '*.azw3', '*.kfx', '*.mobi', '*.pobi', '*.pdf']
 MY_CLIPPINGS_FILENAMES = ['My Clippings.txt', 'Meine Clippings.txt']
+MY_CLIPPINGS_SEPARATOR = b'=========='
 
 class KindleReaderApp(USBReader):
     """
@@ -64,11 +65,14 @@ class KindleReaderApp(USBReader):
         self.annotations_db = self.generate_annotations_db_name(self.app_name_, self.opts.device_name)
         self.books_db = self.generate_books_db_name(self.app_name_, self.opts.device_name)
 
-        # Create the annotations table
-        self.create_annotations_table(self.annotations_db)
+        # Create the annotations table, keeping the cached rows for a delta sync
+        rebuilt = self.create_annotations_table(self.annotations_db, rebuild=not self.opts.delta_sync)
+        high_water_mark = None
+        if not rebuilt:
+            high_water_mark = self.get_high_water_mark(self.annotations_db)
 
         # Parse MyClippings.txt for entries matching installed_books
-        self._parse_my_clippings()
+        self._parse_my_clippings(high_water_mark)
 
         # Initialize the progress bar
         self.opts.pb.set_label("Getting highlights from %s" % self.app_name)
@@ -76,7 +80,8 @@ class KindleReaderApp(USBReader):
         self.opts.pb.show()
         self.opts.pb.set_maximum(len(self.active_annotations))
 
-        # Add annotations to the database
+        # Collect annotations for a single bulk write
+        annotations = []
         for timestamp in sorted(list(self.active_annotations.keys())):
             # Populate an AnnotationStruct with available data
             ann_mi = AnnotationStruct()
@@ -107,17 +112,19 @@ class KindleReaderApp(USBReader):
                 note_text = '\n'.join(self.active_annotations[timestamp]['note_text'])
                 ann_mi.note_text = note_text
 
-            # Add annotation to self.annotations_db
-            self.add_to_annotations_db(self.annotations_db, ann_mi)
+            annotations.append(ann_mi)
 
             # Increment the progress bar
             self.opts.pb.increment()
 
-            # Update last_annotation in self.books_db
-            self.update_book_last_annotation(self.books_db, timestamp, ann_mi.book_id)
-
         self.opts.pb.hide()
 
+        # Add annotations to self.annotations_db, update last_annotation in self.books_db
+        self.add_to_annotations_db_bulk(self.annotations_db, annotations)
+        self.refresh_last_annotations(self.books_db, self.annotations_db)
+        if self.opts.delta_sync:
+            self.set_high_water_mark(self.annotations_db, self.clippings_high_water_mark)
+
         # Update the timestamp
         self.update_timestamp(self.annotations_db)
         self.commit()
@@ -162,7 +169,7 @@ class KindleReaderApp(USBReader):
         self.installed_books_by_title = {}
 
         # Create the books table
-        self.create_books_table(self.books_db)
+        self.create_books_table(self.books_db, rebuild=not self.opts.delta_sync)
 
         # Initialize the progress bar
         self.opts.pb.set_label("Getting installed books from %s" % self.app_name)
@@ -170,7 +177,8 @@ class KindleReaderApp(USBReader):
         self.opts.pb.show()
         self.opts.pb.set_maximum(len(resolved_path_map))
 
-        #  Add installed books to the database
+        #  Collect installed books for a single bulk write
+        books = []
         for book_id in resolved_path_map:
             try:
                 self._log("Getting metadata from book. path='%s'" % (resolved_path_map[book_id]))
@@ -226,8 +234,7 @@ class KindleReaderApp(USBReader):
             if hasattr(mi, 'uuid'):
                 book_mi.uuid = mi.uuid
 
-            # Add book to self.books_db
-            self.add_to_books_db(self.books_db, book_mi)
+            books.append(book_mi)
 
             # Add book to indexed_books
             self.installed_books_by_title[mi.title.strip()] = {'book_id': book_id, 'author_sort': mi.author_sort}
@@ -236,6 +243,10 @@ class KindleReaderApp(USBReader):
             self.opts.pb.increment()
 
         self.opts.pb.hide()
+
+        # Add books to self.books_db
+        self.add_to_books_db_bulk(self.books_db, books)
+
         # Update the timestamp
         self.update_timestamp(self.books_db)
         self.commit()
@@ -327,12 +338,66 @@ class KindleReaderApp(USBReader):
 
         return resolved_path_map
 
-    def _parse_my_clippings(self):
+    def _parse_my_clippings(self, high_water_mark=None):
+        '''
+        Parse My Clippings.txt for entries matching installed books.
+        high_water_mark is recorded by a previous delta sync: the offset of the
+        end of the last record parsed, a digest of the file up to that offset
+        and a digest of the installed titles. If the file still starts with
+        the same content and no books were installed since, only the records
+        appended after the offset are parsed. Otherwise the cached annotations
+        are rebuilt from the whole file.
+        self.clippings_high_water_mark is set for the next delta sync.
+        '''
         import ParseKindleMyClippingsTxt
         def log(level, msg, self=self):
             self._log('ParseKindleMyClippingsTxt '+level+': '+msg)
         ParseKindleMyClippingsTxt.log = log
-        annos = ParseKindleMyClippingsTxt.FromFileName(self._get_my_clippings())
+
+        self.clippings_high_water_mark = None
+        raw = b''
+        mc_path = self._get_my_clippings()
+        if mc_path:
+            try:
+                with open(mc_path, 'rb') as f:
+                    raw = f.read()
+            except Exception as e:
+                log('ERROR', "Error trying to read clippings file: %s" % (str(e),))
+
+        titles_digest = hashlib.md5(json.dumps(sorted(self.installed_books_by_title.keys())).encode('utf-8')).hexdigest()
+
+        offset = 0
+        if high_water_mark:
+            hwm = json.loads(high_water_mark)
+            if (hwm['offset'] <= len(raw) and
+                    hwm['titles'] == titles_digest and
+                    hashlib.md5(raw[:hwm['offset']]).hexdigest() == hwm['digest']):
+                offset = hwm['offset']
+                self._log(" Delta sync from offset %d of %d" % (offset, len(raw)))
+            else:
+                self._log(" 'My Clippings.txt' or installed books changed, rebuilding cached annotations")
+                self.create_annotations_table(self.annotations_db)
+
+        # Annotation ids are derived from timestamps made unique by
+        # incrementing, so avoid those already used by cached annotations
+        used_timestamps = set()
+        if offset:
+            used_timestamps = set(float(annotation_id) for annotation_id in self.get_annotation_ids(self.annotations_db))
+
+        # Only record a high-water mark if the file ends with a complete record
+        if raw.rstrip().endswith(MY_CLIPPINGS_SEPARATOR):
+            self.clippings_high_water_mark = json.dumps({
+                'digest': hashlib.md5(raw).hexdigest(),
+                'offset': len(raw),
+                'titles': titles_digest})
+
+        annos = []
+        if raw[offset:].strip():
+            try:
+                annos = ParseKindleMyClippingsTxt.FromUtf8String(raw[offset:]) or []
+            except Exception as e:
+                log('ERROR', "Error trying to parse clippings file: %s" % (str(e),))
+                self.clippings_high_water_mark = None
         self._log(" Number of entries retrieved from 'My Clippings.txt'=%d" % (len(annos)))
         for anno in annos:
             title = anno.title
@@ -352,7 +417,7 @@ class KindleReaderApp(USBReader):
             else:
                 self._log("    Unable to parse entries from 'My Clippings.txt'")
                 timestamp = mktime(localtime())
-            while timestamp in self.active_annotations:
+            while timestamp in self.active_annotations or timestamp in used_timestamps:
                 timestamp += 1
             self.active_annotations[timestamp] = {
                 'annotation_id': timestamp,
@@ -39,6 +39,13 @@ class KoboFetchingApp(USBReader):
     app_name = 'Kobo'
 #    MERGE_INDEX = "timestamp"
 
+    # Delta sync: only read bookmarks of cached books modified since the high-water mark,
+    # filled into the {delta_since} placeholder of the bookmark queries
+    DELTA_SINCE_CLAUSE = 'AND substr(IFNULL(bm.DateModified, bm.DateCreated), 1, 10) >= ? '
+    delta_book_ids = set()
+    delta_since = None
+    live_annotation_ids = None
+
     # Fetch the active annotations, add them to the annotations_db
     def get_active_annotations(self):
         '''
@@ -66,8 +73,12 @@ class KoboFetchingApp(USBReader):
         self.books_db = self.generate_books_db_name(self.app_name_, self.opts.device_name)
         self._log("%s:get_active_annotations() - annotations_db=%s, books_db=%s" % (self.app_name, annotations_db, self.books_db))
 
-        # Create the annotations table
-        self.create_annotations_table(annotations_db)
+        # Create the annotations table, keeping the cached rows for a delta sync
+        rebuilt = self.create_annotations_table(annotations_db, rebuild=not self.opts.delta_sync)
+        if not rebuilt:
+            self.delta_since = self.get_high_water_mark(annotations_db)
+            self.delta_book_ids = self.get_annotated_book_ids(annotations_db)
+        self.delta_high_water_mark = self.delta_since
 
         self._fetch_annotations()
         # Initialize the progress bar
@@ -76,7 +87,8 @@ class KoboFetchingApp(USBReader):
         self.opts.pb.set_maximum(len(self.active_annotations))
 
 #         self._log("%s:get_active_annotations() - self.active_annotations={0}".format(self.active_annotations))
-        # Add annotations to the database
+        # Collect annotations for a single bulk write
+        annotations = []
         for annotation in sorted(list(self.active_annotations.values()), key=lambda k: (k['book_id'], k['last_modification'])):
             # Populate an AnnotationStruct with available data
             ann_mi = AnnotationStruct()
@@ -103,15 +115,18 @@ class KoboFetchingApp(USBReader):
                 ann_mi.location_sort = annotation['location_sort']
 #            self._log(ann_mi)
 
-            # Add annotation to annotations_db
-            self.add_to_annotations_db(annotations_db, ann_mi)
+            annotations.append(ann_mi)
 
             # Increment the progress bar
             self.opts.pb.increment()
 
-#             self._log("%s:get_active_annotations() - books_db=%s" % (self.app_name, self.books_db))
-            # Update last_annotation in books_db
-            self.update_book_last_annotation(self.books_db, ann_mi.last_modification, ann_mi.book_id)
+        # Add annotations to annotations_db, update last_annotation in books_db
+        self.add_to_annotations_db_bulk(annotations_db, annotations)
+        if self.opts.delta_sync:
+            if not rebuilt and self.live_annotation_ids is not None:
+                self.tombstone_annotations(annotations_db, self.live_annotation_ids)
+            self.set_high_water_mark(annotations_db, self.delta_high_water_mark)
+        self.refresh_last_annotations(self.books_db, annotations_db)
 
         # Update the timestamp
         self.update_timestamp(annotations_db)
@@ -153,7 +168,7 @@ class KoboFetchingApp(USBReader):
         self.installed_books_by_title = {}
 
         # Create the books table
-        self.create_books_table(self.books_db)
+        self.create_books_table(self.books_db, rebuild=not self.opts.delta_sync)
 
         # Initialize the progress bar
         self.opts.pb.set_label("Getting installed books from %s" % self.app_name)
@@ -161,7 +176,8 @@ class KoboFetchingApp(USBReader):
         self.opts.pb.set_maximum(len(self.onDeviceIds))
         self._log("Number of books on the device=%d" % len(self.onDeviceIds))
 
-        #  Add installed books to the database
+        #  Collect installed books for a single bulk write
+        books = []
         for book_id in self.onDeviceIds:
             mi = db.get_metadata(book_id, index_is_id=True)
 #            self._log_location("book: {0} - {1}".format(mi.authors, mi.title))
@@ -203,8 +219,7 @@ class KoboFetchingApp(USBReader):
             if hasattr(mi, 'uuid'):
                 book_mi.uuid = mi.uuid
 
-            # Add book to self.books_db
-            self.add_to_books_db(self.books_db, book_mi)
+            books.append(book_mi)
 
             # Add book to indexed_books
             self.installed_books_by_title[mi.title] = {'book_id': book_id, 'author_sort': mi.author_sort}
@@ -212,6 +227,9 @@ class KoboFetchingApp(USBReader):
             # Increment the progress bar
             self.opts.pb.increment()
 
+        # Add books to self.books_db
+        self.add_to_books_db_bulk(self.books_db, books)
+
         # Update the timestamp
         self.update_timestamp(self.books_db)
         self.commit()
@@ -244,6 +262,7 @@ class KoboFetchingApp(USBReader):
                         'WHERE bm.Hidden = "false" '
                         'AND MimeType NOT IN ("application/xhtml+xml", "application/x-kobo-epub+zip") '
                         'AND bm.VolumeID = ? '
+                        '{delta_since}'
                         'ORDER BY bm.volumeid, bm.DateCreated, c.VolumeIndex, bm.chapterprogress'
                         )
         kepub_bookmark_query = (
@@ -257,6 +276,7 @@ class KoboFetchingApp(USBReader):
                                 'AND ContentType = 899 '
                                 'AND c.ContentID LIKE bm.ContentID || "-%" '
                                 'AND bm.VolumeID = c.BookID '
+                                '{delta_since}'
                                 'ORDER BY bm.volumeid, bm.DateCreated, c.VolumeIndex, bm.chapterprogress'
                                )
         kepub_bookmark_query = (
@@ -270,6 +290,7 @@ class KoboFetchingApp(USBReader):
                                 'AND ContentType = 6 '
                                 'AND bm.VolumeID = c.ContentID '
                                 'AND bm.VolumeID = ? '
+                                '{delta_since}'
                                 'ORDER BY bm.volumeid, bm.DateCreated, c.VolumeIndex, bm.chapterprogress'
                                )
         kepub_chapter_query = (
@@ -357,6 +378,12 @@ class KoboFetchingApp(USBReader):
             except StopIteration:
                 count_bookmarks = 0
             self._log("_fetch_annotations - Total number of bookmarks={0}".format(count_bookmarks))
+
+            if self.opts.delta_sync:
+                # Bookmarks still on the device, cached rows not in this set are tombstoned
+                cursor.execute('SELECT BookmarkID FROM Bookmark WHERE Hidden = "false"')
+                self.live_annotation_ids = set(row['BookmarkID'] for row in cursor)
+                self._log("_fetch_annotations - delta sync since {0}, live bookmarks={1}".format(self.delta_since, len(self.live_annotation_ids)))
             
             self._log("_fetch_annotations - About to get non-kepub annotations")
 #             self._read_database_annotations(connection, bookmark_query, path_map)
@@ -379,10 +406,13 @@ class KoboFetchingApp(USBReader):
             self._log("_read_database_annotations - contentId={0} book={1}".format(contentId, path_map[contentId]))
             kepub = (contentId.endswith('.kepub.epub') or not os.path.splitext(contentId)[1])
             self._log("_read_database_annotations - contentId={0} book={1}".format(contentId, path_map[contentId]))
-            if kepub:
-                bookmark_cursor.execute(kepub_bookmark_query, [contentId])
-            else:
-                bookmark_cursor.execute(bookmark_query, [contentId])
+            query = kepub_bookmark_query if kepub else bookmark_query
+            params = [contentId]
+            delta_since = ''
+            if self.delta_since and str(book_id) in self.delta_book_ids:
+                delta_since = self.DELTA_SINCE_CLAUSE
+                params.append(self.delta_since)
+            bookmark_cursor.execute(query.format(delta_since=delta_since), params)
             new_book = True
             for row in bookmark_cursor:
                 self.opts.pb.increment()
@@ -442,6 +472,10 @@ class KoboFetchingApp(USBReader):
                 else:
                     chapter_title   = row['Title']
     
+                if row['DateModified'] and (self.delta_high_water_mark is None or
+                                            row['DateModified'][:10] > self.delta_high_water_mark):
+                    self.delta_high_water_mark = row['DateModified'][:10]
+
                 bookmark_timestamp = convert_kobo_date(row['DateModified'])
                 self._log("_read_database_annotations - bookmark_timestamp={0}, row['DateModified']='{1}'".format(bookmark_timestamp, row['DateModified']))
                 bookmark_timestamp = mktime(bookmark_timestamp.timetuple())
@@ -142,7 +142,9 @@ class SonyReaderApp(USBReader):
         self.opts.pb.set_value(0)
         self.opts.pb.set_maximum(len(dict_of_anns))
 
-        # Add annotations to the database
+        # Collect annotations for a single bulk write
+        annotations = []
+        last_annotations = {}
         for timestamp in sorted(dict_of_anns.keys()):
             # Populate an AnnotationStruct with available data
             ann_mi = AnnotationStruct()
@@ -169,14 +171,17 @@ class SonyReaderApp(USBReader):
                 ann_mi.location = str(int(next(iter(dict_of_anns[timestamp]['location'] or []), None)))
                 ann_mi.location = ('p. '+ann_mi.location) if ann_mi.location != None else ''
 
-            # Add annotation to annotations_db
-            self.add_to_annotations_db(annotations_db, ann_mi)
+            annotations.append(ann_mi)
 
             # Increment the progress bar
             self.opts.pb.increment()
 
-            # Update last_annotation in books_db
-            self.update_book_last_annotation(self.books_db, timestamp, ann_mi.book_id)
+            # Track last_annotation for books_db
+            last_annotations[ann_mi.book_id] = timestamp
+
+        # Add annotations to annotations_db, update last_annotation in books_db
+        self.add_to_annotations_db_bulk(annotations_db, annotations)
+        self.update_book_last_annotation_bulk(self.books_db, last_annotations)
 
         # Update the timestamp
         self.update_timestamp(annotations_db)
@@ -239,7 +244,8 @@ class SonyReaderApp(USBReader):
         self.opts.pb.set_value(0)
         self.opts.pb.set_maximum(len(dict_of_books))
 
-        #  Add installed books to the database
+        #  Collect installed books for a single bulk write
+        books = []
         for book_id in dict_of_books:
             # Add book_id to list of installed_books (make this a sql function)
             installed_books.add(book_id)
@@ -268,12 +274,14 @@ class SonyReaderApp(USBReader):
             if 'uuid' in dict_of_books[book_id]:
                 book_mi.uuid = dict_of_books[book_id]['uuid']
 
-            # Add book to books_db
-            self.add_to_books_db(self.books_db, book_mi)
+            books.append(book_mi)
 
             # Increment the progress bar
             self.opts.pb.increment()
 
+        # Add books to books_db
+        self.add_to_books_db_bulk(self.books_db, books)
+
         # Update the timestamp
         self.update_timestamp(self.books_db)
         self.commit()
@@ -76,7 +76,9 @@ class TolinoReaderApp(USBReader):
         self.opts.pb.show()
         self.opts.pb.set_maximum(len(self.active_annotations))
 
-        # Add annotations to the database
+        # Collect annotations for a single bulk write
+        annotations = []
+        last_annotations = {}
         for timestamp in sorted(self.active_annotations.keys()):
             # Populate an AnnotationStruct with available data
             ann_mi = AnnotationStruct()
@@ -107,17 +109,20 @@ class TolinoReaderApp(USBReader):
                 note_text = '\n'.join(self.active_annotations[timestamp]['note_text'])
                 ann_mi.note_text = note_text
 
-            # Add annotation to self.annotations_db
-            self.add_to_annotations_db(self.annotations_db, ann_mi)
+            annotations.append(ann_mi)
 
             # Increment the progress bar
             self.opts.pb.increment()
 
-            # Update last_annotation in self.books_db
-            self.update_book_last_annotation(self.books_db, timestamp, ann_mi.book_id)
+            # Track last_annotation for self.books_db
+            last_annotations[ann_mi.book_id] = timestamp
 
         self.opts.pb.hide()
 
+        # Add annotations to self.annotations_db, update last_annotation in self.books_db
+        self.add_to_annotations_db_bulk(self.annotations_db, annotations)
+        self.update_book_last_annotation_bulk(self.books_db, last_annotations)
+
         # Update the timestamp
         self.update_timestamp(self.annotations_db)
         self.commit()
@@ -167,7 +172,8 @@ class TolinoReaderApp(USBReader):
         self.opts.pb.show()
         self.opts.pb.set_maximum(len(self.onDeviceIds))
 
-        #  Add installed books to the database
+        #  Collect installed books for a single bulk write
+        books = []
         for book_id in self.onDeviceIds:
             try:
                 library_mi = mi = db.get_metadata(book_id, index_is_id=True)
@@ -239,14 +245,17 @@ class TolinoReaderApp(USBReader):
                 book_mi.uuid = library_mi.uuid
                 self.installed_books_by_title[mi.title]['uuid'] = book_mi.uuid
 
-            # Add book to self.books_db
-            self.add_to_books_db(self.books_db, book_mi)
+            books.append(book_mi)
 
 
             # Increment the progress bar
             self.opts.pb.increment()
 
         self.opts.pb.hide()
+
+        # Add books to self.books_db
+        self.add_to_books_db_bulk(self.books_db, books)
+
         # Update the timestamp
         self.update_timestamp(self.books_db)
         self.commit()
@@ -165,6 +165,8 @@ class MarvinReaderApp(iOSReaderApp):
                             ''')
                 rows = cur.fetchall()
                 self.opts.pb.set_maximum(len(rows))
+                annotations = []
+                last_annotations = {}
                 for row in rows:
                     self.opts.pb.increment()
 
@@ -232,11 +234,12 @@ class MarvinReaderApp(iOSReaderApp):
                             interior,
                             int(row[b'StartOffset']))
 
-                    # Add annotation
-                    self.add_to_annotations_db(cached_db, a_mi)
+                    annotations.append(a_mi)
+                    last_annotations[book_id] = row[b'NoteDateTime']
 
-                    # Update last_annotation in books_db
-                    self.update_book_last_annotation(books_db, row[b'NoteDateTime'], book_id)
+                # Add annotations, update last_annotation in books_db
+                self.add_to_annotations_db_bulk(cached_db, annotations)
+                self.update_book_last_annotation_bulk(books_db, last_annotations)
 
                 # Update the timestamp
                 self.update_timestamp(cached_db)
@@ -289,6 +292,7 @@ class MarvinReaderApp(iOSReaderApp):
                             ''')
                 rows = cur.fetchall()
                 self.opts.pb.set_maximum(len(rows))
+                books = []
                 for row in rows:
                     self.opts.pb.increment()
                     this_is_news = False
@@ -327,8 +331,7 @@ class MarvinReaderApp(iOSReaderApp):
                     b_mi.title_sort = row[b'CalibreTitleSort']
                     b_mi.uuid = row[b'UUID']
 
-                    # Add book to books_db
-                    self.add_to_books_db(cached_db, b_mi)
+                    books.append(b_mi)
 
                     # Get the library cid, confidence
                     toc_entries = None
@@ -345,6 +348,9 @@ class MarvinReaderApp(iOSReaderApp):
                             toc_entries = self._get_epub_toc(path=path)
                     self.tocs[book_id] = toc_entries
 
+                # Add books to books_db
+                self.add_to_books_db_bulk(cached_db, books)
+
                 # Update the timestamp
                 self.update_timestamp(cached_db)
                 self.commit()
@@ -435,6 +441,7 @@ class MarvinReaderApp(iOSReaderApp):
                         highlights[datetime][md] = hl.get(md)
 
                 sorted_keys = sorted(highlights.keys())
+                annotations = []
                 for datetime in sorted_keys:
                     highlight_text = highlights[datetime]['text']
                     note_text = highlights[datetime]['note']
@@ -476,8 +483,12 @@ class MarvinReaderApp(iOSReaderApp):
                             interior,
                             int(highlights[datetime]['startoffset']))
 
-                    self.add_to_annotations_db(self.annotations_db, a_mi)
-                    self.update_book_last_annotation(self.books_db, datetime, book_mi['book_id'])
+                    annotations.append(a_mi)
+
+                self.add_to_annotations_db_bulk(self.annotations_db, annotations)
+                if annotations:
+                    self.update_book_last_annotation(self.books_db,
+                        annotations[-1].last_modification, book_mi['book_id'])
 
             # Update the timestamps
             self.update_timestamp(self.annotations_db)
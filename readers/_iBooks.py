@@ -75,6 +75,8 @@ class iBooksReaderApp(iOSReaderApp):
                             ''')
                 rows = cur.fetchall()
                 self.opts.pb.set_maximum(len(rows))
+                annotations = []
+                last_annotations = {}
                 for row in rows:
                     self.opts.pb.increment()
                     book_id = row[b'ZANNOTATIONASSETID']
@@ -121,13 +123,12 @@ class iBooksReaderApp(iOSReaderApp):
 
                     a_mi.note_text = note_text
 
-                    # Add annotation
-                    self.add_to_annotations_db(cached_db, a_mi)
+                    annotations.append(a_mi)
+                    last_annotations[book_id] = row[b'ZANNOTATIONMODIFICATIONDATE'] + self.NSTimeIntervalSince1970
 
-                    # Update last_annotation in books_db
-                    self.update_book_last_annotation(books_db,
-                                                 row[b'ZANNOTATIONMODIFICATIONDATE'] + self.NSTimeIntervalSince1970,
-                                                 book_id)
+                # Add annotations, update last_annotation in books_db
+                self.add_to_annotations_db_bulk(cached_db, annotations)
+                self.update_book_last_annotation_bulk(books_db, last_annotations)
 
                 self.update_timestamp(cached_db)
                 self.commit()
@@ -179,6 +180,7 @@ class iBooksReaderApp(iOSReaderApp):
                             ''')
                 rows = cur.fetchall()
                 self.opts.pb.set_maximum(len(rows))
+                books = []
                 for row in rows:
                     self.opts.pb.increment()
                     this_is_news = False
@@ -205,8 +207,7 @@ class iBooksReaderApp(iOSReaderApp):
                     b_mi.title_sort = row[b'ZSORTTITLE']
                     b_mi.uuid = mi['uuid']
 
-                    # Add book to books_db
-                    self.add_to_books_db(cached_db, b_mi)
+                    books.append(b_mi)
 
                     # Get the library cid, confidence
                     toc_entries = None
@@ -223,6 +224,9 @@ class iBooksReaderApp(iOSReaderApp):
                                 toc_entries = self._get_epub_toc(path=path)
                     self.tocs[book_id] = toc_entries
 
+                # Add books to books_db
+                self.add_to_books_db_bulk(cached_db, books)
+
                 # Update the timestamp
                 self.update_timestamp(cached_db)
                 self.commit()
@@ -73,6 +73,7 @@ class KindleReaderApp(iOSReaderApp):
             self.create_annotations_table(cached_db)
 
             annotations = {}
+            last_annotations = {}
 
             con_a = sqlite3.connect(remote_annotations_db)
             con_a.row_factory = sqlite3.Row
@@ -168,10 +169,14 @@ class KindleReaderApp(iOSReaderApp):
                             ZRAWPOSITION=row[b'ZRAWPOSITION']
                             )
 
-                    # Update last_annotation in books_db
-                    self.update_book_last_annotation(books_db, timestamp, book_id)
+                    # Track last_annotation for books_db
+                    last_annotations[book_id] = timestamp
+
+                # Update last_annotation in books_db
+                self.update_book_last_annotation_bulk(books_db, last_annotations)
 
                 # Write the annotations
+                annotation_list = []
                 for timestamp in annotations:
                     ann_mi = AnnotationStruct()
 
@@ -187,8 +192,10 @@ class KindleReaderApp(iOSReaderApp):
                     ann_mi.location_sort = annotations[timestamp]['location_sort']
                     ann_mi.note_text = annotations[timestamp]['note_text']
 
-                    # Add annotation to self.annotations_db
-                    self.add_to_annotations_db(cached_db, ann_mi)
+                    annotation_list.append(ann_mi)
+
+                # Add annotations to self.annotations_db
+                self.add_to_annotations_db_bulk(cached_db, annotation_list)
 
                 # Update the timestamp
                 self.update_timestamp(cached_db)
@@ -237,6 +244,7 @@ class KindleReaderApp(iOSReaderApp):
                             ''')
                 rows = cur.fetchall()
                 self.opts.pb.set_maximum(len(rows))
+                books = []
                 for row in rows:
                     book_id = row[b'ZBOOKID']
                     installed_books.add(book_id)
@@ -273,10 +281,12 @@ class KindleReaderApp(iOSReaderApp):
                     if mi.tags:
                         book_mi.genre = ', '.join([tag for tag in mi.tags])
 
-                    # Add book to self.books_db
-                    self.add_to_books_db(cached_db, book_mi)
+                    books.append(book_mi)
                     self.opts.pb.increment()
 
+                # Add books to self.books_db
+                self.add_to_books_db_bulk(cached_db, books)
+
                 # Update the timestamp
                 self.update_timestamp(cached_db)
                 self.opts.conn.commit()